@@ -1,7 +1,11 @@
 import os
+import sys
 
 import boto3
 
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from upload_spool import S3Backend, UploadSpool  # noqa: E402
+
 AWS_ACCESS_KEY_ID = os.environ["AWS_ACCESS_KEY_ID"]
 AWS_SECRET_ACCESS_KEY = os.environ["AWS_SECRET_ACCESS_KEY"]
 
@@ -18,9 +22,15 @@ bucket_name = "rpi-zero2w-toolhead-camera"
 local_file_path = "src/ac_training_lab/A1-cam/_scripts/example_file.txt"
 s3_object_name = "example_file.txt"  # This can include subdirectories in S3
 
+# The file is spooled to disk first, so if the upload fails (or the script is
+# interrupted) it is retried, including on the next run
+spool = UploadSpool("upload_spool", S3Backend(s3_client, bucket_name))
+
 # Will be very slow on the NOKIA (UoT preferred)
 print(f"Uploading file '{local_file_path}' to '{bucket_name}/{s3_object_name}'...")
-s3_client.upload_file(local_file_path, bucket_name, s3_object_name)
+with open(local_file_path, "rb") as f:
+    spool.put(f.read(), s3_object_name)
+spool.join()
 
 print(
     f"File '{local_file_path}' uploaded to '{bucket_name}/{s3_object_name}' successfully."  # noqa: E501
@@ -1,13 +1,16 @@
+import io
 import json
 import logging
 import sys
+import threading
 import traceback
 from datetime import datetime, timezone
-from queue import Queue
-from time import sleep, time
+from queue import Full, Queue
+from time import monotonic, sleep, time
 
 import boto3
 import paho.mqtt.client as mqtt
+from boto3.s3.transfer import TransferConfig
 from libcamera import Transform
 from my_secrets import (
     AWS_ACCESS_KEY_ID,
@@ -22,6 +25,7 @@ from my_secrets import (
     MQTT_USERNAME,
 )
 from picamera2 import Picamera2
+from upload_spool import S3Backend, SpoolFull, UploadSpool
 
 # Configure logging, useful when running `sudo journalctl -u a1-cam.service -f`,
 # as described in README.
@@ -36,7 +40,23 @@ logging.basicConfig(
 logger = logging.getLogger("a1-cam")
 
 
-command_queue: "Queue[dict]" = Queue()
+# Captures waiting for the camera. Requests beyond this are rejected instead of
+# piling up behind a long burst.
+CAPTURE_QUEUE_SIZE = 8
+MAX_BURST_FRAMES = 100
+UPLOAD_WORKERS = 4
+# Images are spooled to disk before uploading so a network drop doesn't lose
+# them. Captures fail with "upload spool full" beyond these limits.
+SPOOL_DIR = "upload_spool"
+SPOOL_MAX_FILES = 2000
+SPOOL_MAX_BYTES = 2 * 1024**3
+UPLOAD_BANDWIDTH = None  # bytes per second across all uploads, None for no limit
+# Uploads above the threshold are split into parts sent in parallel
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024
+)
+
+command_queue: "Queue[dict]" = Queue(maxsize=CAPTURE_QUEUE_SIZE)
 
 
 def on_message(client, userdata, msg):
@@ -45,35 +65,80 @@ def on_message(client, userdata, msg):
         command = data["command"]
 
         if command == "capture_image":
-            file_path = "image.jpeg"
-
-            picam2.autofocus_cycle()
-            picam2.capture_file(file_path)
-
-            object_name = (
-                datetime.now(timezone.utc).strftime("%Y-%m-%d-%H:%M:%S") + ".jpeg"
-            )
-
-            s3.upload_file(file_path, BUCKET_NAME, object_name)
-
-            file_uri = (
-                f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{object_name}"
-            )
-
-            data = {
-                "image_uri": file_uri,
-                # "bucket": BUCKET_NAME,
-                # "object_name": object_name,
-                # "region": AWS_REGION,
-            }
-            payload = json.dumps(data)
-            client.publish(CAMERA_WRITE_TOPIC, payload)
-            logger.info(f"Published image URI: {file_uri}")
+            frames = int(data.get("frames", 1))
+            interval = float(data.get("interval", 0))
+            if not 1 <= frames <= MAX_BURST_FRAMES or interval < 0:
+                raise ValueError(
+                    f"frames should be 1-{MAX_BURST_FRAMES} and interval >= 0"
+                )
+            # Capturing and uploading happen on worker threads, so the network
+            # loop is free for the next message right away
+            command_queue.put_nowait({**data, "frames": frames, "interval": interval})
+    except Full:
+        client.publish(CAMERA_WRITE_TOPIC, json.dumps({"error": "capture queue full"}))
+        logger.error("Error: capture queue full")
     except Exception as e:
         client.publish(CAMERA_WRITE_TOPIC, json.dumps({"error": str(e)}))
         logger.error(f"Error: {e}")
 
 
+def capture_worker():
+    """Take the queued captures one at a time and spool each frame for upload."""
+    while True:
+        data = command_queue.get()
+        try:
+            frames = data["frames"]
+            # Frames of a burst reuse the focus of the first one
+            if data.get("autofocus", True):
+                picam2.autofocus_cycle()
+
+            start = monotonic()
+            for frame in range(frames):
+                image = io.BytesIO()
+                picam2.capture_file(image, format="jpeg")
+                captured_at = datetime.now(timezone.utc)
+                object_name = captured_at.strftime("%Y-%m-%d-%H:%M:%S.%f")[:-3]
+                if frames > 1:
+                    object_name += f"-{frame}"
+                meta = {"frame": frame} if frames > 1 else {}
+                meta.update(
+                    (key, data[key]) for key in ("frames", "request_id") if key in data
+                )
+                spool.put(image.getvalue(), object_name + ".jpeg", meta)
+
+                delay = start + (frame + 1) * data["interval"] - monotonic()
+                if frame < frames - 1 and delay > 0:
+                    sleep(delay)
+        except SpoolFull as e:
+            client.publish(
+                CAMERA_WRITE_TOPIC, json.dumps({"error": f"upload spool full: {e}"})
+            )
+            logger.error(f"Error: upload spool full: {e}")
+        except Exception as e:
+            client.publish(CAMERA_WRITE_TOPIC, json.dumps({"error": str(e)}))
+            logger.error(f"Error: {e}")
+        finally:
+            command_queue.task_done()
+
+
+def publish_image_uri(object_name, meta):
+    """Called by the spool once an image is in the bucket."""
+    file_uri = f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{object_name}"
+
+    data = {
+        "image_uri": file_uri,
+        # "bucket": BUCKET_NAME,
+        # "object_name": object_name,
+        # "region": AWS_REGION,
+    }
+    if meta.get("frames", 1) > 1:
+        data.update(frame=meta["frame"], frames=meta["frames"])
+    if "request_id" in meta:
+        data["request_id"] = meta["request_id"]
+    client.publish(CAMERA_WRITE_TOPIC, json.dumps(data))
+    logger.info(f"Published image URI: {file_uri}")
+
+
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc != 0:
@@ -114,6 +179,17 @@ try:
     )
     logger.info("AWS S3 configured successfully.")
 
+    spool = UploadSpool(
+        SPOOL_DIR,
+        S3Backend(s3, BUCKET_NAME, TRANSFER_CONFIG),
+        workers=UPLOAD_WORKERS,
+        max_files=SPOOL_MAX_FILES,
+        max_bytes=SPOOL_MAX_BYTES,
+        bandwidth=UPLOAD_BANDWIDTH,
+        on_uploaded=publish_image_uri,
+    )
+    threading.Thread(target=capture_worker, daemon=True).start()
+
     logger.info("MQTT client connected successfully.")
     # Start the MQTT network loop in a separate thread
     client.loop_start()
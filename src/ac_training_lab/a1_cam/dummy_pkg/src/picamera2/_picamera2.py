@@ -24,8 +24,12 @@ class Picamera2:
     def autofocus_cycle(self):
         logging.info("Mock: Performing autofocus cycle")
 
-    def capture_file(self, file_path):
-        logging.info(f"Mock: Capturing image to file: {file_path}")
-        with open(file_path, "wb") as f:
-            dummy_image = Image.new("RGB", (640, 480), color="red")
-            dummy_image.save(f, "JPEG")
+    def capture_file(self, file_output, format=None):
+        logging.info(f"Mock: Capturing image to file: {file_output}")
+        dummy_image = Image.new("RGB", (640, 480), color="red")
+        if isinstance(file_output, str):
+            with open(file_output, "wb") as f:
+                dummy_image.save(f, "JPEG")
+        else:
+            # File-like object, e.g. io.BytesIO, as with the real Picamera2
+            dummy_image.save(file_output, format or "JPEG")
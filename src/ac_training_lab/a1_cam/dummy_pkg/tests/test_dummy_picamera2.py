@@ -1,3 +1,4 @@
+import io
 import os
 
 from picamera2 import Picamera2
@@ -35,7 +36,19 @@ def test_capture_file():
     os.remove(file_path)
 
 
+def test_capture_file_to_memory():
+    picam2 = Picamera2()
+    data = io.BytesIO()
+
+    picam2.capture_file(data, format="jpeg")
+
+    data.seek(0)
+    img = Image.open(data)
+    assert img.size == (640, 480), "Expected a 640x480 image."
+
+
 if __name__ == "__main__":
     test_camera_setup()
     test_capture_file()
+    test_capture_file_to_memory()
     print("All tests passed.")
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from queue import Queue
+
+"""
+Disk-backed upload spool for the camera devices.
+
+Images are written to an append-only directory and recorded in an index file
+before anything touches the network. Worker threads drain the spool to S3 (or
+to any object with the same ``upload`` method, e.g. ``DirectoryBackend`` for
+testing without AWS), retrying with backoff, so a WiFi drop delays uploads
+instead of losing captures. Pending files are picked up again after a restart.
+
+    spool = UploadSpool("spool", S3Backend(s3, BUCKET_NAME), on_uploaded=publish)
+    spool.put(jpeg_bytes, "2025-01-01-00:00:00.000.jpeg")
+"""
+
+logger = logging.getLogger("a1-cam")
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SpoolFull(Exception):
+    """Raised by ``UploadSpool.put`` when the spool is at its size limit."""
+
+
+class S3Backend:
+    def __init__(self, s3, bucket, config=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.config = config
+
+    def upload(self, path, object_name, callback=None):
+        # upload_file switches to concurrent multipart uploads for large files
+        self.s3.upload_file(
+            path, self.bucket, object_name, Config=self.config, Callback=callback
+        )
+
+
+class DirectoryBackend:
+    """Stand-in for S3 that copies objects into a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def upload(self, path, object_name, callback=None):
+        target = os.path.join(self.root, object_name)
+        with open(path, "rb") as src, open(target + ".part", "wb") as dst:
+            while chunk := src.read(CHUNK_SIZE):
+                dst.write(chunk)
+                if callback is not None:
+                    callback(len(chunk))
+        os.replace(target + ".part", target)
+
+
+class TokenBucket:
+    """Blocks ``consume`` callers to keep the combined rate under ``rate`` B/s."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class UploadSpool:
+    """Persist uploads on disk and drain them in the background.
+
+    ``max_files`` and ``max_bytes`` bound the pending uploads (``put`` raises
+    ``SpoolFull`` beyond them) and ``bandwidth`` caps the upload rate in
+    bytes per second across all workers (``None`` for no limit). Objects are
+    deduplicated by the SHA-256 of their content, remembering the hashes of
+    the last ``max_uploaded`` uploads. ``on_uploaded`` is called with
+    ``(object_name, meta)`` after each successful upload.
+    """
+
+    def __init__(
+        self,
+        directory,
+        backend,
+        workers=2,
+        max_files=500,
+        max_bytes=500 * 1024 * 1024,
+        bandwidth=None,
+        retry_delay=1.0,
+        max_retry_delay=60.0,
+        max_uploaded=10000,
+        on_uploaded=None,
+    ):
+        self.directory = directory
+        self.backend = backend
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_uploaded = max_uploaded
+        self.on_uploaded = on_uploaded
+
+        self.index_path = os.path.join(directory, "index.jsonl")
+        self.pending = {}  # content hash -> entry of the index
+        # content hash -> object name of recent uploads, least recently used first
+        self.uploaded = OrderedDict()
+        self.duplicates = defaultdict(list)  # content hash -> meta of later puts
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+        self.queue = Queue()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        for _ in range(workers):
+            threading.Thread(target=self._drain, daemon=True).start()
+
+    def _load(self):
+        """Replay the index so uploads interrupted by a restart are resumed."""
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn last line from a power cut
+                    if entry["op"] == "add":
+                        self.pending[entry["hash"]] = entry
+                    else:
+                        self.pending.pop(entry["hash"], None)
+                        self._remember(entry["hash"], entry["object_name"])
+
+        for content_hash, entry in list(self.pending.items()):
+            if not os.path.exists(self._path(content_hash)):
+                del self.pending[content_hash]
+                continue
+            self.pending_bytes += entry["size"]
+            self.queue.put(content_hash)
+        if self.pending:
+            logger.info(f"Resuming {len(self.pending)} spooled uploads")
+        self.index = None
+        self._compact()
+
+    def _compact(self):
+        """Rewrite the index with only the live entries so it doesn't grow forever.
+
+        Hashes of uploads beyond the last ``max_uploaded`` are dropped, so
+        that content is uploaded again if it is ever put again.
+        """
+        if self.index is not None:
+            self.index.close()
+        with open(self.index_path + ".tmp", "w") as f:
+            for content_hash, object_name in self.uploaded.items():
+                done = {"op": "done", "hash": content_hash, "object_name": object_name}
+                f.write(json.dumps(done) + "\n")
+            for entry in self.pending.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self.index = open(self.index_path, "a")
+        self.index_lines = len(self.uploaded) + len(self.pending)
+
+    def _remember(self, content_hash, object_name):
+        self.uploaded[content_hash] = object_name
+        self.uploaded.move_to_end(content_hash)
+        while len(self.uploaded) > self.max_uploaded:
+            self.uploaded.popitem(last=False)
+
+    def _path(self, content_hash):
+        return os.path.join(self.directory, content_hash)
+
+    def _append(self, entry):
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.index_lines += 1
+
+    def _maybe_compact(self):
+        # Called after the in-memory state is updated, so nothing is lost
+        if self.index_lines > 2 * (self.max_uploaded + self.max_files):
+            self._compact()
+
+    def put(self, data, object_name, meta=None):
+        """Spool ``data`` for upload as ``object_name`` and return its hash.
+
+        Content that is already pending or uploaded is not stored again; its
+        ``meta`` is reported with the object name of the first copy.
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        meta = meta or {}
+        with self.lock:
+            if content_hash in self.pending:
+                self.duplicates[content_hash].append(meta)
+                return content_hash
+            uploaded_as = self.uploaded.get(content_hash)
+            if uploaded_as is None:
+                self._store(content_hash, data, object_name, meta)
+            else:
+                self.uploaded.move_to_end(content_hash)
+
+        if uploaded_as is not None:
+            self._notify(uploaded_as, meta)
+        else:
+            self.queue.put(content_hash)
+        return content_hash
+
+    def _store(self, content_hash, data, object_name, meta):
+        if (
+            len(self.pending) >= self.max_files
+            or self.pending_bytes + len(data) > self.max_bytes
+        ):
+            raise SpoolFull(
+                f"{len(self.pending)} uploads ({self.pending_bytes} bytes) pending"
+            )
+
+        path = self._path(content_hash)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        entry = {
+            "op": "add",
+            "hash": content_hash,
+            "object_name": object_name,
+            "size": len(data),
+            "meta": meta,
+        }
+        self._append(entry)
+        self.pending[content_hash] = entry
+        self.pending_bytes += len(data)
+        self._maybe_compact()
+
+    def _drain(self):
+        delay = self.retry_delay
+        while True:
+            content_hash = self.queue.get()
+            with self.lock:
+                entry = self.pending[content_hash]
+            object_name = entry["object_name"]
+            callback = self.bucket.consume if self.bucket else None
+            try:
+                self.backend.upload(self._path(content_hash), object_name, callback)
+            except Exception as e:
+                logger.warning(f"Upload of {object_name} failed: {e}")
+                self.queue.put(content_hash)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+
+            with self.lock:
+                self._append(
+                    {"op": "done", "hash": content_hash, "object_name": object_name}
+                )
+                del self.pending[content_hash]
+                self._remember(content_hash, object_name)
+                self.pending_bytes -= entry["size"]
+                duplicates = self.duplicates.pop(content_hash, [])
+                self._maybe_compact()
+            os.remove(self._path(content_hash))
+
+            for meta in [entry["meta"], *duplicates]:
+                self._notify(object_name, meta)
+
+    def _notify(self, object_name, meta):
+        if self.on_uploaded is None:
+            return
+        try:
+            self.on_uploaded(object_name, meta)
+        except Exception as e:
+            logger.error(f"on_uploaded failed for {object_name}: {e}")
+
+    def join(self, timeout=None):
+        """Wait until nothing is pending. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import cv2
+
+"""
+Long-lived camera capture for device.py.
+
+Opening cv2.VideoCapture for every query/camera request costs the camera
+warm-up each time. CameraStream keeps the device open on a background thread
+and always holds the most recent frame, so a request only has to encode it.
+"""
+
+
+class CameraStream:
+    """Keep the newest frame of a V4L2 camera in memory."""
+
+    def __init__(self, index=0, reopen_delay=1.0, logger=None):
+        self.index = index
+        self.reopen_delay = reopen_delay
+        self.logger = logger
+        self.frame = None
+        self.frame_time = None  # time.time() when self.frame was read
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        capture = None
+        while self.running:
+            if capture is None:
+                capture = cv2.VideoCapture(self.index)
+                # Only the newest frame matters, don't let the driver queue more
+                capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+            ok, frame = capture.read()
+            if not ok:
+                if self.logger is not None:
+                    self.logger.warning("camera read failed, reopening device")
+                capture.release()
+                capture = None
+                time.sleep(self.reopen_delay)
+                continue
+
+            with self.condition:
+                self.frame = frame
+                self.frame_time = time.time()
+                self.condition.notify_all()
+
+        if capture is not None:
+            capture.release()
+
+    def latest(self, timeout=5.0):
+        """Return ``(frame, frame_time)``, waiting for the first frame if needed."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frame is not None, timeout):
+                raise TimeoutError(f"no camera frame after {timeout} s")
+            return self.frame, self.frame_time
+
+
+def encode_jpeg(frame, quality):
+    """Encode a BGR frame straight to JPEG bytes, without going through PIL."""
+    ok, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise ValueError("could not encode frame as JPEG")
+    return buffer.tobytes()
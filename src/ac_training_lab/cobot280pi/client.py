@@ -1,13 +1,18 @@
+import asyncio
 import base64
 import io
 import json
-from queue import Queue
+import uuid
+from concurrent.futures import Future
 
 import paho.mqtt.client as paho
+from paho.mqtt.packettypes import PacketTypes
 from PIL import Image
 
+from ac_training_lab.mqtt_requests import PendingRequests
 
-class CobotController:
+
+class CobotController(PendingRequests):
 
     def __init__(
         self,
@@ -16,21 +21,41 @@ class CobotController:
         hive_mq_cloud: str,
         port: int,
         device_endpoint: str,
+        timeout: float = 60,
     ):
         self.publish_endpoint = device_endpoint
         self.response_endpoint = device_endpoint + "/response"
+        self.timeout = self.batch_timeout = timeout
         self.client = paho.Client(client_id="", userdata=None, protocol=paho.MQTTv5)
         self.client.tls_set()
         self.client.username_pw_set(hive_mq_username, hive_mq_password)
         self.client.connect(hive_mq_cloud, port)
 
-        response_queue = Queue()
+        self._init_pending()
+        # request id -> received chunks of a binary (query/camera) response
+        self.chunks = {}
 
         def on_message(client, userdata, msg):
-            payload_dict = json.loads(msg.payload)
-            response_queue.put(payload_dict)
-
-        self.response_queue = response_queue
+            correlation = getattr(msg.properties, "CorrelationData", None)
+            if getattr(msg.properties, "ContentType", None) == "image/jpeg":
+                payload_dict = self._add_chunk(correlation, msg)
+                if payload_dict is None:
+                    return
+            else:
+                payload_dict = json.loads(msg.payload)
+            request_id = (
+                correlation.decode() if correlation else payload_dict.get("request_id")
+            )
+            with self.pending_lock:
+                if request_id in self.pending:
+                    future = self.pending.pop(request_id)
+                elif request_id is None and self.pending:
+                    # Servers that don't echo ids answer in order
+                    future = self.pending.pop(next(iter(self.pending)))
+                else:
+                    return
+            if not future.cancelled():
+                future.set_result(payload_dict)
 
         def on_connect(client, userdata, flags, rc, properties=None):
             print("Connection recieved")
@@ -40,61 +65,133 @@ class CobotController:
         self.client.subscribe(self.response_endpoint, qos=2)
         self.client.loop_start()
 
-    def handle_publish_and_response(self, payload):
-        self.client.publish(self.publish_endpoint, payload=payload, qos=2)
-        return self.response_queue.get(block=True)
+    def submit(self, command: str, args: dict) -> Future:
+        """Publish a command and return a Future for its response.
 
-    def send_angles(self, angle_list: list[float] = [0.0] * 6, speed: int = 50):
+        Any number of requests may be outstanding; responses are matched by
+        the MQTT v5 correlation data (or ``request_id`` in the payload).
+        """
+        request_id = uuid.uuid4().hex
+        future = self._add_pending(request_id)
+
+        properties = paho.Properties(PacketTypes.PUBLISH)
+        properties.CorrelationData = request_id.encode()
+        properties.ResponseTopic = self.response_endpoint
         payload = json.dumps(
-            {
-                "command": "control/angles",
-                "args": {"angles": angle_list, "speed": speed},
-            }
+            {"command": command, "args": args, "request_id": request_id}
+        )
+        self.client.publish(
+            self.publish_endpoint, payload=payload, qos=2, properties=properties
+        )
+        return future
+
+    def request(self, command: str, args: dict, timeout: float = None):
+        """Publish a command and wait up to ``timeout`` seconds for the response."""
+        future = self.submit(command, args)
+        return self._wait(future, future, timeout or self.timeout)
+
+    async def request_async(self, command: str, args: dict, timeout: float = None):
+        """Asyncio version of ``request``."""
+        future = self.submit(command, args)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout or self.timeout
+            )
+        except asyncio.TimeoutError:
+            self._discard(future)
+            raise
+
+    def handle_publish_and_response(self, payload, timeout: float = None):
+        payload_dict = json.loads(payload)
+        return self._call(payload_dict["command"], payload_dict["args"], timeout)
+
+    def _add_chunk(self, correlation, msg):
+        """Collect one chunk of a binary response, returning it once complete."""
+        properties = dict(msg.properties.UserProperty)
+        metadata = json.loads(properties["metadata"])
+        key = metadata.get("request_id", correlation)
+
+        with self.pending_lock:
+            chunks = self.chunks.setdefault(key, {})
+            chunks[int(properties["chunk"])] = msg.payload
+            if len(chunks) < metadata["chunks"]:
+                return None
+            del self.chunks[key]
+
+        metadata["image"] = b"".join(chunks[i] for i in range(len(chunks)))
+        return metadata
+
+    def _call(self, command, args, timeout=None, transform=None):
+        request = self.submit(command, args)
+        future = request if transform is None else self._then(request, transform)
+        if self._batched(request, future):
+            return future
+        return self._wait(request, future, timeout or self.timeout)
+
+    def _discard(self, request):
+        request_ids = super()._discard(request)
+        with self.pending_lock:
+            for request_id in request_ids:
+                self.chunks.pop(request_id, None)
+        return request_ids
+
+    def send_angles(
+        self, angle_list: list[float] = [0.0] * 6, speed: int = 50, timeout=None
+    ):
+        return self._call(
+            "control/angles", {"angles": angle_list, "speed": speed}, timeout
         )
-        return self.handle_publish_and_response(payload)
 
-    def send_coords(self, coord_list: list[float] = [0.0] * 6, speed: int = 50):
-        payload = json.dumps(
-            {
-                "command": "control/coords",
-                "args": {"coords": coord_list, "speed": speed},
-            }
+    def send_coords(
+        self, coord_list: list[float] = [0.0] * 6, speed: int = 50, timeout=None
+    ):
+        return self._call(
+            "control/coords", {"coords": coord_list, "speed": speed}, timeout
         )
-        return self.handle_publish_and_response(payload)
 
-    def send_gripper_value(self, value: int = 100, speed: int = 50):
-        payload = json.dumps(
-            {
-                "command": "control/gripper",
-                "args": {"gripper_value": value, "speed": speed},
-            }
+    def send_gripper_value(self, value: int = 100, speed: int = 50, timeout=None):
+        return self._call(
+            "control/gripper", {"gripper_value": value, "speed": speed}, timeout
         )
-        return self.handle_publish_and_response(payload)
 
-    def get_angles(self):
-        payload = json.dumps({"command": "query/angles", "args": {}})
-        return self.handle_publish_and_response(payload)
+    def run_program(self, steps: list[dict], timeout=None):
+        """Run a whole motion program on the device in one request.
 
-    def get_coords(self):
-        payload = json.dumps({"command": "query/coords", "args": {}})
-        return self.handle_publish_and_response(payload)
+        ``steps`` are dicts such as ``{"type": "coords", "coords": [...]}``,
+        ``{"type": "angles", "angles": [...]}`` or
+        ``{"type": "gripper", "value": 100}``, each with an optional
+        ``speed``. Per-step progress is published on ``<endpoint>/progress``.
+        """
+        return self._call("control/program", {"steps": steps}, timeout)
 
-    def get_gripper_value(self):
-        payload = json.dumps({"command": "query/gripper", "args": {}})
-        return self.handle_publish_and_response(payload)
+    def abort(self, timeout=None):
+        """Stop the cobot and any running motion program."""
+        return self._call("control/abort", {}, timeout)
 
-    def get_camera(self, quality=100, save_path=None):
-        payload = json.dumps({"command": "query/camera", "args": {"quality": quality}})
-        response = self.handle_publish_and_response(payload)
-        if not response["success"]:
-            return response
+    def get_angles(self, timeout=None):
+        return self._call("query/angles", {}, timeout)
+
+    def get_coords(self, timeout=None):
+        return self._call("query/coords", {}, timeout)
+
+    def get_gripper_value(self, timeout=None):
+        return self._call("query/gripper", {}, timeout)
 
-        b64_bytes = base64.b64decode(response["image"])
-        img_bytes = io.BytesIO(b64_bytes)
-        img = Image.open(img_bytes)
+    def get_camera(self, quality=100, save_path=None, timeout=None):
+        def decode(response):
+            if not response["success"]:
+                return response
 
-        response["image"] = img
-        if save_path is not None:
-            img.save(save_path)
+            img_bytes = response["image"]
+            if isinstance(img_bytes, str):
+                # JSON responses from devices without binary replies
+                img_bytes = base64.b64decode(img_bytes)
+            img = Image.open(io.BytesIO(img_bytes))
+
+            response["image"] = img
+            if save_path is not None:
+                img.save(save_path)
+
+            return response
 
-        return response
+        return self._call("query/camera", {"quality": quality}, timeout, decode)
@@ -1,13 +1,17 @@
 import argparse
 import base64
-import io
 import json
 import sys
+import threading
 import time
-from queue import Queue
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
 
 import cv2
+import numpy as np
 import paho.mqtt.client as paho
+from camera_stream import CameraStream, encode_jpeg
 from my_secrets import (
     DEVICE_ENDPOINT,
     DEVICE_PORT,
@@ -15,15 +19,72 @@ from my_secrets import (
     HIVEMQ_PASSWORD,
     HIVEMQ_USERNAME,
 )
-from PIL import Image
+from paho.mqtt.packettypes import PacketTypes
 from pymycobot.mycobot280 import MyCobot280
-from utils import setup_logger
+from utils import publish_jpeg, setup_logger
 
 # cli args
 parser = argparse.ArgumentParser()
 parser.add_argument("--debug", "-d", action="store_true", help="runs in debug mode")
 cliargs = parser.parse_args()
 
+# Commands that share the serial bus for motion run one at a time, in order.
+# Queries run on a small pool and camera captures on their own lane, so both
+# can proceed while the arm is moving.
+MOTION_COMMANDS = {
+    "control/angles",
+    "control/coords",
+    "control/gripper",
+    "control/release_servos",
+    "control/program",
+}
+QUERY_WORKERS = 4
+
+# Pause after a motion command before the next one. It doubles after a failed
+# command (up to MAX_SETTLE_TIME) and decays back after successful ones.
+SETTLE_TIME = {
+    "control/angles": 0.2,
+    "control/coords": 0.2,
+    "control/gripper": 0.0,
+    "control/release_servos": 0.5,
+    "control/program": 0.2,
+}
+MAX_SETTLE_TIME = 3.0
+METRICS_INTERVAL = 10  # seconds between publishes on DEVICE_ENDPOINT/metrics
+
+# query/camera replies with the raw JPEG as the payload and the rest of the
+# response in MQTT v5 user properties, split into chunks above this size.
+CAMERA_CHUNK_SIZE = 256 * 1024
+
+
+class ProgramAborts:
+    """
+    Numbers control/program commands in the order they are received, so that
+    control/abort stops every program received before it, whether it is
+    already running or still queued behind other motion commands, but none
+    received after it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.aborted = 0  # programs up to this number are aborted
+
+    def receive(self):
+        with self.lock:
+            self.received += 1
+            return self.received
+
+    def abort(self):
+        with self.lock:
+            self.aborted = self.received
+
+    def is_aborted(self, program):
+        return program <= self.aborted
+
+
+program_aborts = ProgramAborts()
+
 
 # Cobot action functions
 def reset_cobot_connection(cobot):
@@ -38,6 +99,24 @@ def reset_cobot_connection(cobot):
         return False
 
 
+def wait_for_gripper(cobot):
+    # Wait for gripper movement to complete using is_gripper_moving
+    max_wait_time = 10  # seconds
+    wait_interval = 0.1  # seconds
+    total_wait = 0
+
+    while total_wait < max_wait_time:
+        if not cobot.is_gripper_moving():
+            break
+        time.sleep(wait_interval)
+        total_wait += wait_interval
+
+    # Add delay after gripper operation to allow device to stabilize
+    time.sleep(0.5)
+    # Reset connection to clear any potential buffer issues
+    reset_cobot_connection(cobot)
+
+
 def handle_control_gripper(args, cobot):
     logger.info(f"running command control/gripper with {args}")
     try:
@@ -45,22 +124,7 @@ def handle_control_gripper(args, cobot):
         value = args.get("value", args.get("gripper_value", 50))
         speed = args.get("speed", 50)
         cobot.set_gripper_value(value, speed)
-
-        # Wait for gripper movement to complete using is_gripper_moving
-        max_wait_time = 10  # seconds
-        wait_interval = 0.1  # seconds
-        total_wait = 0
-
-        while total_wait < max_wait_time:
-            if not cobot.is_gripper_moving():
-                break
-            time.sleep(wait_interval)
-            total_wait += wait_interval
-
-        # Add delay after gripper operation to allow device to stabilize
-        time.sleep(0.5)
-        # Reset connection to clear any potential buffer issues
-        reset_cobot_connection(cobot)
+        wait_for_gripper(cobot)
         return {"success": True}
     except Exception as e:
         logger.critical(f"control gripper error: {str(e)}")
@@ -106,6 +170,102 @@ def handle_control_release_servos(args, cobot):
         return {"success": False, "error_msg": str(e)}
 
 
+def in_range(value, low, high):
+    return isinstance(value, (int, float)) and low <= value <= high
+
+
+def validate_program(steps):
+    """Return a list of problems with a program, empty if it can run."""
+    if not isinstance(steps, list) or not steps:
+        return ["'steps' should be a non-empty list"]
+
+    errors = []
+    for i, step in enumerate(steps):
+        kind = step.get("type") if isinstance(step, dict) else None
+        if kind in ("coords", "angles"):
+            values = step.get(kind)
+            if not isinstance(values, list) or len(values) != 6:
+                errors.append(f"step {i}: '{kind}' should be a list of 6 numbers")
+            elif not all(isinstance(v, (int, float)) for v in values):
+                errors.append(f"step {i}: '{kind}' should only contain numbers")
+        elif kind == "gripper":
+            if not in_range(step.get("value"), 0, 100):
+                errors.append(f"step {i}: gripper 'value' should be 0-100")
+        else:
+            errors.append(f"step {i}: unknown step type {kind!r}")
+            continue
+
+        if not in_range(step.get("speed", 50), 1, 100):
+            errors.append(f"step {i}: 'speed' should be 1-100")
+    return errors
+
+
+def handle_control_program(args, cobot, request_id=None, program=None):
+    """Run a whole sequence of moves and gripper steps on the device.
+
+    Each step waits for completion locally (sync_send_* or is_gripper_moving),
+    so there is no broker round-trip between steps. A progress event is
+    published on DEVICE_ENDPOINT/progress after every step, and the program
+    stops early when control/abort is received. ``program`` is the number
+    program_aborts gave it on receipt.
+    """
+    logger.info(f"running command control/program with {args}")
+    steps = args.get("steps")
+    errors = validate_program(steps)
+    if errors:
+        return {"success": False, "error_msg": "; ".join(errors)}
+
+    if program is None:
+        program = program_aborts.receive()
+    started = time.perf_counter()
+    for i, step in enumerate(steps):
+        if program_aborts.is_aborted(program):
+            return {"success": False, "error_msg": "aborted", "completed_steps": i}
+
+        step_started = time.perf_counter()
+        speed = step.get("speed", 50)
+        timeout = step.get("timeout", 15)
+        try:
+            if step["type"] == "coords":
+                cobot.sync_send_coords(
+                    step["coords"], speed, step.get("mode", 0), timeout=timeout
+                )
+            elif step["type"] == "angles":
+                cobot.sync_send_angles(step["angles"], speed, timeout=timeout)
+            else:
+                cobot.set_gripper_value(step["value"], speed)
+                wait_for_gripper(cobot)
+        except Exception as e:
+            logger.critical(f"control program error at step {i}: {str(e)}")
+            return {"success": False, "error_msg": str(e), "completed_steps": i}
+
+        client.publish(
+            DEVICE_ENDPOINT + "/progress",
+            payload=json.dumps(
+                {
+                    "request_id": request_id,
+                    "step": i,
+                    "total_steps": len(steps),
+                    "type": step["type"],
+                    "step_s": round(time.perf_counter() - step_started, 3),
+                }
+            ),
+        )
+
+    elapsed = round(time.perf_counter() - started, 3)
+    return {"success": True, "completed_steps": len(steps), "elapsed_s": elapsed}
+
+
+def handle_control_abort(args, cobot):
+    logger.info(f"running command control/abort with {args}")
+    try:
+        cobot.stop()
+        return {"success": True}
+    except Exception as e:
+        logger.critical(f"control abort error: {str(e)}")
+        return {"success": False, "error_msg": str(e)}
+
+
 def handle_query_angles(args, cobot):
     logger.info(f"running command query/angle with {args}")
     try:
@@ -190,17 +350,26 @@ def handle_query_camera(args):
     logger.info(f"running command query/camera with {args}")
     try:
         if not cliargs.debug:
-            webcam = cv2.VideoCapture(0)
-            _, frame = webcam.read()
-            webcam.release()
-            img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            frame, frame_time = camera.latest()
         else:
             img = cobot.get_camera(**args)
-        compressed_bytes = io.BytesIO()
-        img.save(compressed_bytes, format="JPEG", quality=args["quality"])
-        compressed_bytes.seek(0)
-        byte_str = base64.b64encode(compressed_bytes.read()).decode("utf-8")
-        return {"success": True, "image": byte_str}
+            frame = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+            frame_time = time.time()
+        jpeg = encode_jpeg(frame, args.get("quality", 100))
+
+        if args.get("format") == "base64":
+            # Older clients expect the image inside the JSON response
+            byte_str = base64.b64encode(jpeg).decode("utf-8")
+            return {"success": True, "image": byte_str}
+
+        height, width = frame.shape[:2]
+        return {
+            "success": True,
+            "jpeg": jpeg,
+            "width": width,
+            "height": height,
+            "frame_age_s": round(time.time() - frame_time, 3),
+        }
     except Exception as e:
         logger.critical(f"query camera error: {str(e)}")
         return {"success": False, "error_msg": str(e)}
@@ -214,16 +383,16 @@ def on_connect(client, userdata, flags, rc, properties=None):
 
 
 def on_publish(client, userdata, mid, properties=None):
-    logger.info("Successful publish.")
-
+    with stats_lock:
+        published_at = publish_times.pop(mid, None)
+    if published_at is None:
+        logger.info("Successful publish.")
+    else:
+        ack_s = time.perf_counter() - published_at
+        logger.info(f"Publish {mid} acknowledged after {ack_s:.3f}s")
 
-def handle_message(msg, cobot):
-    # Parse payload to json dict
-    try:
-        payload_dict = json.loads(msg.payload)
-    except Exception as e:
-        return {"success": False, "error": str(e)}
 
+def handle_message(payload_dict, cobot):
     if "command" not in payload_dict:
         return {"success": False, "error": "'command' key should be in payload"}
 
@@ -235,6 +404,15 @@ def handle_message(msg, cobot):
         return handle_control_coords(payload_dict["args"], cobot)
     elif cmd == "control/gripper":
         return handle_control_gripper(payload_dict["args"], cobot)
+    elif cmd == "control/program":
+        return handle_control_program(
+            payload_dict["args"],
+            cobot,
+            payload_dict.get("request_id"),
+            payload_dict.get("program"),
+        )
+    elif cmd == "control/abort":
+        return handle_control_abort(payload_dict["args"], cobot)
     elif cmd == "control/release_servos":
         return handle_control_release_servos(payload_dict["args"], cobot)
     elif cmd == "query/angles":
@@ -249,8 +427,84 @@ def handle_message(msg, cobot):
         return {"success": False, "error": "invalid command"}
 
 
+def adapt_settle_time(cmd, success):
+    base = SETTLE_TIME[cmd]
+    if success:
+        settle_times[cmd] = max(base, settle_times[cmd] / 2)
+    else:
+        settle_times[cmd] = min(MAX_SETTLE_TIME, max(settle_times[cmd] * 2, 0.5))
+    return settle_times[cmd]
+
+
+def run_command(client, msg, payload_dict, received_at):
+    cmd = payload_dict.get("command")
+    try:
+        response_dict = handle_message(payload_dict, cobot)
+    except Exception as e:
+        # e.g. a missing "args", the caller still gets a reply
+        logger.error(f"{cmd} failed: {e!r}")
+        response_dict = {"success": False, "error": f"{type(e).__name__}: {e}"}
+    if "request_id" in payload_dict:
+        response_dict["request_id"] = payload_dict["request_id"]
+
+    # Echo the MQTT v5 correlation data so clients can match out-of-order replies
+    properties = paho.Properties(PacketTypes.PUBLISH)
+    topic = DEVICE_ENDPOINT + "/response"
+    if msg.properties is not None:
+        topic = getattr(msg.properties, "ResponseTopic", topic)
+        if hasattr(msg.properties, "CorrelationData"):
+            properties.CorrelationData = msg.properties.CorrelationData
+
+    jpeg = response_dict.pop("jpeg", None)
+    with stats_lock:
+        if jpeg is None:
+            pub_handle = client.publish(
+                topic, qos=2, payload=json.dumps(response_dict), properties=properties
+            )
+        else:
+            pub_handle = publish_jpeg(
+                client, topic, jpeg, response_dict, properties, CAMERA_CHUNK_SIZE
+            )
+        publish_times[pub_handle.mid] = time.perf_counter()
+
+        latency = time.perf_counter() - received_at
+        cmd_stats = stats[cmd]
+        cmd_stats["count"] += 1
+        cmd_stats["errors"] += not response_dict.get("success", False)
+        cmd_stats["total_s"] += latency
+        cmd_stats["max_s"] = max(cmd_stats["max_s"], latency)
+
+    if cmd in SETTLE_TIME:
+        time.sleep(adapt_settle_time(cmd, response_dict.get("success", False)))
+
+
+def publish_metrics(client):
+    uptime = time.perf_counter() - started_at
+    with stats_lock:
+        metrics = {
+            cmd: {
+                "count": cmd_stats["count"],
+                "errors": cmd_stats["errors"],
+                "throughput_per_s": round(cmd_stats["count"] / uptime, 4),
+                "mean_latency_s": round(cmd_stats["total_s"] / cmd_stats["count"], 4),
+                "max_latency_s": round(cmd_stats["max_s"], 4),
+            }
+            for cmd, cmd_stats in stats.items()
+        }
+    client.publish(DEVICE_ENDPOINT + "/metrics", payload=json.dumps(metrics))
+
+
 if __name__ == "__main__":
     task_queue = Queue()
+    motion_lane = ThreadPoolExecutor(max_workers=1)
+    camera_lane = ThreadPoolExecutor(max_workers=1)
+    query_lane = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+    settle_times = dict(SETTLE_TIME)
+    stats = defaultdict(lambda: dict(count=0, errors=0, total_s=0.0, max_s=0.0))
+    stats_lock = threading.Lock()
+    publish_times = {}  # mid -> time of publish, to log the broker ack latency
+    started_at = time.perf_counter()
     logger = setup_logger()
 
     if not cliargs.debug:
@@ -260,6 +514,7 @@ if __name__ == "__main__":
         except Exception as e:
             logger.critical(f"could not initialize cobot with error {str(e)}")
             sys.exit(1)
+        camera = CameraStream(0, logger=logger).start()
     else:
         from dummy_cobot import DummyCobot
 
@@ -279,7 +534,7 @@ if __name__ == "__main__":
                 Payload: {msg.payload.decode(errors='ignore')}"""
             )
 
-            task_queue.put(msg)
+            task_queue.put((msg, time.perf_counter()))
         except Exception as e:
             logger.error(f"[ERROR] Failed to handle message: {e}")
             print(f"[ERROR] in on_message: {e}")
@@ -295,11 +550,43 @@ if __name__ == "__main__":
     client.loop_start()
     logger.info("Ready for tasks...")
 
+    last_metrics = time.perf_counter()
     while True:
-        msg = task_queue.get()  # blocks if queue is empty
-        response_dict = handle_message(msg, cobot)
-        pub_handle = client.publish(
-            DEVICE_ENDPOINT + "/response", qos=2, payload=json.dumps(response_dict)
-        )
-        pub_handle.wait_for_publish()
-        time.sleep(3)
+        try:
+            msg, received_at = task_queue.get(timeout=METRICS_INTERVAL)
+        except Empty:
+            msg = None
+
+        if time.perf_counter() - last_metrics >= METRICS_INTERVAL:
+            publish_metrics(client)
+            last_metrics = time.perf_counter()
+        if msg is None:
+            continue
+
+        # Parse payload to json dict
+        try:
+            payload_dict = json.loads(msg.payload)
+            if not isinstance(payload_dict, dict):
+                raise ValueError("payload should be a JSON object")
+        except Exception as e:
+            client.publish(
+                DEVICE_ENDPOINT + "/response",
+                qos=2,
+                payload=json.dumps({"success": False, "error": str(e)}),
+            )
+            continue
+
+        cmd = payload_dict.get("command")
+        # Numbered and aborted here, in arrival order, so an abort also
+        # catches programs that haven't started yet
+        if cmd == "control/program":
+            payload_dict["program"] = program_aborts.receive()
+        elif cmd == "control/abort":
+            program_aborts.abort()
+        if cmd in MOTION_COMMANDS:
+            lane = motion_lane
+        elif cmd == "query/camera":
+            lane = camera_lane
+        else:
+            lane = query_lane
+        lane.submit(run_command, client, msg, payload_dict, received_at)
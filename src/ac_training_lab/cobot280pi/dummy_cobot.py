@@ -27,6 +27,9 @@ class DummyCobot:
         self.logger.info(f"tried to check if gripper is moving with args {kwargs}")
         return False  # Always return False for dummy (not moving)
 
+    def stop(self, **kwargs):
+        self.logger.info(f"tried to stop with args {kwargs}")
+
     def release_all_servos(self, **kwargs):
         self.logger.info(f"tried to release all servos with args {kwargs}")
 
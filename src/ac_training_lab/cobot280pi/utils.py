@@ -1,6 +1,10 @@
+import json
 import logging
 import sys
 
+import paho.mqtt.client as paho
+from paho.mqtt.packettypes import PacketTypes
+
 
 def setup_logger(logfile_name: str = "mqttcobot.log"):
     logger = logging.getLogger("logger")
@@ -18,3 +22,34 @@ def setup_logger(logfile_name: str = "mqttcobot.log"):
         logger.addHandler(file_handler)
     logger.propagate = False
     return logger
+
+
+def publish_jpeg(client, topic, jpeg, response_dict, properties, chunk_size):
+    """Publish a JPEG as raw payload chunks, with the response as user properties.
+
+    Every chunk carries the same response topic, correlation data and content
+    type as ``properties``, plus "chunk" and "chunks" so the client can put
+    the image back together. Each chunk gets its own Properties object, since
+    paho appends to UserProperty on assignment and QoS 2 publishes may still
+    be in flight. Returns the handle of the last publish.
+    """
+    chunks = max(1, -(-len(jpeg) // chunk_size))
+    metadata = json.dumps({**response_dict, "size": len(jpeg), "chunks": chunks})
+    for chunk in range(chunks):
+        chunk_properties = paho.Properties(PacketTypes.PUBLISH)
+        for name in ("ResponseTopic", "CorrelationData"):
+            if hasattr(properties, name):
+                setattr(chunk_properties, name, getattr(properties, name))
+        chunk_properties.ContentType = "image/jpeg"
+        chunk_properties.UserProperty = [
+            ("metadata", metadata),
+            ("chunk", str(chunk)),
+        ]
+        start = chunk * chunk_size
+        pub_handle = client.publish(
+            topic,
+            qos=2,
+            payload=jpeg[start : start + chunk_size],
+            properties=chunk_properties,
+        )
+    return pub_handle
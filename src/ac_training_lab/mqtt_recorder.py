@@ -0,0 +1,448 @@
+"""
+Record MQTT telemetry to disk and replay it, for offline analysis and for
+load tests against a local broker.
+
+    python -m ac_training_lab.mqtt_recorder record --tls "magnetometer/#"
+    python -m ac_training_lab.mqtt_recorder info
+    python -m ac_training_lab.mqtt_recorder replay --host localhost --speed 10
+
+Messages are written to rolling segment files (``<start time>.mql``) made of
+zlib-compressed blocks. Within a block the receive times, topic ids, flags and
+payload lengths are stored as columns, followed by the payloads. Each segment
+has a ``.idx`` file with one JSON line per block (offset, time range and
+message count per topic), so readers can skip blocks by topic and time
+without decompressing them. Only the standard library and paho-mqtt are
+needed.
+"""
+
+import argparse
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter, namedtuple
+
+import paho.mqtt.client as mqtt
+
+# Telemetry topics of the devices in this repo. Command topics are left out so
+# a replay cannot drive real hardware.
+DEFAULT_TOPICS = [
+    "magnetometer/+/+/sensor_data",
+    "fan-control/picow/+/rpm",
+    "pioreactor/+/temperature",
+    "pioreactor/+/readings/#",
+    "FX-120i/#",
+    "USS-DBS51-30/#",
+]
+# Topics that make devices act. replay skips them unless asked not to.
+COMMAND_TOPICS = [
+    "pioreactor/control",
+    "pioreactor/+/+/+/+/set",
+    "fan-control/picow/+/speed",
+    "time-sync/#",
+]
+DEFAULT_DIRECTORY = "recordings"
+
+MAGIC = b"MQL1"
+BLOCK_HEADER = "<4sII"  # magic, compressed size, message count
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER)
+SEGMENT_SUFFIX = ".mql"
+INDEX_SUFFIX = ".idx"
+
+Message = namedtuple("Message", "time topic payload qos retain")
+
+
+def _column(typecode, values=()):
+    column = array(typecode, values)
+    if sys.byteorder == "big":  # blocks are little-endian
+        column.byteswap()
+    return column
+
+
+def _from_column(typecode, data, offset, count):
+    column = array(typecode)
+    end = offset + count * column.itemsize
+    column.frombytes(data[offset:end])
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column, end
+
+
+def encode_block(messages):
+    """Compress a list of Messages into one block (header included)."""
+    topics = sorted({message.topic for message in messages})
+    topic_ids = {topic: i for i, topic in enumerate(topics)}
+    topic_json = json.dumps(topics).encode("utf-8")
+    body = b"".join(
+        [
+            struct.pack("<I", len(topic_json)),
+            topic_json,
+            _column("d", (message.time for message in messages)).tobytes(),
+            _column("H", (topic_ids[m.topic] for m in messages)).tobytes(),
+            _column("B", (m.qos | m.retain << 2 for m in messages)).tobytes(),
+            _column("I", (len(m.payload) for m in messages)).tobytes(),
+            *(message.payload for message in messages),
+        ]
+    )
+    compressed = zlib.compress(body)
+    return struct.pack(BLOCK_HEADER, MAGIC, len(compressed), len(messages)) + compressed
+
+
+def decode_block(compressed, count):
+    """The Messages of a block, from its compressed body and message count."""
+    body = zlib.decompress(compressed)
+    (topic_length,) = struct.unpack_from("<I", body)
+    offset = 4 + topic_length
+    topics = json.loads(body[4:offset].decode("utf-8"))
+    times, offset = _from_column("d", body, offset, count)
+    topic_ids, offset = _from_column("H", body, offset, count)
+    flags, offset = _from_column("B", body, offset, count)
+    lengths, offset = _from_column("I", body, offset, count)
+    messages = []
+    for i in range(count):
+        payload = body[offset : offset + lengths[i]]
+        offset += lengths[i]
+        messages.append(
+            Message(
+                times[i],
+                topics[topic_ids[i]],
+                payload,
+                flags[i] & 3,
+                bool(flags[i] & 4),
+            )
+        )
+    return messages
+
+
+class Recorder:
+    """
+    Append messages to rolling segment files in ``directory``.
+
+    Messages are buffered into blocks of up to ``block_messages`` messages or
+    ``block_seconds`` of traffic. A new segment is started after
+    ``segment_bytes`` (compressed) or ``segment_seconds``. ``on_message`` can
+    be used directly as a paho-mqtt callback.
+    """
+
+    def __init__(
+        self,
+        directory=DEFAULT_DIRECTORY,
+        block_messages=1000,
+        block_seconds=5.0,
+        segment_bytes=64 * 1024 * 1024,
+        segment_seconds=3600,
+    ):
+        self.directory = directory
+        self.block_messages = block_messages
+        self.block_seconds = block_seconds
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.messages = []  # of the block being filled
+        self.segment = None
+        self.index = None
+        self.segment_started = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, topic, payload, qos=0, retain=False, received=None):
+        received = time.time() if received is None else received
+        with self.lock:
+            if self.messages and received - self.messages[0].time >= self.block_seconds:
+                self._write_block()
+            self.messages.append(Message(received, topic, bytes(payload), qos, retain))
+            if len(self.messages) >= self.block_messages:
+                self._write_block()
+
+    def on_message(self, client, userdata, message):
+        self.record(message.topic, message.payload, message.qos, message.retain)
+
+    def flush(self, max_age=None):
+        """
+        Write the buffered messages, or only if the oldest one is older than
+        ``max_age`` seconds, so quiet topics still reach the disk.
+        """
+        with self.lock:
+            if self.messages and (
+                max_age is None or time.time() - self.messages[0].time >= max_age
+            ):
+                self._write_block()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self._close_segment()
+
+    def _open_segment(self, start):
+        name = time.strftime("%Y%m%dT%H%M%S", time.gmtime(start))
+        path = os.path.join(self.directory, f"{name}.{int(start % 1 * 1000):03d}")
+        self.segment = open(path + SEGMENT_SUFFIX, "ab")
+        self.index = open(path + INDEX_SUFFIX, "a")
+        self.segment_started = start
+
+    def _close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = self.index = None
+
+    def _write_block(self):
+        messages, self.messages = self.messages, []
+        start = messages[0].time
+        if self.segment is not None and (
+            self.segment.tell() >= self.segment_bytes
+            or start - self.segment_started >= self.segment_seconds
+        ):
+            self._close_segment()
+        if self.segment is None:
+            self._open_segment(start)
+
+        block = encode_block(messages)
+        offset = self.segment.tell()
+        self.segment.write(block)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        entry = _index_entry(offset, len(block), messages)
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+
+
+def _index_entry(offset, size, messages):
+    return {
+        "offset": offset,
+        "size": size,
+        "start": min(message.time for message in messages),
+        "end": max(message.time for message in messages),
+        "topics": Counter(message.topic for message in messages),
+    }
+
+
+def segments(directory=DEFAULT_DIRECTORY):
+    return sorted(glob.glob(os.path.join(directory, "*" + SEGMENT_SUFFIX)))
+
+
+def blocks(segment):
+    """
+    Index entries of the blocks in a segment. Blocks written after the last
+    index line (e.g. after a crash) are found by scanning the segment.
+    """
+    entries = []
+    index_path = segment[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # torn last line
+    position = entries[-1]["offset"] + entries[-1]["size"] if entries else 0
+    with open(segment, "rb") as f:
+        f.seek(position)
+        while header := f.read(BLOCK_HEADER_SIZE):
+            if len(header) < BLOCK_HEADER_SIZE:
+                break
+            magic, size, count = struct.unpack(BLOCK_HEADER, header)
+            compressed = f.read(size)
+            if magic != MAGIC or len(compressed) < size:
+                break
+            messages = decode_block(compressed, count)
+            entries.append(_index_entry(position, BLOCK_HEADER_SIZE + size, messages))
+            position += BLOCK_HEADER_SIZE + size
+    return entries
+
+
+def _matches(topic, patterns):
+    return patterns is None or any(
+        mqtt.topic_matches_sub(pattern, topic) for pattern in patterns
+    )
+
+
+def read_messages(directory=DEFAULT_DIRECTORY, topics=None, start=None, end=None):
+    """
+    Yield the recorded Messages, in recording order, whose topic matches one
+    of the ``topics`` subscription patterns (all by default) and whose receive
+    time is within ``start`` to ``end`` (epoch seconds).
+    """
+    for segment in segments(directory):
+        with open(segment, "rb") as f:
+            for block in blocks(segment):
+                if start is not None and block["end"] < start:
+                    continue
+                if end is not None and block["start"] > end:
+                    continue
+                if not any(_matches(topic, topics) for topic in block["topics"]):
+                    continue
+                f.seek(block["offset"])
+                _, size, count = struct.unpack(BLOCK_HEADER, f.read(BLOCK_HEADER_SIZE))
+                for message in decode_block(f.read(size), count):
+                    if (
+                        _matches(message.topic, topics)
+                        and (start is None or message.time >= start)
+                        and (end is None or message.time <= end)
+                    ):
+                        yield message
+
+
+def summary(directory=DEFAULT_DIRECTORY):
+    """
+    {topic: (messages, first time, last time)} from the indexes alone, so the
+    times are those of the first and last block containing the topic.
+    """
+    topics = {}
+    for segment in segments(directory):
+        for block in blocks(segment):
+            for topic, count in block["topics"].items():
+                total, first, last = topics.get(topic, (0, block["start"], 0))
+                topics[topic] = (
+                    total + count,
+                    min(first, block["start"]),
+                    max(last, block["end"]),
+                )
+    return topics
+
+
+def replay(client, messages, speed=1.0, prefix="", retain=False, commands=False):
+    """
+    Publish ``messages`` with ``client``, keeping their recorded spacing
+    divided by ``speed`` (0 publishes as fast as possible). ``prefix`` is
+    prepended to every topic. Messages on COMMAND_TOPICS are skipped and the
+    retain flag is cleared unless ``commands`` or ``retain`` is set. Returns
+    the number of messages published.
+    """
+    first = started = info = None
+    published = 0
+    for message in messages:
+        if not commands and _matches(message.topic, COMMAND_TOPICS):
+            continue
+        if speed:
+            if first is None:
+                first, started = message.time, time.monotonic()
+            delay = (message.time - first) / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        info = client.publish(
+            prefix + message.topic,
+            message.payload,
+            qos=message.qos,
+            retain=message.retain and retain,
+        )
+        published += 1
+    if info is not None:
+        info.wait_for_publish()
+    return published
+
+
+def connect(args):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    if args.tls:
+        client.tls_set(tls_version=mqtt.ssl.PROTOCOL_TLS_CLIENT)
+    port = args.port or (8883 if args.tls else 1883)
+    client.connect(args.host, port, 60)
+    return client
+
+
+def record_command(args):
+    recorder = Recorder(args.dir)
+    topics = args.topics or DEFAULT_TOPICS
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        # Subscribing here renews the subscriptions after a reconnect
+        for topic in topics:
+            client.subscribe(topic, qos=args.qos)
+        print(f"Recording {', '.join(topics)} to {args.dir}")
+
+    client = connect(args)
+    client.on_connect = on_connect
+    client.on_message = recorder.on_message
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(1)
+            recorder.flush(recorder.block_seconds)
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        client.loop_stop()
+        recorder.close()
+
+
+def replay_command(args):
+    client = connect(args)
+    client.loop_start()
+    try:
+        messages = read_messages(args.dir, args.topics or None, args.start, args.end)
+        published = replay(
+            client, messages, args.speed, args.prefix, args.retain, args.commands
+        )
+        print(f"Replayed {published} messages")
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+
+def info_command(args):
+    for topic, (count, first, last) in sorted(summary(args.dir).items()):
+        first, last = (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) for t in (first, last)
+        )
+        print(f"{topic}: {count} messages, {first} to {last}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record and replay MQTT messages")
+    subparsers = parser.add_subparsers(dest="name", required=True)
+    for name, command, description in (
+        ("record", record_command, "record messages from a broker"),
+        ("replay", replay_command, "publish recorded messages to a broker"),
+        ("info", info_command, "list the recorded topics"),
+    ):
+        subparser = subparsers.add_parser(name, help=description)
+        subparser.set_defaults(command=command)
+        subparser.add_argument("--dir", default=DEFAULT_DIRECTORY)
+        if name == "info":
+            continue
+        subparser.add_argument(
+            "topics",
+            nargs="*",
+            help="topic patterns, e.g. 'magnetometer/#' (default: device telemetry "
+            "for record, everything for replay)",
+        )
+        subparser.add_argument(
+            "--host", default=os.environ.get("MQTT_HOST", "localhost")
+        )
+        subparser.add_argument(
+            "--port", type=int, help="default 8883 with TLS, else 1883"
+        )
+        subparser.add_argument("--username", default=os.environ.get("MQTT_USERNAME"))
+        subparser.add_argument("--password", default=os.environ.get("MQTT_PASSWORD"))
+        subparser.add_argument("--tls", action="store_true")
+    record_parser = subparsers.choices["record"]
+    record_parser.add_argument("--qos", type=int, default=1)
+    replay_parser = subparsers.choices["replay"]
+    replay_parser.add_argument(
+        "--speed", type=float, default=1.0, help="1 is real time, 0 is unthrottled"
+    )
+    replay_parser.add_argument("--prefix", default="", help="prepended to topics")
+    replay_parser.add_argument(
+        "--retain", action="store_true", help="keep the recorded retain flags"
+    )
+    replay_parser.add_argument(
+        "--commands",
+        action="store_true",
+        help="also publish recorded command topics (devices will act on them)",
+    )
+    replay_parser.add_argument("--start", type=float, help="epoch seconds")
+    replay_parser.add_argument("--end", type=float, help="epoch seconds")
+
+    args = parser.parse_args(argv)
+    args.command(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Bookkeeping for MQTT clients that keep several requests in flight, shared by
+cobot280pi/client.py (CobotController) and openflexure/microscope_demo_client.py
+(MicroscopeDemo).
+
+Each published request gets a Future in ``pending`` that the client's
+``on_message`` resolves. ``batch()`` pipelines calls made from the same thread
+and ``_wait`` / ``batch()`` drop requests that timed out, so late replies are
+not matched to them and ``pending`` doesn't grow.
+"""
+
+import threading
+from concurrent.futures import Future, TimeoutError, wait
+from contextlib import contextmanager
+
+
+class PendingRequests:
+    """
+    Mixin for the request bookkeeping. Subclasses call ``_init_pending()`` in
+    ``__init__`` and set ``batch_timeout`` (seconds ``batch()`` waits when the
+    block exits).
+    """
+
+    batch_timeout = 60
+
+    def _init_pending(self):
+        self.pending = {}  # request id -> Future, in publish order
+        self.pending_lock = threading.Lock()
+        # Batches are per thread, so calls from other threads aren't swept into
+        # one and wait for their own replies as usual
+        self._batches = threading.local()
+
+    def _add_pending(self, request_id):
+        future = Future()
+        with self.pending_lock:
+            self.pending[request_id] = future
+        return future
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue several calls without waiting for each round-trip.
+
+        Inside the block the command methods return Futures instead of
+        results. All of them are waited for (up to ``batch_timeout``) when the
+        block exits; requests still without a reply are then dropped.
+        """
+        outer = getattr(self._batches, "current", None)
+        futures, requests = self._batches.current = ([], [])
+        try:
+            yield futures
+        finally:
+            self._batches.current = outer
+            wait(futures, timeout=self.batch_timeout)
+            for request in requests:
+                if not request.done():
+                    self._discard(request)
+
+    def _batched(self, request, future):
+        """
+        Add ``future`` (the Future of ``request``, maybe transformed) to the
+        calling thread's batch. Returns False outside of ``batch()``.
+        """
+        current = getattr(self._batches, "current", None)
+        if current is None:
+            return False
+        current[0].append(future)
+        current[1].append(request)
+        return True
+
+    def _wait(self, request, future, timeout):
+        """Result of ``future``, dropping ``request`` if it times out."""
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            self._discard(request)
+            raise
+
+    def _discard(self, request):
+        """Stop waiting for ``request``. Returns the request ids dropped."""
+        with self.pending_lock:
+            request_ids = [
+                request_id
+                for request_id, future in self.pending.items()
+                if future is request
+            ]
+            for request_id in request_ids:
+                del self.pending[request_id]
+        return request_ids
+
+    @staticmethod
+    def _then(future, transform):
+        """A Future for ``transform`` applied to the result of ``future``."""
+        result = Future()
+
+        def on_done(done):
+            try:
+                result.set_result(transform(done.result()))
+            except Exception as e:
+                result.set_exception(e)
+
+        future.add_done_callback(on_done)
+        return result
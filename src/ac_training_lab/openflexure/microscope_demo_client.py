@@ -9,22 +9,38 @@
 # execute the command
 # return the images/store them etc
 
+import asyncio
 import base64
 import json
-import time
-from io import BytesIO
-from queue import Queue
+import uuid
+from queue import Empty, Queue
 
 import paho.mqtt.client as mqtt
-from PIL import Image
+from tile_stream import Mosaic, TileCache, decode_image
+
+from ac_training_lab.mqtt_requests import PendingRequests
 
 # microscope1
 # microscope2
 # deltastagereflection
 # deltastagetransmission
 
+# seconds to wait for the reply to each command before raising TimeoutError
+COMMAND_TIMEOUTS = {
+    "move": 60,
+    "focus": 60,
+    "get_pos": 10,
+    "take_image": 30,
+    "scan": 1800,
+    "scan_and_stitch": 1800,
+}
+DEFAULT_TIMEOUT = 60
+
+
+class MicroscopeDemo(PendingRequests):
+    # batch() waits as long as the slowest command may take
+    batch_timeout = max(DEFAULT_TIMEOUT, *COMMAND_TIMEOUTS.values())
 
-class MicroscopeDemo:
     def __init__(self, host, port, username, password, microscope):
         self.host = host
         self.port = port
@@ -36,11 +52,14 @@ class MicroscopeDemo:
         self.client.tls_set()
         self.client.username_pw_set(self.username, self.password)
 
-        self.receiveq = Queue()
+        # replies are matched to requests by "request_id"; replies from
+        # microscopes that don't echo it go to the oldest open request
+        self._init_pending()
+        self.streams = {}  # request id -> Queue of scan messages
+        self.receiveq = Queue()  # replies that match no request
 
         def on_message(client, userdata, message):
             received = json.loads(message.payload.decode("utf-8"))
-            self.receiveq.put(received)
             if len(json.dumps(received)) <= 300:
                 print(received)
             else:
@@ -48,6 +67,7 @@ class MicroscopeDemo:
                     print(json.dumps(received)[:300] + "...")
                 except Exception as e:
                     print(f"Command printing error (program will continue): {e}")
+            self._dispatch(received)
 
         self.client.on_message = on_message
 
@@ -57,35 +77,91 @@ class MicroscopeDemo:
 
         self.client.subscribe(self.microscope + "/return", qos=2)
 
-    def scan_and_stitch(self, c1, c2, ov=1200, foc=0):  # WIP
-        command = json.dumps(
-            {"command": "scan_and_stitch", "c1": c1, "c2": c2, "ov": ov, "foc": foc}
-        )
+    def _dispatch(self, received):
+        request_id = received.get("request_id")
+        with self.pending_lock:
+            if request_id is None:
+                if self.streams:
+                    request_id = next(iter(self.streams))
+                elif self.pending:
+                    request_id = next(iter(self.pending))
+            stream = self.streams.get(request_id)
+            future = None if stream is not None else self.pending.pop(request_id, None)
+        if stream is not None:
+            stream.put(received)
+        elif future is not None:
+            if not future.cancelled():
+                future.set_result(received)
+        else:
+            self.receiveq.put(received)
+
+    def _publish(self, command, request_id):
+        command = {**command, "request_id": request_id}
         self.client.publish(
-            self.microscope + "/command", payload=command, qos=2, retain=False
+            self.microscope + "/command",
+            payload=json.dumps(command),
+            qos=2,
+            retain=False,
         )
-        while self.receiveq.empty():
-            time.sleep(0.05)
-        image = self.receiveq.get()
-        image_string = image["image"]
-        image_bytes = base64.b64decode(image_string)
-        image_object = Image.open(BytesIO(image_bytes))
-        return image_object
-
-    def move(self, x, y, z=False, relative=False):
+
+    def submit(self, command):
+        """publishes a command (a dictionary like {"command": "move", "x": 1,
+        "y": 2}) and returns a Future for its reply without waiting. Several
+        commands can be in flight at once, the microscope runs them in order"""
+        request_id = uuid.uuid4().hex
+        future = self._add_pending(request_id)
+        self._publish(command, request_id)
+        return future
+
+    def request(self, command, timeout=None):
+        """publishes a command and waits for its reply"""
+        future = self.submit(command)
+        return self._wait(future, future, self._timeout(command["command"], timeout))
+
+    async def request_async(self, command, timeout=None):
+        """asyncio version of request()"""
+        future = self.submit(command)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), self._timeout(command["command"], timeout)
+            )
+        except asyncio.TimeoutError:
+            self._discard(future)
+            raise
+
+    def _timeout(self, name, timeout):
+        return timeout or COMMAND_TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+
+    def _call(self, command, timeout=None, transform=None):
+        request = self.submit(command)
+        future = request if transform is None else self._then(request, transform)
+        if self._batched(request, future):
+            return future
+        return self._wait(request, future, self._timeout(command["command"], timeout))
+
+    def scan_and_stitch(self, c1, c2, ov=1200, foc=0, timeout=None):  # WIP
+        command = {"command": "scan_and_stitch", "c1": c1, "c2": c2, "ov": ov}
+        command["foc"] = foc
+        return self._call(command, timeout, _decode_image_reply)
+
+    def move(self, x, y, z=False, relative=False, timeout=None):
         """moves to given coordinates x, y (and z if it is set to any integer
         value, if it is set to False the z value wont change). If relative is
         True, then it will move relative to the current position instead of
         moving to the absolute coordinates"""
-        command = json.dumps(
-            {"command": "move", "x": x, "y": y, "z": z, "relative": relative}
-        )
-        self.client.publish(
-            self.microscope + "/command", payload=command, qos=2, retain=False
-        )
-        while self.receiveq.empty():
-            time.sleep(0.05)
-        return self.receiveq.get()
+        command = {"command": "move", "x": x, "y": y, "z": z, "relative": relative}
+        return self._call(command, timeout)
+
+    def capture_at(self, positions, timeout=None):
+        """moves to each (x, y) in positions and takes an image there, with all
+        the moves and captures pipelined instead of one round-trip per step.
+        Returns the image objects in order"""
+        with self.batch():
+            images = []
+            for x, y in positions:
+                self.move(x, y)
+                images.append(self.take_image())
+        return [image.result(timeout) for image in images]
 
     def scan(self, c1, c2, ov=1200, foc=0):
         """returns a list of image objects. Takes images to scan an entire area
@@ -93,59 +169,120 @@ class MicroscopeDemo:
         y1", "x2, y2" or [x1, y1], [x2, y2]. ov refers to the overlap between
         the images (useful for stitching) and foc refers to how much the
         microscope should focus between images (0 to disable)"""
-        command = json.dumps(
-            {"command": "scan", "c1": c1, "c2": c2, "ov": ov, "foc": foc}
-        )
-        self.client.publish(
-            self.microscope + "/command", payload=command, qos=2, retain=False
-        )
-        while self.receiveq.empty():
-            time.sleep(0.05)
-        image_l = self.receiveq.get()
-        image_list = image_l["images"]
-        for i in range(len(image_list)):
-            image = image_list[i]
-            image_bytes = base64.b64decode(image)
-            image_object = Image.open(BytesIO(image_bytes))
-            image_list[i] = image_object
-        return image_list
-
-    def focus(
-        self, amount="fast"
-    ):  # focuses by different amounts: huge, fast, medium, fine, or any integer value
-        command = json.dumps({"command": "focus", "amount": amount})
-        self.client.publish(
-            self.microscope + "/command", payload=command, qos=2, retain=False
-        )
-        while self.receiveq.empty():
-            time.sleep(0.05)
-        return self.receiveq.get()
-
-    def get_pos(
-        self,
-    ):  # returns a dictionary with x, y, and z coordinates eg. {'x':1,'y':2,'z':3}
-        command = json.dumps({"command": "get_pos"})
-        self.client.publish(
-            self.microscope + "/command", payload=command, qos=2, retain=False
-        )
-        while self.receiveq.empty():
-            time.sleep(0.05)
-        pos = self.receiveq.get()
-        return pos["pos"]
+        return [tile["image"] for tile in self.scan_tiles(c1, c2, ov, foc)]
 
-    def take_image(self):  # returns an image object
-        command = json.dumps({"command": "take_image"})
-        self.client.publish(
-            self.microscope + "/command", payload=command, qos=2, retain=False
-        )
-        while self.receiveq.empty():
-            time.sleep(0.05)
-        image = self.receiveq.get()
-        image_string = image["image"]
-        image_bytes = base64.b64decode(image_string)
-        image_object = Image.open(BytesIO(image_bytes))
-        return image_object
+    def scan_tiles(self, c1, c2, ov=1200, foc=0, mosaic_path=None, cache_dir=None):
+        """like scan(), but yields each tile as soon as it is captured instead
+        of returning all of them at the end. Each tile is a dictionary with the
+        image object, its grid "index" [row, col], the scan "grid" size and the
+        stage coordinates "x", "y" and "z".
+
+        If mosaic_path is set, tiles are also written into a memory-mapped .npy
+        mosaic there. If cache_dir is set, tiles are kept on disk and positions
+        already in the cache (for the same foc) are not downloaded again.
+
+        Microscopes that don't stream tiles reply with the whole list at once,
+        which is yielded tile by tile as a single row (and written to the
+        mosaic that way). Those tiles have no stage coordinates, so cache_dir
+        raises ValueError with such a microscope. A tile sent without its image
+        that isn't in the cache (or without a cache) also raises ValueError"""
+        cache = TileCache(cache_dir) if cache_dir is not None else None
+        mosaic = Mosaic(mosaic_path) if mosaic_path is not None else None
+        command = {
+            "command": "scan",
+            "c1": c1,
+            "c2": c2,
+            "ov": ov,
+            "foc": foc,
+            "stream": True,
+        }
+        if cache is not None:
+            # the microscope sends these tiles without the image data
+            command["cached"] = cache.positions(foc)
+        request_id = uuid.uuid4().hex
+        stream = Queue()
+        with self.pending_lock:
+            self.streams[request_id] = stream
+        self._publish(command, request_id)
+
+        try:
+            while True:
+                try:
+                    received = stream.get(timeout=COMMAND_TIMEOUTS["scan"])
+                except Empty:
+                    raise TimeoutError("no reply from the microscope during scan")
+                if "images" in received:  # all tiles in one message
+                    if cache is not None:
+                        raise ValueError(
+                            "the microscope sent the scan without tile positions, "
+                            "so there is nothing to key cache_dir by"
+                        )
+                    images = received["images"]
+                    for i, image in enumerate(images):
+                        tile = {
+                            "index": [0, i],
+                            "grid": [1, len(images)],
+                            "image": decode_image(base64.b64decode(image)),
+                        }
+                        if mosaic is not None:
+                            mosaic.add(tile["index"], tile["grid"], tile["image"])
+                        yield tile
+                    return
+                if received.get("scan_complete"):
+                    return
+
+                tile = received["tile"]
+                x, y = tile["x"], tile["y"]
+                if "image" in tile:
+                    image_bytes = base64.b64decode(tile.pop("image"))
+                    if cache is not None:
+                        cache.put(x, y, foc, image_bytes)
+                elif cache is None:
+                    raise ValueError(
+                        f"the microscope sent the tile at ({x}, {y}) without image "
+                        "data, but no cache_dir was given"
+                    )
+                else:
+                    image_bytes = cache.get(x, y, foc)
+                    if image_bytes is None:
+                        raise ValueError(
+                            f"the microscope sent the tile at ({x}, {y}) as cached, "
+                            f"but it is not in {cache_dir}"
+                        )
+                tile["image"] = decode_image(image_bytes)
+                if mosaic is not None:
+                    mosaic.add(tile["index"], tile["grid"], tile["image"])
+                yield tile
+        finally:
+            with self.pending_lock:
+                del self.streams[request_id]
+            if mosaic is not None:
+                mosaic.close()
+
+    async def scan_tiles_async(self, c1, c2, ov=1200, foc=0, **kwargs):
+        """async iterator version of scan_tiles(), for use with async for"""
+        tiles = self.scan_tiles(c1, c2, ov, foc, **kwargs)
+        while True:
+            tile = await asyncio.to_thread(next, tiles, None)
+            if tile is None:
+                return
+            yield tile
+
+    def focus(self, amount="fast", timeout=None):
+        # focuses by different amounts: huge, fast, medium, fine, or any integer value
+        return self._call({"command": "focus", "amount": amount}, timeout)
+
+    def get_pos(self, timeout=None):
+        # returns a dictionary with x, y, and z coordinates eg. {'x':1,'y':2,'z':3}
+        return self._call({"command": "get_pos"}, timeout, lambda pos: pos["pos"])
+
+    def take_image(self, timeout=None):  # returns an image object
+        return self._call({"command": "take_image"}, timeout, _decode_image_reply)
 
     def end_connection(self):  # ends the connection
         self.client.loop_stop()
         self.client.disconnect()
+
+
+def _decode_image_reply(reply):
+    return decode_image(base64.b64decode(reply["image"]))
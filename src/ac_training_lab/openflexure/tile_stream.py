@@ -0,0 +1,83 @@
+# Helpers for MicroscopeDemo.scan_tiles: an on-disk tile cache and a
+# memory-mapped mosaic that tiles are written into as they arrive.
+
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+class TileCache:
+    """JPEG tiles on disk keyed by stage position and focus setting, so a
+    repeated scan over the same area doesn't have to download them again"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, x, y, foc):
+        return os.path.join(self.directory, f"{x}_{y}_{foc}.jpeg")
+
+    def get(self, x, y, foc):
+        try:
+            with open(self.path(x, y, foc), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, x, y, foc, image_bytes):
+        path = self.path(x, y, foc)
+        with open(path + ".tmp", "wb") as f:
+            f.write(image_bytes)
+        os.replace(path + ".tmp", path)
+
+    def positions(self, foc):
+        """[x, y] of every cached tile taken with this focus setting"""
+        positions = []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            parts = stem.split("_")
+            if ext == ".jpeg" and len(parts) == 3 and parts[2] == str(foc):
+                positions.append([int(parts[0]), int(parts[1])])
+        return positions
+
+
+class Mosaic:
+    """Tiles laid out on their scan grid in a .npy file that is memory-mapped,
+    so the full mosaic never has to fit in RAM. Tiles are placed edge to edge
+    by grid index (the overlap is not blended, use openflexure-stitch for
+    that). The file is created when the first tile arrives."""
+
+    def __init__(self, path):
+        self.path = path
+        self.array = None
+
+    def add(self, index, grid, image):
+        tile = np.asarray(image.convert("RGB"))
+        if self.array is None:
+            height, width = tile.shape[:2]
+            self.array = np.lib.format.open_memmap(
+                self.path,
+                mode="w+",
+                dtype=np.uint8,
+                shape=(grid[0] * height, grid[1] * width, 3),
+            )
+        height = self.array.shape[0] // grid[0]
+        width = self.array.shape[1] // grid[1]
+        tile = tile[:height, :width]
+        row, col = index
+        self.array[
+            row * height : row * height + tile.shape[0],
+            col * width : col * width + tile.shape[1],
+        ] = tile
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+
+
+def decode_image(image_bytes):
+    image = Image.open(BytesIO(image_bytes))
+    image.load()
+    return image
@@ -34,6 +34,23 @@
 # [x1, y1], [x2, y2]. ov refers to the overlap between the images (useful for
 # stitching) and foc refers to how much the microscope should focus between
 # images (0 to disable)
+#
+# scan_tiles(c1,c2,ov,foc,mosaic_path,cache_dir) optional
+#
+# same as scan() but yields each tile (a dictionary with the image, its grid
+# index and stage coordinates) as soon as it arrives. mosaic_path writes the
+# tiles into a memory-mapped .npy mosaic, cache_dir keeps tiles on disk so the
+# same area isn't downloaded twice. scan_tiles_async() works with async for
+#
+# capture_at(positions) optional
+#
+# moves to each [x, y] in positions and returns the images taken there. The
+# moves and captures are sent at once instead of waiting for each reply
+#
+# every command takes an optional timeout (seconds) and raises TimeoutError
+# when the microscope doesn't reply in time. Inside "with microscope.batch():"
+# commands return futures instead of waiting, and request_async() is the
+# asyncio version of request({"command": ...})
 
 
 # EXAMPLE CODE
@@ -3,9 +3,9 @@
 import os
 from datetime import datetime
 
-import pandas as pd
 from prefect import task
 from pymongo import MongoClient
+from well_repository import WellRepository
 
 MONGODB_PASSWORD = os.getenv("MONGODB_PASSWORD")
 
@@ -13,69 +13,67 @@ blinded_connection_string = os.getenv("blinded_connection_string")
 
 connection_string = blinded_connection_string.replace("<db_password>", MONGODB_PASSWORD)
 
+# Number of well plates on the deck, reserve_wells moves on to the next plate
+# once one is full
+PLATES = int(os.getenv("OT2_PLATES", "1"))
+
+# MongoClient keeps its own connection pool, so one instance is shared by all
+# the functions below instead of connecting on every call
+_dbclient = None
+_wells = None
+
+
+def get_db():
+    global _dbclient
+    if _dbclient is None:
+        _dbclient = MongoClient(connection_string)
+    return _dbclient["LCM-OT-2-SLD"]
+
+
+def get_wells():
+    global _wells
+    if _wells is None:
+        _wells = WellRepository(get_db()["wells"], project="OT2", plates=PLATES)
+    return _wells
+
 
 @task
 def generate_empty_well():
-    dbclient = MongoClient(connection_string)
-    db = dbclient["LCM-OT-2-SLD"]
-    collection = db["wells"]
-    rows = ["A", "B", "C", "D", "E", "F", "G", "H"]
-    columns = [str(i) for i in range(1, 13)]
-    for row in rows:
-        for col in columns:
-            well = f"{row}{col}"
-            metadata = {"well": well, "status": "empty", "project": "OT2"}
+    get_wells().reset()
 
-            # send_data_to_mongodb(collection="wells", data=metadata)
-            query = {"well": well}
-            update_data = {"$set": metadata}
-            collection.update_one(query, update_data, upsert=True)
 
-    # close connection
-    dbclient.close()
+@task
+def update_used_wells(used_wells, plate=1):
+    get_wells().mark_used(used_wells, plate)
 
 
 @task
-def update_used_wells(used_wells):
-    dbclient = MongoClient(connection_string)
-    db = dbclient["LCM-OT-2-SLD"]
-    collection = db["wells"]
+def reserve_wells(n, session_id):
+    """
+    Atomically claims the next ``n`` empty wells for ``session_id``, so two
+    concurrent runs never get the same well. Returns ``[(plate, well), ...]``
+    in plate order. Follow up with confirm_reserved_wells once the wells are
+    used, or release_reserved_wells; otherwise the reservation expires on its
+    own.
+    """
+    return [
+        (well["plate"], well["well"]) for well in get_wells().reserve(n, session_id)
+    ]
 
-    for well in used_wells:
-        metadata = {"well": well, "status": "used", "project": "OT2"}
-        # send_data_to_mongodb(collection="wells", data=metadata)
-        query = {"well": well}
-        update_data = {"$set": metadata}
-        collection.update_one(query, update_data, upsert=True)
 
-    # close connection
-    dbclient.close()
+@task
+def confirm_reserved_wells(session_id):
+    get_wells().confirm(session_id)
 
 
 @task
-def find_unused_wells():
-    dbclient = MongoClient(connection_string)
-    db = dbclient["LCM-OT-2-SLD"]
-    collection = db["wells"]
-    query = {"status": "empty"}
-    response = list(collection.find(query))
-    df = pd.DataFrame(response)
-
-    # Extract the "well" column as a list
-    if "well" not in df.columns:
-        raise ValueError("No available wells.")
-
-    # Sort obtained list
-    def well_sort_key(well):
-        row = well[0]  # A, B, C, ...
-        col = int(well[1:])  # 1, 2, ..., 12
-        return (row, col)
-
-    empty_wells = sorted(df["well"].tolist(), key=well_sort_key)
-    # print(empty_wells)
+def release_reserved_wells(session_id):
+    get_wells().release(session_id)
 
-    # close connection
-    dbclient.close()
+
+@task
+def find_unused_wells(plate=1):
+    empty_wells = get_wells().unused(plate)
 
     # Check if there are any empty wells
     if len(empty_wells) == 0:
@@ -86,32 +84,25 @@ def find_unused_wells():
 
 @task
 def save_result(result_data):
-    dbclient = MongoClient(connection_string)
-    db = dbclient["LCM-OT-2-SLD"]
+    db = get_db()
     collection = db["MSE403_result"]  # change collection afte this practical finishes
     # collection = db["test_result"]
     result_data["timestamp"] = datetime.utcnow()  # UTC time
     insert_result = collection.insert_one(result_data)
     inserted_id = insert_result.inserted_id
-    # close connection
-    dbclient.close()
     return inserted_id
 
 
 def get_student_quota(student_id):
-    with MongoClient(connection_string) as client:
-        db = client["LCM-OT-2-SLD"]
-        collection = db["student"]
-        student = collection.find_one({"student_id": student_id})
-        if student is None:
-            raise ValueError(f"Student ID '{student_id}' not found in the database.")
-        return student.get("quota", 0)
+    collection = get_db()["student"]
+    student = collection.find_one({"student_id": student_id})
+    if student is None:
+        raise ValueError(f"Student ID '{student_id}' not found in the database.")
+    return student.get("quota", 0)
 
 
 def decrement_student_quota(student_id):
-    dbclient = MongoClient(connection_string)
-    db = dbclient["LCM-OT-2-SLD"]
-    collection = db["student"]
+    collection = get_db()["student"]
 
     student = collection.find_one({"student_id": student_id})
     if not student:
@@ -135,14 +126,11 @@ def add_student_quota(student_id, quota):
     :param student_id: The ID of the student.
     :param quota: The initial quota for the student.
     """
-    dbclient = MongoClient(connection_string)
-    db = dbclient["LCM-OT-2-SLD"]
-    collection = db["student"]
+    collection = get_db()["student"]
     student_data = {"student_id": student_id, "quota": quota}
     collection.update_one(
         {"student_id": student_id}, {"$set": student_data}, upsert=True
     )
-    dbclient.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,16 @@
+import itertools
 import json
-from queue import Empty, Queue
-from time import sleep
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from queue import PriorityQueue
 
 import opentrons.execute
+import opentrons.simulate
 import paho.mqtt.client as mqtt
+from mix_planner import compare_plans, plan_mixes, run_plan
 
 protocol = opentrons.execute.get_protocol_api("2.16")
 
@@ -18,6 +25,10 @@ port = 8883
 
 OT2_COMMAND_TOPIC = f"command/ot2/{OT2_SERIAL}/pipette"
 OT2_STATUS_TOPIC = f"status/ot2/{OT2_SERIAL}/complete"
+# one event per finished step (tip pickup, aspirate, dispense, sensor in place...)
+OT2_PROGRESS_TOPIC = f"status/ot2/{OT2_SERIAL}/progress"
+# retained per-step duration histograms, updated after each command
+OT2_METRICS_TOPIC = f"status/ot2/{OT2_SERIAL}/metrics"
 # SENSOR_COMMAND_TOPIC = f"command/picow/{PICO_ID}/as7341/read"
 # SENSOR_DATA_TOPIC = f"color-mixing/picow/{PICO_ID}/as7341"
 
@@ -26,7 +37,64 @@ client = mqtt.Client()
 client.tls_set(tls_version=mqtt.ssl.PROTOCOL_TLS_CLIENT)  # type: ignore
 client.username_pw_set(username, password)
 
-command_queue = Queue()
+# Sensor-return commands jump ahead of new mixes, so the sensor never waits on
+# the charging port behind a queue of mixes. The counter keeps FIFO order
+# within a priority.
+SENSOR_PRIORITY = 0
+MIX_PRIORITY = 1
+command_queue = PriorityQueue()
+command_counter = itertools.count()
+
+# Upper bounds (s) of the step duration histogram buckets, the last is +inf
+HISTOGRAM_BUCKETS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, float("inf")]
+step_histograms = defaultdict(
+    lambda: {"count": 0, "sum_s": 0.0, "buckets": [0] * len(HISTOGRAM_BUCKETS)}
+)
+
+
+def record_duration(step, duration):
+    histogram = step_histograms[step]
+    histogram["count"] += 1
+    histogram["sum_s"] += duration
+    histogram["buckets"][bisect_left(HISTOGRAM_BUCKETS, duration)] += 1
+
+
+@contextmanager
+def track_step(step, payload, **details):
+    """
+    Time a step, add it to the histogram and publish a progress event. A step
+    that raises is still recorded, with the error in the event.
+    """
+    started_at = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        record_duration(step, duration)
+        event = {
+            "step": step,
+            "started_at": started_at.isoformat(),
+            "duration_s": round(duration, 3),
+            "experiment_id": payload.get("experiment_id"),
+            "session_id": payload.get("session_id"),
+            **details,
+        }
+        if error is not None:
+            event["error"] = error
+        client.publish(OT2_PROGRESS_TOPIC, json.dumps(event), qos=1)
+
+
+def publish_metrics():
+    metrics = {
+        "buckets_le_s": [str(bound) for bound in HISTOGRAM_BUCKETS],
+        "steps": dict(step_histograms),
+    }
+    client.publish(OT2_METRICS_TOPIC, json.dumps(metrics), qos=1, retain=True)
 
 
 # MQTT Callbacks
@@ -41,7 +109,14 @@ def on_message(client, userdata, msg):
     try:
         payload = json.loads(payload)
         if msg.topic == OT2_COMMAND_TOPIC:
-            command_queue.put(payload)
+            command = payload.get("command") if isinstance(payload, dict) else None
+            if not isinstance(command, dict):
+                print(f"Dropped message without a command object: {payload!r}")
+                return
+            priority = SENSOR_PRIORITY if "sensor_status" in command else MIX_PRIORITY
+            command_queue.put(
+                (priority, next(command_counter), time.perf_counter(), payload)
+            )
 
     except json.JSONDecodeError as e:
         print(f"Failed to decode JSON payload: {e}")
@@ -55,29 +130,39 @@ client.loop_start()
 print("MQTT client connected")
 
 protocol.home()  # home to know MQTT cilent is connected
-# Define labware and pipettes
 
-# changed file path before nohup run
-# load wireless charging port
-with open(
-    "/var/lib/jupyter/notebooks/ac_color_sensor_charging_port.json"
-) as labware_file1:
-    labware_def1 = json.load(labware_file1)
-    tiprack_2 = protocol.load_labware_from_definition(labware_def1, 10)
-# load 3x2 vials rack
-with open("/var/lib/jupyter/notebooks/ac_6_tuberack_15000ul.json") as labware_file2:
-    labware_def2 = json.load(labware_file2)
-    reservoir = protocol.load_labware_from_definition(labware_def2, 3)
-# load other labwares from Opentrons's labware library
-plate = protocol.load_labware(load_name="corning_96_wellplate_360ul_flat", location=1)
-
-tiprack_1 = protocol.load_labware(load_name="opentrons_96_tiprack_300ul", location=9)
-
-p300 = protocol.load_instrument(
-    instrument_name="p300_single_gen2", mount="right", tip_racks=[tiprack_1]
-)
 
-p300.well_bottom_clearance.dispense = 8
+# Define labware and pipettes
+def load_deck(protocol):
+    # changed file path before nohup run
+    # load wireless charging port
+    with open(
+        "/var/lib/jupyter/notebooks/ac_color_sensor_charging_port.json"
+    ) as labware_file1:
+        labware_def1 = json.load(labware_file1)
+        tiprack_2 = protocol.load_labware_from_definition(labware_def1, 10)
+    # load 3x2 vials rack
+    with open("/var/lib/jupyter/notebooks/ac_6_tuberack_15000ul.json") as labware_file2:
+        labware_def2 = json.load(labware_file2)
+        reservoir = protocol.load_labware_from_definition(labware_def2, 3)
+    # load other labwares from Opentrons's labware library
+    plate = protocol.load_labware(
+        load_name="corning_96_wellplate_360ul_flat", location=1
+    )
+
+    tiprack_1 = protocol.load_labware(
+        load_name="opentrons_96_tiprack_300ul", location=9
+    )
+
+    p300 = protocol.load_instrument(
+        instrument_name="p300_single_gen2", mount="right", tip_racks=[tiprack_1]
+    )
+
+    p300.well_bottom_clearance.dispense = 8
+    return tiprack_2, reservoir, plate, tiprack_1, p300
+
+
+tiprack_2, reservoir, plate, tiprack_1, p300 = load_deck(protocol)
 
 
 print("Labwares loaded")
@@ -110,22 +195,29 @@ def mix_color(payload):
 
     for pos in position:
         if float(portion[pos]) != 0.0:  # if zero, skip this color aspiration process
-            p300.pick_up_tip(tiprack_1[pos])
-            p300.aspirate(color_volume[pos], reservoir[pos])
-            p300.dispense(color_volume[pos], plate[mix_well])
-            p300.default_speed = 100
-            # reduce pipette speed to prevent droplets falling, speed unit: mm/sec
-            p300.blow_out(reservoir["A1"].top(z=-5))
-            p300.default_speed = (
-                400  # reset pipette speed, speed unit: mm/sec, 400 is default value
-            )
-            p300.drop_tip(tiprack_1[pos])
-
-    p300.pick_up_tip(tiprack_2["A2"])
-    p300.move_to(
-        plate[mix_well].top(z=-1.3)
-    )  # z=-1.3 to get sensor closer to the well, can change this value depends on
-    # the fitting of the pick-up fake tip on the sensor package.
+            details = {"well": mix_well, "color": pos}
+            with track_step("pick_up_tip", payload, **details):
+                p300.pick_up_tip(tiprack_1[pos])
+            with track_step("aspirate", payload, volume=color_volume[pos], **details):
+                p300.aspirate(color_volume[pos], reservoir[pos])
+            with track_step("dispense", payload, volume=color_volume[pos], **details):
+                p300.dispense(color_volume[pos], plate[mix_well])
+            with track_step("blow_out", payload, **details):
+                p300.default_speed = 100
+                # reduce pipette speed to prevent droplets falling, speed unit: mm/sec
+                p300.blow_out(reservoir["A1"].top(z=-5))
+                p300.default_speed = (
+                    400  # reset pipette speed, speed unit: mm/sec, 400 is default value
+                )
+            with track_step("drop_tip", payload, **details):
+                p300.drop_tip(tiprack_1[pos])
+
+    with track_step("sensor_in_place", payload, well=mix_well):
+        p300.pick_up_tip(tiprack_2["A2"])
+        p300.move_to(
+            plate[mix_well].top(z=-1.3)
+        )  # z=-1.3 to get sensor closer to the well, can change this value depends on
+        # the fitting of the pick-up fake tip on the sensor package.
 
     # payloadtosent = json.dumps(payload)
     # print("Sending read command to sensor...")
@@ -141,12 +233,58 @@ def mix_color(payload):
     client.publish(OT2_STATUS_TOPIC, payload, qos=2)  # send a status message back to HF
 
 
+# N mixes planned together, with wells visited in serpentine order. With
+# "reuse_tips": true (opt-in), each color uses one tip for the whole batch
+# instead of a fresh tip per well. With "dry_run", the plan is checked on a
+# simulated deck and only the time estimate is reported.
+def mix_batch(payload):
+    mixes = payload["command"]["mixes"]
+    reuse_tips = payload["command"].get("reuse_tips", False)
+    session_id = payload["session_id"]
+    experiment_id = payload["experiment_id"]
+
+    steps = plan_mixes(mixes, reuse_tips)
+    if payload["command"].get("dry_run", False):
+        sim_protocol = opentrons.simulate.get_protocol_api("2.16")
+        _, sim_reservoir, sim_plate, sim_tiprack, sim_p300 = load_deck(sim_protocol)
+        run_plan(steps, sim_p300, sim_reservoir, sim_plate, sim_tiprack)
+        status = {
+            "mix_status": "dry_run",
+            **compare_plans(mixes, sim_reservoir, sim_plate, sim_tiprack, reuse_tips),
+        }
+    else:
+        protocol.home()  # one home for the whole batch
+
+        def track(step):
+            if step[0] in ("pick_up_tip", "drop_tip"):
+                details = {"color": step[1]}
+            elif step[0] == "aspirate":
+                details = {"color": step[2], "volume": step[1]}
+            elif step[0] == "dispense":
+                details = {"well": step[2], "volume": step[1]}
+            else:
+                details = {}
+            return track_step(step[0], payload, **details)
+
+        run_plan(steps, p300, reservoir, plate, tiprack_1, track=track)
+        status = {"mix_status": "complete", "wells": [mix["well"] for mix in mixes]}
+
+    payload_data = {
+        "status": status,
+        "experiment_id": experiment_id,
+        "session_id": session_id,
+    }
+    payload = json.dumps(payload_data)
+    client.publish(OT2_STATUS_TOPIC, payload, qos=2)  # send a status message back to HF
+
+
 def move_sensor_back(payload):
     results_status = payload["command"]["sensor_status"]
     session_id = payload["session_id"]
     experiment_id = payload["experiment_id"]
 
-    p300.drop_tip(tiprack_2["A2"].top(z=-80))
+    with track_step("sensor_back", payload):
+        p300.drop_tip(tiprack_2["A2"].top(z=-80))
     # protocol.home()
 
     payload_data = {
@@ -163,7 +301,11 @@ def move_sensor_back(payload):
 
 def handle_command(payload):
 
-    if {"R", "Y", "B", "well"}.issubset(payload["command"].keys()):
+    if "mixes" in payload["command"]:
+        print(f"Handling batch mix command: {payload}")
+        mix_batch(payload)
+
+    elif {"R", "Y", "B", "well"}.issubset(payload["command"].keys()):
         print(f"Handling mix command: {payload}")
         mix_color(payload)
 
@@ -176,22 +318,22 @@ print("OT-2 is waiting for command")
 protocol.home()  # home to know OT-2 is ready
 
 
-# Keep protocol active
+# Keep protocol active. get() blocks until a command arrives, so a command is
+# handled as soon as the previous one is done.
 while True:
     try:
-        command = command_queue.get(timeout=1)
+        _, _, received, command = command_queue.get()
         print(f"Processing command from queue: {command}")
 
         if "command" in command and "experiment_id" in command:
+            record_duration("queue_wait", time.perf_counter() - received)
             try:
                 handle_command(command)
             except Exception as e:
                 print(f"Error processing command: {e}")
-    except Empty:
-
-        pass
+            record_duration("command", time.perf_counter() - received)
+            publish_metrics()
 
     except Exception as e:
 
         print(f"Unexpected error in main loop: {e}")
-    sleep(1)
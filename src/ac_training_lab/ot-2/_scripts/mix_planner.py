@@ -0,0 +1,154 @@
+# Batch planning of color mixes, shared by OT2mqtt.py and prefect/device.py
+
+import math
+from contextlib import nullcontext
+
+# R, Y, B paint vials on the 3x2 vials rack, and the matching tips on tiprack_1
+COLOR_POSITIONS = {"R": "B1", "Y": "B2", "B": "B3"}
+MAX_WELL_VOLUME = 300  # uL, also the p300 capacity
+BLOW_OUT_SPEED = 100  # mm/s, slow to prevent droplets falling
+DEFAULT_SPEED = 400  # mm/s, the OT-2 default
+
+# Rough durations (s) of the pipette actions, excluding travel, used by the
+# dry-run estimate. COMMAND_OVERHEAD is the per-command queue poll of the
+# one-well-per-command loop.
+ACTION_SECONDS = {
+    "pick_up_tip": 4.0,
+    "drop_tip": 4.0,
+    "aspirate": 2.0,
+    "dispense": 2.0,
+    "blow_out": 1.5,
+}
+COMMAND_OVERHEAD = 1.0
+
+
+def well_path_key(well):
+    """Serpentine order over the plate (A1..A12, B12..B1, ...) to cut travel."""
+    row = ord(well[0]) - ord("A")
+    col = int(well[1:])
+    return (row, col if row % 2 == 0 else -col)
+
+
+def validate_mixes(mixes):
+    for mix in mixes:
+        total = sum(mix[color] for color in COLOR_POSITIONS)
+        if total > MAX_WELL_VOLUME:
+            raise ValueError(
+                f"The sum of the proportions must be not greater than "
+                f"{MAX_WELL_VOLUME} (well {mix['well']}: {total})"
+            )
+    wells = [mix["well"] for mix in mixes]
+    if len(set(wells)) != len(wells):
+        raise ValueError("Each well can only appear once in a batch")
+
+
+def plan_mixes(mixes, reuse_tips=False):
+    """
+    Turns ``[{"R": 100, "Y": 50, "B": 0, "well": "A1"}, ...]`` into a list of
+    pipette steps such as ``("aspirate", 100, "B1")``.
+
+    Colors are handled one at a time, with the wells visited in serpentine
+    order. With ``reuse_tips`` each color's tip is picked up once for the
+    whole batch, which is safe because dispensing happens above the liquid.
+    Otherwise the tip is returned after every well, like single mixes.
+    """
+    validate_mixes(mixes)
+    steps = []
+    for color, position in COLOR_POSITIONS.items():
+        targets = sorted(
+            ((mix["well"], mix[color]) for mix in mixes if float(mix[color]) != 0.0),
+            key=lambda target: well_path_key(target[0]),
+        )
+        for i, (well, volume) in enumerate(targets):
+            if i == 0 or not reuse_tips:
+                steps.append(("pick_up_tip", position))
+            steps.append(("aspirate", volume, position))
+            steps.append(("dispense", volume, well))
+            steps.append(("blow_out",))
+            if i == len(targets) - 1 or not reuse_tips:
+                steps.append(("drop_tip", position))
+    return steps
+
+
+def run_plan(steps, pipette, reservoir, plate, tiprack, track=None):
+    """
+    Executes ``plan_mixes`` steps on an opentrons protocol (real or simulated).
+    ``track(step)``, if given, returns a context manager wrapped around each
+    step, e.g. to time it.
+    """
+    for step in steps:
+        with track(step) if track is not None else nullcontext():
+            run_step(step, pipette, reservoir, plate, tiprack)
+
+
+def run_step(step, pipette, reservoir, plate, tiprack):
+    action = step[0]
+    if action == "pick_up_tip":
+        pipette.pick_up_tip(tiprack[step[1]])
+    elif action == "aspirate":
+        pipette.aspirate(step[1], reservoir[step[2]])
+    elif action == "dispense":
+        pipette.dispense(step[1], plate[step[2]])
+    elif action == "blow_out":
+        # Only the move to the blow-out position is slow, so default_speed
+        # doesn't have to be changed and restored around it
+        pipette.move_to(reservoir["A1"].top(z=-5), speed=BLOW_OUT_SPEED)
+        pipette.blow_out()
+    elif action == "drop_tip":
+        pipette.drop_tip(tiprack[step[1]])
+
+
+def estimate_seconds(steps, locate, commands=1):
+    """
+    Estimates how long ``steps`` take: fixed ACTION_SECONDS per action plus
+    straight-line travel at the pipette speed. ``locate(step)`` returns the
+    (x, y, z) deck position a step moves to, e.g. from simulated labware.
+    """
+    total = commands * COMMAND_OVERHEAD
+    position = None
+    for step in steps:
+        target = locate(step)
+        speed = BLOW_OUT_SPEED if step[0] == "blow_out" else DEFAULT_SPEED
+        if position is not None:
+            total += math.dist(position, target) / speed
+        position = target
+        total += ACTION_SECONDS[step[0]]
+    return total
+
+
+def labware_locator(reservoir, plate, tiprack):
+    def locate(step):
+        action = step[0]
+        if action in ("pick_up_tip", "drop_tip"):
+            point = tiprack[step[1]].top().point
+        elif action == "aspirate":
+            point = reservoir[step[2]].top().point
+        elif action == "dispense":
+            point = plate[step[2]].top().point
+        else:
+            point = reservoir["A1"].top(z=-5).point
+        return (point.x, point.y, point.z)
+
+    return locate
+
+
+def compare_plans(mixes, reservoir, plate, tiprack, reuse_tips=False):
+    """
+    Dry-run report of a batch against running the same mixes one command at
+    a time (in request order, each color's tip picked up from and returned to
+    its slot for every well).
+    """
+    locate = labware_locator(reservoir, plate, tiprack)
+    batch = plan_mixes(mixes, reuse_tips)
+    single = [step for mix in mixes for step in plan_mixes([mix], reuse_tips=False)]
+    batch_s = estimate_seconds(batch, locate)
+    single_s = estimate_seconds(single, locate, commands=len(mixes))
+    return {
+        "mixes": len(mixes),
+        "steps": len(batch),
+        "tip_pickups": sum(step[0] == "pick_up_tip" for step in batch),
+        "single_tip_pickups": sum(step[0] == "pick_up_tip" for step in single),
+        "estimated_s": round(batch_s, 1),
+        "single_estimated_s": round(single_s, 1),
+        "estimated_saved_s": round(single_s - batch_s, 1),
+    }
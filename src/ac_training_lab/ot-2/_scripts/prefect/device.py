@@ -1,8 +1,12 @@
 import json
+import sys
 
 import opentrons.simulate
 from prefect import flow, serve
 
+sys.path.append("..")
+from mix_planner import compare_plans, plan_mixes, run_plan  # noqa: E402
+
 # ------------------- OT-2 Setup -------------------
 protocol = opentrons.simulate.get_protocol_api("2.12")
 protocol.home()
@@ -59,6 +63,27 @@ def mix_color(R, Y, B, mix_well):
     print(f"Mixed R:{R}, Y:{Y}, B:{B} in well {mix_well}")
 
 
+@flow
+def mix_color_batch(mixes, reuse_tips=False, dry_run=False):
+    """
+    Mix several wells in one run, e.g. mixes=[{"R": 120, "Y": 50, "B": 80,
+    "well": "B2"}, ...]. The mixes are planned together (serpentine well
+    order). With reuse_tips, each color uses one tip for the whole batch
+    instead of a fresh tip per well. With dry_run, only the time estimate is
+    returned.
+    """
+    steps = plan_mixes(mixes, reuse_tips)
+    report = compare_plans(mixes, reservoir, plate, tiprack_1, reuse_tips)
+    if dry_run:
+        print(f"Dry run: {report}")
+        return report
+
+    protocol.home()  # one home for the whole batch
+    run_plan(steps, p300, reservoir, plate, tiprack_1)
+    print(f"Mixed {len(mixes)} wells: {[mix['well'] for mix in mixes]}")
+    return report
+
+
 @flow
 def move_sensor_to_measurement_position(mix_well):
     """Move sensor to measurement position"""
@@ -80,6 +105,7 @@ if __name__ == "__main__":
     # Serve mode: register to Prefect Cloud & listen for tasks
     serve(
         mix_color.to_deployment("mix-color"),
+        mix_color_batch.to_deployment("mix-color-batch"),
         move_sensor_to_measurement_position.to_deployment(
             "move-sensor-to-measurement-position"
         ),
@@ -0,0 +1,192 @@
+# Well status storage shared by DB_utls.py and well_status_utils.py
+
+import time
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+ROWS = ["A", "B", "C", "D", "E", "F", "G", "H"]
+COLUMNS = list(range(1, 13))
+
+# Seconds a cached list of unused wells is trusted. Writes through the same
+# repository clear it right away, this only bounds how long changes made by
+# another process (e.g. the local script vs. the HF space) go unnoticed.
+CACHE_TTL = 5
+# Seconds before wells reserved by a session that never confirmed or released
+# them become available again
+RESERVATION_TTL = 15 * 60
+
+
+def well_sort_key(well):
+    """Natural plate order: A1, A2, ..., A12, B1, ... (not A1, A10, A11, A2)."""
+    return (well[0], int(well[1:]))
+
+
+def plate_wells(rows=ROWS, columns=COLUMNS):
+    return [f"{row}{col}" for row in rows for col in columns]
+
+
+def well_order(plate, well):
+    """Position of a well across all plates, stored so the database can sort."""
+    row, col = well_sort_key(well)
+    return (plate * len(ROWS) + ROWS.index(row)) * len(COLUMNS) + col - 1
+
+
+class WellRepository:
+    """
+    Well status ("empty" / "used") of one project, stored one document per
+    well and plate in a MongoDB collection.
+
+    Writes go out as a single unordered bulk_write instead of one upsert per
+    well, and reads of the unused wells are cached until the next write. Any
+    pymongo-compatible collection works whose ``find_one_and_update`` honors
+    ``sort`` (mongomock 4.3 does not: it updates a different document than the
+    one it returns).
+
+    Clients that run concurrently should claim wells with ``reserve`` instead
+    of picking from ``unused``, then ``confirm`` (or ``release``) them.
+    """
+
+    def __init__(self, collection, project="OT2", plates=1):
+        self.collection = collection
+        self.project = project
+        self.plates = plates
+        self._unused = None
+        self._unused_at = 0.0
+        self._migrate()
+        # Makes the upserts below safe under concurrent writers
+        collection.create_index(
+            [("project", ASCENDING), ("plate", ASCENDING), ("well", ASCENDING)],
+            unique=True,
+        )
+        # Lets reserve() find the first free well without scanning the plate
+        collection.create_index(
+            [("project", ASCENDING), ("status", ASCENDING), ("order", ASCENDING)]
+        )
+
+    def _migrate(self):
+        # Documents written before plates were tracked belong to plate 1
+        documents = self.collection.find(
+            {"project": self.project, "order": {"$exists": False}}, {"well": 1}
+        )
+        requests = [
+            UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": {"plate": 1, "order": well_order(1, document["well"])}},
+            )
+            for document in documents
+        ]
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+    def _set_status(self, wells, status, plate):
+        requests = [
+            UpdateOne(
+                {"project": self.project, "plate": plate, "well": well},
+                {
+                    "$set": {
+                        "well": well,
+                        "plate": plate,
+                        "order": well_order(plate, well),
+                        "status": status,
+                        "project": self.project,
+                    },
+                    "$unset": {"reserved_by": "", "reserved_until": ""},
+                },
+                upsert=True,
+            )
+            for well in wells
+        ]
+        self._unused = None
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+    def reset(self, wells=None, plate=None):
+        """
+        Mark ``wells`` as empty, on ``plate`` or on every plate. By default
+        the whole of each plate is reset.
+        """
+        for each in range(1, self.plates + 1) if plate is None else [plate]:
+            self._set_status(plate_wells() if wells is None else wells, "empty", each)
+
+    def mark_used(self, wells, plate=1):
+        self._set_status(wells, "used", plate)
+
+    def _free(self, now):
+        return {
+            "project": self.project,
+            "status": "empty",
+            "$or": [
+                {"reserved_until": {"$exists": False}},
+                {"reserved_until": {"$lt": now}},
+            ],
+        }
+
+    def unused(self, plate=1):
+        """Return the empty, unreserved wells of ``plate`` in natural order."""
+        if self._unused is None or time.monotonic() - self._unused_at > CACHE_TTL:
+            documents = self.collection.find(
+                self._free(time.time()), {"well": 1, "plate": 1, "_id": 0}
+            )
+            self._unused = sorted(
+                (document["plate"], well_sort_key(document["well"]))
+                for document in documents
+            )
+            self._unused_at = time.monotonic()
+        return [f"{row}{col}" for each, (row, col) in self._unused if each == plate]
+
+    def reserve(self, n, session_id, ttl=RESERVATION_TTL):
+        """
+        Claim the first ``n`` free wells in plate order for ``session_id`` and
+        return them as ``[{"plate": 1, "well": "A1"}, ...]``.
+
+        Every claim is a single find_one_and_update, so concurrent sessions
+        never get the same well and nothing has to lock the whole plate.
+        Unconfirmed reservations expire after ``ttl`` seconds. Raises
+        ValueError (keeping nothing reserved) if fewer than ``n`` are free.
+        """
+        reserved = []
+        for _ in range(n):
+            now = time.time()
+            document = self.collection.find_one_and_update(
+                self._free(now),
+                {"$set": {"reserved_by": session_id, "reserved_until": now + ttl}},
+                sort=[("order", ASCENDING)],
+                projection={"plate": 1, "well": 1, "_id": 0},
+                return_document=ReturnDocument.AFTER,
+            )
+            if document is None:
+                self._release(session_id, reserved)
+                raise ValueError(
+                    f"Only {len(reserved)} empty wells available, {n} requested"
+                )
+            reserved.append(document)
+        self._unused = None
+        return reserved
+
+    def _release(self, session_id, wells=None):
+        query = {"project": self.project, "reserved_by": session_id}
+        if wells is not None:
+            if not wells:
+                return
+            query["$or"] = [
+                {"plate": well["plate"], "well": well["well"]} for well in wells
+            ]
+        self.collection.update_many(
+            query, {"$unset": {"reserved_by": "", "reserved_until": ""}}
+        )
+        self._unused = None
+
+    def release(self, session_id):
+        """Give back the wells ``session_id`` reserved but didn't use."""
+        self._release(session_id)
+
+    def confirm(self, session_id):
+        """Mark every well reserved by ``session_id`` as used."""
+        self.collection.update_many(
+            {"project": self.project, "reserved_by": session_id},
+            {
+                "$set": {"status": "used"},
+                "$unset": {"reserved_by": "", "reserved_until": ""},
+            },
+        )
+        self._unused = None
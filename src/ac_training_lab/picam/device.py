@@ -1,5 +1,10 @@
+import argparse
 import json
 import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
 
 import requests
 from my_secrets import (
@@ -11,13 +16,55 @@ from my_secrets import (
     WORKFLOW_NAME,
 )
 
+# Stream settings, from best to most conservative. The supervisor steps down
+# one profile after sustained frame drops.
+PROFILES = [
+    {"width": 854, "height": 480, "framerate": 15, "bitrate": 1000000},
+    {"width": 640, "height": 360, "framerate": 15, "bitrate": 600000},
+    {"width": 426, "height": 240, "framerate": 10, "bitrate": 300000},
+]
+# A profile is "dropping" when this fraction of frames is dropped, or when the
+# output fps falls below MIN_FPS_RATIO of the target, for DROP_WINDOW seconds.
+DROP_RATIO = 0.05
+MIN_FPS_RATIO = 0.8
+DROP_WINDOW = 30
+# Restart delay doubles after each run shorter than STABLE_AFTER seconds
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+STABLE_AFTER = 60
+# End and re-create the broadcast after this many short runs in a row, in case
+# the ingestion URL itself went stale
+RECREATE_AFTER = 3
+# ffmpeg writes a -progress block about twice a second. Without one for this
+# many seconds it is considered stalled and the pipeline is restarted.
+STALL_TIMEOUT = 20
+METRICS_PORT = 8000  # stream stats as JSON on http://<pi>:METRICS_PORT/
 
-def start_stream(ffmpeg_url):
+
+def start_stream(ffmpeg_url, profile=PROFILES[0], test_source=False):
     """
     Starts the libcamera -> ffmpeg pipeline and returns two Popen objects:
-      p1: libcamera-vid process
-      p2: ffmpeg process
+      p1: libcamera-vid process (None with test_source)
+      p2: ffmpeg process, writing -progress key=value blocks to its stdout
+
+    With test_source, ffmpeg encodes a synthetic lavfi testsrc instead, so the
+    pipeline can be exercised without a camera attached.
     """
+    if test_source:
+        size = f"{profile['width']}x{profile['height']}"
+        video_input = [
+            "-re",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc=size={size}:rate={profile['framerate']}",
+        ]
+        video_codec = ["-c:v", "libx264", "-b:v", str(profile["bitrate"])]
+    else:
+        # Read H.264 video from pipe and copy it directly
+        video_input = ["-i", "pipe:0"]
+        video_codec = ["-c:v", "copy"]
+
     # First: libcamera-vid command with core parameters
     libcamera_cmd = [
         "libcamera-vid",
@@ -28,15 +75,15 @@ def start_stream(ffmpeg_url):
         "--mode",
         "1536:864",  # A known 16:9 sensor mode
         "--width",
-        "854",  # Scale width
+        str(profile["width"]),  # Scale width
         "--height",
-        "480",  # Scale height
+        str(profile["height"]),  # Scale height
         "--framerate",
-        "15",  # Frame rate
+        str(profile["framerate"]),  # Frame rate
         "--codec",
         "h264",  # H.264 encoding
         "--bitrate",
-        "1000000",  # ~1 Mbps video
+        str(profile["bitrate"]),
     ]
 
     # Add flip parameters if needed
@@ -51,6 +98,8 @@ def start_stream(ffmpeg_url):
     # Second: ffmpeg command
     ffmpeg_cmd = [
         "ffmpeg",
+        # Overwrite a local --output file on restart instead of prompting
+        "-y",
         # Generate silent audio source
         "-f",
         "lavfi",
@@ -61,12 +110,8 @@ def start_stream(ffmpeg_url):
         "1024",
         "-use_wallclock_as_timestamps",
         "1",
-        # Read H.264 video from pipe
-        "-i",
-        "pipe:0",
-        # Copy the H.264 video directly
-        "-c:v",
-        "copy",
+        *video_input,
+        *video_codec,
         # Encode audio as AAC
         "-c:a",
         "aac",
@@ -76,19 +121,31 @@ def start_stream(ffmpeg_url):
         "fast",
         "-strict",
         "experimental",
+        # Machine-readable stats on stdout instead of the stderr status line
+        "-progress",
+        "pipe:1",
+        "-nostats",
         # Output format is FLV, then final RTMP URL
         "-f",
         "flv",
         ffmpeg_url,
     ]
 
+    if test_source:
+        p2 = subprocess.Popen(
+            ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True
+        )
+        return None, p2
+
     # Start libcamera-vid, capturing its output in a pipe
     p1 = subprocess.Popen(
         libcamera_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
     )
 
     # Start ffmpeg, reading from p1's stdout
-    p2 = subprocess.Popen(ffmpeg_cmd, stdin=p1.stdout, stderr=subprocess.STDOUT)
+    p2 = subprocess.Popen(
+        ffmpeg_cmd, stdin=p1.stdout, stdout=subprocess.PIPE, text=True
+    )
 
     # Close p1's stdout in the parent process
     p1.stdout.close()
@@ -96,6 +153,190 @@ def start_stream(ffmpeg_url):
     return p1, p2
 
 
+def parse_progress(lines):
+    """
+    Yields one dict per ffmpeg -progress block, e.g.
+    {"frame": 300, "fps": 15.0, "bitrate_kbps": 998.1, "drop_frames": 0, ...}
+    """
+    block = {}
+    for line in lines:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        value = value.strip()
+        if key in ("frame", "drop_frames", "dup_frames", "total_size"):
+            block[key] = int(value) if value.isdigit() else 0
+        elif key == "fps":
+            block[key] = float(value or 0)
+        elif key == "bitrate":
+            # "998.1kbits/s", or "N/A" before the first packet
+            number = value.removesuffix("kbits/s")
+            block["bitrate_kbps"] = float(number) if number != "N/A" else 0.0
+        elif key == "speed":
+            number = value.removesuffix("x")
+            block[key] = float(number) if number != "N/A" else 0.0
+        elif key == "progress":
+            block[key] = value
+            yield block
+            block = {}
+
+
+class StreamSupervisor:
+    """
+    Keeps the stream running: restarts it with exponential backoff, steps
+    down through PROFILES on sustained frame drops, and keeps the latest
+    ffmpeg stats in self.stats for the metrics endpoint.
+    """
+
+    def __init__(
+        self,
+        get_url,
+        profiles=PROFILES,
+        test_source=False,
+        stall_timeout=STALL_TIMEOUT,
+    ):
+        self.get_url = get_url  # called for a (new) ingestion URL
+        self.profiles = profiles
+        self.test_source = test_source
+        self.stall_timeout = stall_timeout
+        self.profile_index = 0
+        self.backoff = MIN_BACKOFF
+        self.lock = threading.Lock()
+        self.stats = {"state": "starting", "restarts": 0, "profile": profiles[0]}
+
+    def update(self, **stats):
+        with self.lock:
+            self.stats.update(stats)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def run(self):
+        ffmpeg_url = self.get_url()
+        short_runs = 0
+        while True:
+            profile = self.profiles[self.profile_index]
+            print(f"Starting stream with profile {profile}..")
+            started = time.monotonic()
+            p1, p2 = start_stream(ffmpeg_url, profile, self.test_source)
+            self.update(state="streaming", profile=profile, started=time.time())
+            print("Stream started")
+            try:
+                can_step_down = self.profile_index < len(self.profiles) - 1
+                degraded = self.watch(p2, profile, can_step_down)
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                print(e)
+                degraded = False
+            finally:
+                print("Terminating processes..")
+                for process in (p1, p2):
+                    if process is not None:
+                        process.terminate()
+                        try:
+                            process.wait(timeout=5)
+                        except subprocess.TimeoutExpired:
+                            process.kill()  # e.g. stuck on a dead connection
+                            process.wait()
+                print("Processes terminated.")
+
+            with self.lock:
+                self.stats["restarts"] += 1
+
+            if degraded:
+                self.profile_index += 1
+                print(
+                    f"Sustained frame drops, switching to profile {self.profile_index}"
+                )
+                continue
+
+            if time.monotonic() - started >= STABLE_AFTER:
+                self.backoff = MIN_BACKOFF
+                short_runs = 0
+            else:
+                short_runs += 1
+                if short_runs >= RECREATE_AFTER:
+                    try:
+                        ffmpeg_url = self.get_url()
+                        short_runs = 0
+                    except RuntimeError as e:
+                        print(f"Could not re-create broadcast: {e}")
+
+            self.update(state="backoff", backoff_s=self.backoff)
+            print(f"Retrying in {self.backoff} s..")
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def watch(self, p2, profile, can_step_down=True):
+        """
+        Reads ffmpeg progress until it exits, or until no progress arrived
+        for stall_timeout seconds. Returns True if it was stopped because
+        frames were being dropped for DROP_WINDOW seconds (only when there is
+        a lower profile to switch to).
+        """
+        # Read on a thread, a stalled ffmpeg blocks the read without exiting
+        blocks = Queue()
+
+        def read():
+            for block in parse_progress(p2.stdout):
+                blocks.put(block)
+            blocks.put(None)
+
+        threading.Thread(target=read, daemon=True).start()
+
+        last = None
+        dropping_since = None
+        while True:
+            try:
+                block = blocks.get(timeout=self.stall_timeout)
+            except Empty:
+                print(f"No ffmpeg progress for {self.stall_timeout} s, restarting")
+                self.update(state="stalled")
+                return False
+            if block is None:
+                break
+            now = time.monotonic()
+            self.update(**block)
+            if last is not None:
+                frames = block.get("frame", 0) - last.get("frame", 0)
+                dropped = block.get("drop_frames", 0) - last.get("drop_frames", 0)
+                dropping = (
+                    dropped > DROP_RATIO * max(frames + dropped, 1)
+                    or block.get("fps", 0) < MIN_FPS_RATIO * profile["framerate"]
+                )
+                if not dropping:
+                    dropping_since = None
+                elif dropping_since is None:
+                    dropping_since = now
+                elif now - dropping_since >= DROP_WINDOW and can_step_down:
+                    return True
+            last = block
+        p2.wait()
+        return False
+
+
+def serve_metrics(supervisor, port=METRICS_PORT):
+    """Serves supervisor.snapshot() as JSON on a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(supervisor.snapshot()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # don't print a line per scrape
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
 def call_lambda(action, CAM_NAME, WORKFLOW_NAME, privacy_status="private"):
     payload = {
         "action": action,
@@ -131,8 +372,8 @@ def call_lambda(action, CAM_NAME, WORKFLOW_NAME, privacy_status="private"):
         raise RuntimeError(f"Failed to decode Lambda response: {e}")
 
 
-if __name__ == "__main__":
-    # End previous broadcast and start a new one via Lambda
+def create_broadcast():
+    """End the previous broadcast, start a new one and return its ffmpeg URL."""
     call_lambda("end", CAM_NAME, WORKFLOW_NAME)
     raw_body = call_lambda(
         "create", CAM_NAME, WORKFLOW_NAME, privacy_status=PRIVACY_STATUS
@@ -146,19 +387,29 @@ if __name__ == "__main__":
         )
 
     print(f"Streaming to: {ffmpeg_url}")
+    return ffmpeg_url
 
-    while True:
-        print("Starting stream..")
-        p1, p2 = start_stream(ffmpeg_url)
-        print("Stream started")
-        try:
-            p2.wait()
-        except KeyboardInterrupt:
-            pass
-        except Exception as e:
-            print(e)
-        finally:
-            print("Terminating processes..")
-            p1.terminate()
-            p2.terminate()
-            print("Processes terminated. Retrying..")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--test-source",
+        action="store_true",
+        help="stream a synthetic lavfi testsrc instead of the camera",
+    )
+    parser.add_argument(
+        "--output",
+        help="FLV output URL or file, instead of creating a broadcast via Lambda",
+    )
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT)
+    args = parser.parse_args()
+
+    if args.output:
+        supervisor = StreamSupervisor(lambda: args.output, test_source=args.test_source)
+    else:
+        supervisor = StreamSupervisor(create_broadcast, test_source=args.test_source)
+    serve_metrics(supervisor, args.metrics_port)
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
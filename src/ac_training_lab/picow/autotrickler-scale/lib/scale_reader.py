@@ -0,0 +1,191 @@
+"""
+Non-blocking reader for RS-232 lab scales, shared by autotrickler-scale/main.py
+(A&D FX-120i) and us-solid/_scripts/main.py (US Solid).
+
+Lines are read with an asyncio stream as they arrive, so waiting for the scale
+never blocks the event loop (and with it the MQTT keepalives). The scale
+either streams readings on its own (``continuous``, e.g. ``b"SIR\\r\\n"`` on
+A&D scales, sent again after ``resend_after`` seconds without a line in case
+the scale was power cycled) or is polled with ``query`` every
+``poll_interval`` seconds. Readings are coalesced until ``take()`` is called,
+e.g. once per publish.
+
+Only ``asyncio`` is used, so this also runs on CPython with any object that
+has an async ``readline()`` in place of the UART stream:
+
+    uart = machine.UART(1, baudrate=9600, tx=machine.Pin(4), rx=machine.Pin(5))
+    scale = ScaleReader(asyncio.StreamReader(uart), asyncio.StreamWriter(uart, {}))
+    asyncio.create_task(scale.run())
+    ...
+    window = scale.take()  # {"last": 12.34, "min": ..., "stable": True, ...}
+"""
+
+import asyncio
+
+NUMBER_CHARS = "+-0123456789."
+
+
+class Reading:
+    def __init__(self, weight, unit, stable, text):
+        self.weight = weight
+        self.unit = unit
+        self.stable = stable  # None if the scale doesn't say
+        self.text = text  # the value as sent, e.g. "+00012.34  g"
+
+
+def parse_line(line):
+    """
+    Parse a scale output line such as ``b"ST,+00012.34  g\\r\\n"`` (A&D: ST
+    stable, US unstable) or ``b"  12.345 g"``. Returns a Reading, or None for
+    lines without a weight (e.g. OL overload or a command acknowledgement).
+    """
+    if isinstance(line, bytes):
+        try:
+            line = line.decode("utf-8")
+        except UnicodeError:
+            return None
+    fields = line.strip().split(",")
+    headers = [field.strip().upper() for field in fields[:-1]]
+    text = fields[-1].strip()
+    if "OL" in headers:  # overload, the value is only a placeholder
+        return None
+
+    value = text.replace(" ", "")
+    end = 0
+    while end < len(value) and value[end] in NUMBER_CHARS:
+        end += 1
+    try:
+        weight = float(value[:end])
+    except ValueError:
+        return None
+
+    if "ST" in headers:
+        stable = True
+    elif "US" in headers:
+        stable = False
+    else:
+        stable = None
+    return Reading(weight, value[end:], stable, text)
+
+
+class ReadingWindow:
+    """
+    Readings received between two publishes, all in one unit. A reading in
+    another unit (e.g. after switching the scale from g to PC) starts the
+    window over, so counts never end up in a gram min/max.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.last = None
+        self.minimum = None
+        self.maximum = None
+        self.stable = True  # every reading flagged stable
+        self.flagged = True  # every reading had a stability flag
+
+    def add(self, reading):
+        if self.count and reading.unit != self.last.unit:
+            self.reset()
+        weight = reading.weight
+        if self.count == 0:
+            self.minimum = self.maximum = weight
+        else:
+            self.minimum = min(self.minimum, weight)
+            self.maximum = max(self.maximum, weight)
+        self.count += 1
+        self.last = reading
+        if reading.stable is None:
+            self.flagged = False
+        elif not reading.stable:
+            self.stable = False
+
+    def summary(self, tolerance):
+        """
+        ``stable`` is the scale's own flag when every reading carried one,
+        otherwise whether the readings stayed within ``tolerance``.
+        """
+        if self.flagged:
+            stable = self.stable
+        else:
+            stable = self.maximum - self.minimum <= tolerance
+        return {
+            "last": self.last.weight,
+            "min": self.minimum,
+            "max": self.maximum,
+            "unit": self.last.unit,
+            "text": self.last.text,
+            "readings": self.count,
+            "stable": stable,
+        }
+
+
+class ScaleReader:
+    def __init__(
+        self,
+        reader,
+        writer=None,
+        query=b"Q\r\n",
+        continuous=None,
+        poll_interval=0.2,
+        tolerance=0.0,
+        resend_after=5.0,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.query = query
+        self.continuous = continuous
+        self.poll_interval = poll_interval
+        self.tolerance = tolerance
+        self.resend_after = resend_after
+        self.window = ReadingWindow()
+        self.lines = 0  # every line received, parsed or not
+
+    async def _send(self, command):
+        self.writer.write(command)
+        await self.writer.drain()
+
+    async def _poll(self):
+        while True:
+            await self._send(self.query)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _stream(self):
+        while True:
+            await self._send(self.continuous)
+            # A scale that was switched off and on again is back in its
+            # default mode, silent until told to stream
+            lines = -1
+            while lines != self.lines:
+                lines = self.lines
+                await asyncio.sleep(self.resend_after)
+
+    async def run(self):
+        """Read lines until the stream ends, polling if not continuous."""
+        poller = None
+        if self.writer is not None:
+            if self.continuous is not None:
+                poller = asyncio.create_task(self._stream())
+            elif self.query is not None:
+                poller = asyncio.create_task(self._poll())
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+                self.lines += 1
+                reading = parse_line(line)
+                if reading is not None:
+                    self.window.add(reading)
+        finally:
+            if poller is not None:
+                poller.cancel()
+
+    def take(self):
+        """Summary of the readings since the last call, or None if none."""
+        window, self.window = self.window, ReadingWindow()
+        if window.count == 0:
+            return None
+        return window.summary(self.tolerance)
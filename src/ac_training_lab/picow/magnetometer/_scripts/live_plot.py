@@ -0,0 +1,172 @@
+"""
+Live plot of magnetometer samples, shared by orchestrator.py (MQTT) and
+plot_data.py (serial).
+
+Samples are scaled and smoothed once, as they arrive, into a fixed-size NumPy
+ring buffer. The figure is redrawn at a fixed frame rate, independent of how
+fast samples come in, by updating the existing scatter and line artists
+instead of clearing the axes and plotting every segment again.
+"""
+
+import threading
+
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.animation import FuncAnimation
+
+WINDOW_SECONDS = 10  # how much history is shown
+CAPACITY = 50000  # samples kept, WINDOW_SECONDS at up to 5 kHz
+FPS = 10
+MAX_POINTS = 500  # drawn per frame, longer windows are evenly thinned out
+
+POINT_COLOR = "red"
+LINE_COLOR = np.array([0, 0, 1, 1])
+
+
+def inverse_sqrt(values):
+    """1 / sqrt(|v|) elementwise, and 0 where v is 0."""
+    magnitude = np.abs(values)
+    return np.divide(
+        1.0,
+        np.sqrt(magnitude),
+        out=np.zeros_like(magnitude, dtype=float),
+        where=magnitude != 0,
+    )
+
+
+class RingBuffer:
+    """The last ``capacity`` rows of a 2D float array."""
+
+    def __init__(self, capacity, columns):
+        self.data = np.zeros((capacity, columns))
+        self.start = 0
+        self.size = 0
+
+    def extend(self, rows):
+        capacity = len(self.data)
+        rows = rows[-capacity:]
+        n = len(rows)
+        end = (self.start + self.size) % capacity
+        first = min(n, capacity - end)
+        self.data[end : end + first] = rows[:first]
+        self.data[: n - first] = rows[first:]
+        overwritten = max(0, self.size + n - capacity)
+        self.start = (self.start + overwritten) % capacity
+        self.size = min(capacity, self.size + n)
+
+    def view(self):
+        """The rows, oldest first (a copy if they wrap around the end)."""
+        end = self.start + self.size
+        if end <= len(self.data):
+            return self.data[self.start : end]
+        return np.concatenate(
+            (self.data[self.start :], self.data[: end - len(self.data)])
+        )
+
+
+class MovingAverage:
+    """
+    Moving average over the last ``window`` rows, computed only for the new
+    rows of each update. Like ``np.convolve(..., mode="valid")``, there is no
+    output until a full window has been seen, and each average is timed by
+    the newest row in its window.
+    """
+
+    def __init__(self, window, columns):
+        self.window = window
+        self.values = np.empty((0, columns))
+        self.times = np.empty(0)
+
+    def update(self, values, times):
+        values = np.concatenate((self.values, values))
+        times = np.concatenate((self.times, times))
+        keep = len(values) - self.window + 1
+        # The rows the next update still needs
+        self.values = values[max(keep, 0) :]
+        self.times = times[max(keep, 0) :]
+        if keep <= 0:
+            return values[:0], times[:0]
+        cumsum = np.cumsum(values, axis=0)
+        sums = cumsum[self.window - 1 :].copy()
+        sums[1:] -= cumsum[: -self.window]
+        return sums / self.window, times[self.window - 1 :]
+
+
+class LivePlot:
+    """
+    3D path of the scaled field (top) and the estimated distance over time
+    (bottom) of the last ``window_seconds``. ``add`` can be called from any
+    thread, e.g. an MQTT callback, while ``show`` runs the render loop.
+    """
+
+    def __init__(
+        self,
+        averaging_window=3,
+        window_seconds=WINDOW_SECONDS,
+        capacity=CAPACITY,
+    ):
+        self.window_seconds = window_seconds
+        self.average = MovingAverage(averaging_window, 3)
+        self.buffer = RingBuffer(capacity, 4)  # scaled x, y, z and time
+        self.lock = threading.Lock()
+        self.start_time = None
+
+        self.figure = plt.figure(figsize=(10, 8))
+        self.ax1 = self.figure.add_subplot(211, projection="3d")
+        self.ax2 = self.figure.add_subplot(212)
+        self.points = self.ax1.scatter([], [], [], color=POINT_COLOR, s=20)
+        (self.path,) = self.ax1.plot([], [], [], color=LINE_COLOR)
+        (self.distance,) = self.ax2.plot([], [], "-o", color="blue")
+        self.ax2.set_ylim(0, 1.1)  # Set fixed y-axis limits
+        self.ax2.set_xlabel("Time (s)")
+        self.ax2.set_ylabel("Distance (rel. units)")
+        self.ax2.set_title("Estimated Distance over Time")
+        self.animation = None
+
+    def add(self, samples):
+        """Add an (n, 4) array of X, Y, Z (uT) and time (s) rows."""
+        if not len(samples):
+            return
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = samples[0, 3]
+            averaged, times = self.average.update(
+                inverse_sqrt(samples[:, :3]), samples[:, 3]
+            )
+            self.buffer.extend(np.column_stack((averaged, times - self.start_time)))
+
+    def render(self):
+        """Update the artists with the current window, without drawing."""
+        with self.lock:
+            rows = self.buffer.view()
+            if not len(rows):
+                return
+            rows = rows[rows[:, 3] >= rows[-1, 3] - self.window_seconds]
+            # Keep the newest row, the screen can't show more points anyway
+            step = -(-len(rows) // MAX_POINTS)
+            rows = rows[::-1][::step][::-1].copy()
+        xs, ys, zs, ts = rows.T
+
+        self.points._offsets3d = (xs, ys, zs)
+        self.path.set_data_3d(xs, ys, zs)
+        for set_lim, values in (
+            (self.ax1.set_xlim, xs),
+            (self.ax1.set_ylim, ys),
+            (self.ax1.set_zlim, zs),
+        ):
+            low, high = values.min(), values.max()
+            margin = (high - low) * 0.05 or 0.01
+            set_lim(low - margin, high + margin)
+
+        self.distance.set_data(ts, np.sqrt(xs**2 + ys**2 + zs**2))
+        self.ax2.set_xlim(ts[0], max(ts[-1], ts[0] + 1e-3))
+
+    def show(self, fps=FPS):
+        """Redraw ``fps`` times per second until the window is closed."""
+        self.animation = FuncAnimation(
+            self.figure,
+            lambda frame: self.render(),
+            interval=1000 / fps,
+            cache_frame_data=False,
+        )
+        plt.show()
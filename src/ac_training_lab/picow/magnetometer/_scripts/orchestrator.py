@@ -1,10 +1,12 @@
+import argparse
 import json
-import re
+import struct
 import time
 
 import matplotlib.pyplot as plt
 import numpy as np
 import paho.mqtt.client as mqtt
+from live_plot import FPS, LivePlot
 
 HIVEMQ_USERNAME = "sgbaird"
 HIVEMQ_PASSWORD = "D.Pq5gYtejYbU#L"
@@ -18,18 +20,77 @@ sensor_data_topic = (
 )
 # CA_CERT = "hivemq-com-chain.der"  # Path to your CA certificate
 
+# Binary sensor_data layout, see pack_batch in ../main.py
+TELEMETRY_VERSION = 1
+HEADER_FORMAT = "<BHHHQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
 averaging_window = 3  # Number of data points to include in the moving average
-data = []
 
-# Matplotlib setup
-fig = plt.figure(figsize=(10, 8))
-ax1 = fig.add_subplot(211, projection="3d")
-ax2 = fig.add_subplot(212)
-plt.ion()
 
-point_color = "red"
-line_base_color = np.array([0, 0, 1, 1])
-start_time = time.time()
+def decode_sensor_data(payload, received=None):
+    """
+    Samples of a sensor_data message as an (n, 4) array of X, Y, Z (uT) and
+    sample time (epoch seconds) rows. Older JSON messages (a list of {"X",
+    "Y", "Z"} dicts) carry no time, so ``received`` (default now) is used.
+    """
+    if payload[:1] == b"[":
+        entries = json.loads(payload.decode("utf-8"))
+        received = time.time() if received is None else received
+        return np.array(
+            [[entry["X"], entry["Y"], entry["Z"], received] for entry in entries],
+            dtype=float,
+        ).reshape(-1, 4)
+
+    version, count, sequence, dropped, base_ms = struct.unpack_from(
+        HEADER_FORMAT, payload
+    )
+    if version != TELEMETRY_VERSION:
+        raise ValueError(f"Unsupported telemetry version {version}")
+    deltas = np.frombuffer(payload, "<u2", count, HEADER_SIZE)
+    values = np.frombuffer(payload, "<f4", 3 * count, HEADER_SIZE + 2 * count)
+    times = (base_ms + np.cumsum(deltas, dtype=np.int64)) / 1000
+    if dropped:
+        print(f"Batch {sequence}: {dropped} samples dropped on the device")
+    return np.column_stack((values.reshape(count, 3), times))
+
+
+def benchmark(directory, fps=FPS):
+    """
+    Replay the sensor_data messages recorded in directory (see
+    ac_training_lab.mqtt_recorder) through decoding, filtering and rendering as fast as
+    possible, without a display, and report the sustained sample rate. A frame
+    is rendered every 1 / fps s of recorded time, like the live plot would.
+    """
+    # Only needed for --record and --benchmark, so the live plot works without
+    # ac_training_lab installed
+    from ac_training_lab.mqtt_recorder import read_messages
+
+    plt.switch_backend("Agg")
+    plot = LivePlot(averaging_window)
+    samples = frames = 0
+    first_time = next_frame = None
+    start = time.perf_counter()
+    for message in read_messages(directory, [sensor_data_topic]):
+        sensor_data = decode_sensor_data(message.payload, message.time)
+        plot.add(sensor_data)
+        samples += len(sensor_data)
+        if first_time is None and len(sensor_data):
+            first_time = sensor_data[0, 3]
+        if len(sensor_data) and (
+            next_frame is None or sensor_data[-1, 3] >= next_frame
+        ):
+            plot.render()
+            plot.figure.canvas.draw()
+            frames += 1
+            next_frame = sensor_data[-1, 3] + 1 / fps
+    elapsed = time.perf_counter() - start
+    recorded = next_frame - 1 / fps - first_time if frames else 0
+    print(
+        f"{samples} samples and {frames} frames in {elapsed:.2f} s: "
+        f"{samples / elapsed:.0f} samples/s sustained, "
+        f"{recorded / elapsed:.1f}x the recorded {recorded:.1f} s"
+    )
 
 
 # The callback for when the client receives a CONNACK response from the server.
@@ -42,89 +103,55 @@ def on_connect(client, userdata, flags, rc, properties=None):
 
 
 def on_message(client, userdata, msg):
-    global data
-    payload = msg.payload.decode("utf-8")
-    sensor_data = json.loads(payload)
-
-    for entry in sensor_data:
-        magx = entry["X"]
-        magy = entry["Y"]
-        magz = entry["Z"]
-
-        net_magnitude = np.sqrt(magx**2 + magy**2 + magz**2)
-        scaled_distance = 1 / np.sqrt(net_magnitude) if net_magnitude != 0 else 0
-
-        current_time = time.time()
-        elapsed_time = current_time - start_time
-
-        data.append(
-            (
-                1 / np.sqrt(abs(magx)) if magx != 0 else 0,
-                1 / np.sqrt(abs(magy)) if magy != 0 else 0,
-                1 / np.sqrt(abs(magz)) if magz != 0 else 0,
-                elapsed_time,
-            )
+    received = time.time()
+    if userdata["recorder"] is not None:
+        userdata["recorder"].record(
+            msg.topic, msg.payload, msg.qos, msg.retain, received
         )
-
-        # Print the received data for debugging
-        print(f"Received data: X={magx}, Y={magy}, Z={magz}, Time={elapsed_time}")
-
-        # Filter old data
-        data = [(x, y, z, t) for x, y, z, t in data if elapsed_time - t <= 10]
-
-        # Averaging
-        xs, ys, zs, ts = zip(*data)
-        if len(data) > averaging_window:
-            xs = np.convolve(
-                xs, np.ones(averaging_window) / averaging_window, mode="valid"
-            )
-            ys = np.convolve(
-                ys, np.ones(averaging_window) / averaging_window, mode="valid"
-            )
-            zs = np.convolve(
-                zs, np.ones(averaging_window) / averaging_window, mode="valid"
-            )
-            ts = ts[
-                -len(xs) :
-            ]  # Adjust time array to match the length of averaged arrays
-
-        # 3D plot updates with averaged values
-        ax1.clear()
-        ax1.scatter(xs, ys, zs, color=point_color, s=20)
-
-        for i in range(len(xs) - 1):
-            ax1.plot(
-                [xs[i], xs[i + 1]],
-                [ys[i], ys[i + 1]],
-                [zs[i], zs[i + 1]],
-                color=line_base_color,
-            )
-
-        # Calculate and average distance
-        distances = [np.sqrt(x**2 + y**2 + z**2) for x, y, z in zip(xs, ys, zs)]
-        ax2.clear()
-        ax2.plot(ts, distances, "-o", color="blue")
-        ax2.set_ylim(0, 1.1)  # Set fixed y-axis limits
-        ax2.set_xlabel("Time (s)")
-        ax2.set_ylabel("Distance (rel. units)")
-        ax2.set_title("Estimated Distance over Time")
-
-        plt.pause(0.01)
-
-
-client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
-client.username_pw_set(HIVEMQ_USERNAME, HIVEMQ_PASSWORD)
-# client.tls_set(CA_CERT)
-client.tls_set(tls_version=mqtt.ssl.PROTOCOL_TLS_CLIENT)
-client.on_connect = on_connect
-client.on_message = on_message
-
-client.connect(HIVEMQ_HOST, PORT, 60)
-
-try:
-    client.loop_forever()
-except KeyboardInterrupt:
-    print("Exiting...")
-finally:
-    plt.ioff()
-    plt.show()
+    userdata["plot"].add(decode_sensor_data(msg.payload, received))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--record", metavar="DIR", help="also record the messages to this directory"
+    )
+    parser.add_argument(
+        "--benchmark",
+        metavar="DIR",
+        help="replay a recording headless and report samples/s, then exit",
+    )
+    parser.add_argument("--fps", type=float, default=FPS, help="plot frame rate")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.fps)
+        raise SystemExit
+
+    recorder = None
+    if args.record:
+        from ac_training_lab.mqtt_recorder import Recorder
+
+        recorder = Recorder(args.record)
+    userdata = {"plot": LivePlot(averaging_window), "recorder": recorder}
+    client = mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5, userdata=userdata
+    )
+    client.username_pw_set(HIVEMQ_USERNAME, HIVEMQ_PASSWORD)
+    # client.tls_set(CA_CERT)
+    client.tls_set(tls_version=mqtt.ssl.PROTOCOL_TLS_CLIENT)
+    client.on_connect = on_connect
+    client.on_message = on_message
+
+    client.connect(HIVEMQ_HOST, PORT, 60)
+
+    # MQTT runs on its own thread, the plot redraws at a fixed rate meanwhile
+    client.loop_start()
+    try:
+        userdata["plot"].show(args.fps)
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        client.loop_stop()
+        if userdata["recorder"] is not None:
+            userdata["recorder"].close()
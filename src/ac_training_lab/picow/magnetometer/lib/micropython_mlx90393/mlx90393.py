@@ -23,6 +23,7 @@ This library depends on Micropython
 
 import struct
 import time
+from array import array
 
 from micropython import const
 
@@ -163,12 +164,26 @@ class RegisterStructCMD:
         obj._status_last = data[0]
 
 
+_CMD_SB = const(0b00010000)
+_CMD_SW = const(0b00100000)
 _CMD_RR = const(0b01010000)
 _CMD_WR = const(0b01100000)
 _CMD_SM = const(0b00110000)
 _CMD_RM = const(0b01000000)
+_CMD_EX = const(0b10000000)
 _CMD_AXIS_ALL = const(0xE)
 _REG_WHOAMI = const(0x0C)
+_STATUS_ERROR = const(0x10)
+
+# Fixed part of the conversion time (standby and active phases), in us
+_TCONV_OVERHEAD = const(493)
+# Burst data rate register step, in us
+_BURST_RATE_STEP = const(20000)
+
+# Measurement modes
+MODE_SINGLE = const(0)
+MODE_BURST = const(1)
+MODE_WAKE_ON_CHANGE = const(2)
 
 # Gain settings
 GAIN_5X = const(0x00)
@@ -270,17 +285,6 @@ class MLX90393:
         1: (10.137, 8.109, 6.082, 5.068, 4.055, 3.379, 2.703, 2.027),
     }
 
-    _TCONV = (
-        (1.27, 1.84, 3.00, 5.30),
-        (1.46, 2.23, 3.76, 6.84),
-        (1.84, 3.00, 5.30, 9.91),
-        (2.61, 4.53, 8.37, 16.05),
-        (4.15, 7.60, 14.52, 28.34),
-        (7.22, 13.75, 26.80, 52.92),
-        (13.36, 26.04, 51.38, 102.07),
-        (25.65, 50.61, 100.53, 200.37),
-    )
-
     _resolutionsxy = {0: _res0_xy, 1: _res1_xy, 2: _res2_xy, 3: _res3_xy}
     _resolutionsz = {0: _res0_z, 1: _res1_z, 2: _res2_z, 3: _res3_z}
 
@@ -306,14 +310,74 @@ class MLX90393:
     _res_y = CBits(2, 0x02, 7, 2, False, _CMD_RR, _CMD_WR)
     _res_z = CBits(2, 0x02, 9, 2, False, _CMD_RR, _CMD_WR)
 
-    def __init__(self, i2c, address=0x0C):
+    # Register 0x01
+    #  BURST_DATA_RATE(5:0) | BURST_SEL(9:6) | TCMP_EN(10) | EXT_TRIG(11) | WOC_DIFF(12) | ...
+    _burst_data_rate = CBits(6, 0x01, 0, 2, False, _CMD_RR, _CMD_WR)
+    _woc_diff = CBits(1, 0x01, 12, 2, False, _CMD_RR, _CMD_WR)
+
+    # Wake-up on change thresholds, in LSB
+    _woxy_threshold = RegisterStructCMD(0x07, "H", _CMD_RR, _CMD_WR)
+    _woz_threshold = RegisterStructCMD(0x08, "H", _CMD_RR, _CMD_WR)
+
+    def __init__(self, i2c, address=0x0C, int_pin=None):
         self._i2c = i2c
         self._address = address
+        self._int_pin = int_pin
         self._status_last = None
+        self._mode = MODE_SINGLE
+        self._period_us = 0
+        self._next_us = 0
+
+        # Reused for every command and measurement, so reads don't allocate
+        self._command_buffer = bytearray(1)
+        self._status_buffer = bytearray(1)
+        self._data_buffer = bytearray(7)
+        self._sample = array("f", (0.0, 0.0, 0.0))
+
         self._res_x = self._res_y = self._res_z = RESOLUTION_3
         self._digfilt = FILTER_7
         self._oversampling = OSR_3
         self._gain = GAIN_1X
+        self._update_settings()
+
+    def _update_settings(self):
+        """
+        Read back the settings a measurement depends on, so that reading a
+        sample doesn't have to query the configuration registers each time.
+        Called again by every setter.
+        """
+        hallconf_index = 0 if self._hall == 12 else 1
+        gain = self._gain
+        self._resolution = (self._res_x, self._res_y, self._res_z)
+        self._scale = (
+            self._resolutionsxy[self._resolution[0]][hallconf_index][gain],
+            self._resolutionsxy[self._resolution[1]][hallconf_index][gain],
+            self._resolutionsz[self._resolution[2]][hallconf_index][gain],
+        )
+        # 10 % margin over the nominal conversion time
+        self._conversion_us = (
+            self.conversion_time_us(self._digfilt, self._oversampling) * 11 // 10
+        )
+
+    @staticmethod
+    def conversion_time_us(digital_filter, oversampling, axes=3):
+        """
+        Nominal time in microseconds to convert ``axes`` magnetic axes with the
+        given `digital_filter` and `oversampling` settings, from the datasheet:
+        67 + 64 * 2^OSR * (2 + 2^DIG_FILT) us per axis, plus the fixed standby
+        and active phases. For example 200 ms with FILTER_7 and OSR_3 and
+        1.27 ms with FILTER_0 and OSR_0.
+        """
+        per_axis = 67 + 64 * (1 << oversampling) * (2 + (1 << digital_filter))
+        return axes * per_axis + _TCONV_OVERHEAD
+
+    @property
+    def scale(self):
+        """
+        The X, Y, Z sensitivities in µT/LSB for the current `gain` and
+        resolutions, to convert the values of ``read_into(buf, raw=True)``.
+        """
+        return self._scale
 
     @property
     def gain(self):
@@ -341,6 +405,7 @@ class MLX90393:
         if value not in range(1, 8):
             raise ValueError("Invalid GAIN setting")
         self._gain = value
+        self._update_settings()
 
     @property
     def resolution_x(self):
@@ -369,6 +434,7 @@ class MLX90393:
         if value not in range(0, 4):
             raise ValueError("Invalid resolution setting")
         self._res_x = value
+        self._update_settings()
 
     @property
     def resolution_y(self):
@@ -397,6 +463,7 @@ class MLX90393:
         if value not in range(0, 4):
             raise ValueError("Invalid resolution setting")
         self._res_y = value
+        self._update_settings()
 
     @property
     def resolution_z(self):
@@ -425,6 +492,7 @@ class MLX90393:
         if value not in range(0, 4):
             raise ValueError("Invalid resolution setting")
         self._res_z = value
+        self._update_settings()
 
     @property
     def digital_filter(self):
@@ -470,6 +538,7 @@ class MLX90393:
         if value not in range(0, 8):
             raise ValueError("Invalid Digital Filter setting")
         self._digfilt = value
+        self._update_settings()
 
     @property
     def oversampling(self):
@@ -504,6 +573,7 @@ class MLX90393:
         if value not in range(0, 8):
             raise ValueError("Invalid oversampling setting")
         self._oversampling = value
+        self._update_settings()
 
     @property
     def magnetic(self):
@@ -511,47 +581,126 @@ class MLX90393:
         The processed magnetometer sensor values.
         A 3-tuple of X, Y, Z axis values in microteslas that are signed floats.
         """
-        delay = self._TCONV[self._digfilt][self._oversampling] / 1000
-        delay = delay * 1.1
-
-        payload = bytes([_CMD_SM | _CMD_AXIS_ALL])
-        data = bytearray(1)
-        self._i2c.writeto(self._address, payload)
-        data = self._i2c.readfrom(self._address, len(data))
-        self._status_last = data[0]
+        self.read_into(self._sample)
+        return self._sample[0], self._sample[1], self._sample[2]
 
-        time.sleep(delay)
+    @property
+    def mode(self):
+        """
+        The measurement mode: :const:`MODE_SINGLE` (the default, one
+        measurement per read), :const:`MODE_BURST` or
+        :const:`MODE_WAKE_ON_CHANGE`
+        """
+        return self._mode
+
+    def _command(self, command):
+        self._command_buffer[0] = command
+        self._i2c.writeto(self._address, self._command_buffer)
+        self._i2c.readfrom_into(self._address, self._status_buffer)
+        self._status_last = self._status_buffer[0]
+        if self._status_last & _STATUS_ERROR and command != _CMD_EX:
+            raise RuntimeError("MLX90393 rejected command 0x%02x" % command)
+
+    def _start(self, command, mode, data_rate):
+        self.exit_mode()
+        self._burst_data_rate = data_rate
+        self._command(command | _CMD_AXIS_ALL)
+        self._mode = mode
+        self._period_us = max(data_rate * _BURST_RATE_STEP, self._conversion_us)
+        self._next_us = time.ticks_add(time.ticks_us(), self._conversion_us)
+
+    def start_burst(self, data_rate=0):
+        """
+        Start burst mode: the sensor converts continuously, every
+        ``data_rate`` * 20 ms or back to back with the default of 0, and each
+        read only fetches the newest result instead of starting a measurement
+        and waiting for it.
+        """
+        if data_rate not in range(0, 64):
+            raise ValueError("Invalid burst data rate")
+        self._start(_CMD_SB, MODE_BURST, data_rate)
 
-        data2 = bytearray(7)
-        payload = bytes([_CMD_RM | _CMD_AXIS_ALL])
-        self._i2c.writeto(self._address, payload)
-        data2 = self._i2c.readfrom(self._address, len(data2))
+    def start_wake_on_change(
+        self, xy_threshold, z_threshold, data_rate=0, differential=False
+    ):
+        """
+        Start wake-up on change mode: the sensor measures like in burst mode
+        but only raises its INT pin when an axis changed by more than the
+        threshold (in LSB) from the first measurement, or from the previous
+        one if ``differential``. Needs the ``int_pin`` the sensor was created
+        with, as reads wait for it.
+        """
+        if self._int_pin is None:
+            raise ValueError("Wake-up on change mode needs int_pin")
+        if data_rate not in range(0, 64):
+            raise ValueError("Invalid burst data rate")
+        self.exit_mode()
+        self._woxy_threshold = xy_threshold
+        self._woz_threshold = z_threshold
+        self._woc_diff = 1 if differential else 0
+        self._start(_CMD_SW, MODE_WAKE_ON_CHANGE, data_rate)
+
+    def exit_mode(self):
+        """Stop burst or wake-up on change mode and go back to single reads."""
+        if self._mode != MODE_SINGLE:
+            self._command(_CMD_EX)
+            self._mode = MODE_SINGLE
 
-        self._status_last = data2[0]
-        x = self._unpack_axis_data(self._res_x, data2[1:3])
-        y = self._unpack_axis_data(self._res_y, data2[3:5])
-        z = self._unpack_axis_data(self._res_z, data2[5:7])
+    @property
+    def data_ready(self):
+        """
+        Whether ``read_into`` can return a new sample without waiting. Always
+        True in single mode, where every read runs its own measurement. Uses
+        the INT pin if there is one, the burst period otherwise.
+        """
+        if self._mode == MODE_SINGLE:
+            return True
+        if self._int_pin is not None:
+            return bool(self._int_pin.value())
+        return time.ticks_diff(time.ticks_us(), self._next_us) >= 0
 
-        if self._hall == 12:
-            hallconf_index = 0
+    def read_into(self, buf, index=0, raw=False):
+        """
+        Write the next X, Y, Z sample to ``buf[index:index + 3]`` (e.g. an
+        ``array("f")``) using only preallocated buffers. In single mode this
+        measures and waits for the conversion, in the other modes it waits
+        until `data_ready`.
+
+        With ``raw`` the signed ADC values are stored instead of microteslas
+        (multiply by `scale` to convert), which also avoids creating float
+        objects, e.g. to fill an ``array("i")``.
+        """
+        if self._mode == MODE_SINGLE:
+            self._command(_CMD_SM | _CMD_AXIS_ALL)
+            time.sleep_us(self._conversion_us)
+        elif self._int_pin is not None:
+            while not self._int_pin.value():
+                pass
         else:
-            hallconf_index = 1
-
-        x = x * self._resolutionsxy[self._res_x][hallconf_index][self._gain]
-        y = y * self._resolutionsxy[self._res_y][hallconf_index][self._gain]
-        z = z * self._resolutionsz[self._res_z][hallconf_index][self._gain]
-
-        return x, y, z
+            wait = time.ticks_diff(self._next_us, time.ticks_us())
+            if wait > 0:
+                time.sleep_us(wait)
+
+        self._command_buffer[0] = _CMD_RM | _CMD_AXIS_ALL
+        self._i2c.writeto(self._address, self._command_buffer)
+        self._i2c.readfrom_into(self._address, self._data_buffer)
+        self._status_last = self._data_buffer[0]
+        if self._mode != MODE_SINGLE:
+            self._next_us = time.ticks_add(time.ticks_us(), self._period_us)
+
+        data = self._data_buffer
+        for axis in range(3):
+            value = self._unpack_axis_data(
+                self._resolution[axis], data[1 + 2 * axis], data[2 + 2 * axis]
+            )
+            buf[index + axis] = value if raw else value * self._scale[axis]
 
     @staticmethod
-    def _unpack_axis_data(resolution, data):
+    def _unpack_axis_data(resolution, high, low):
         # see datasheet
+        value = (high << 8) | low
         if resolution == RESOLUTION_3:
-            (value,) = struct.unpack(">H", data)
-            value -= 0x4000
-        elif resolution == RESOLUTION_2:
-            (value,) = struct.unpack(">H", data)
-            value -= 0x8000
-        else:
-            value = struct.unpack(">h", data)[0]
-        return value
+            return value - 0x4000
+        if resolution == RESOLUTION_2:
+            return value - 0x8000
+        return value - 0x10000 if value & 0x8000 else value
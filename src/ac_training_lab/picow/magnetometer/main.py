@@ -1,7 +1,9 @@
 import asyncio
 import json
 import ssl
-from collections import deque
+import struct
+import time
+from array import array
 
 import ntptime
 from machine import I2C, Pin
@@ -22,9 +24,56 @@ mlx = mlx90393.MLX90393(i2c, address=0x18)
 # # Generate a unique identifier for the Pico W
 # pico_id = get_unique_id(write_to_file=True)
 
-# Buffer for storing sensor data
-queue = []
-sensor_data_buffer = deque(queue, 100)  # Adjust maxlen as needed
+# "binary" publishes each batch packed as described in pack_batch, "json" as the
+# older list of {"X": ..., "Y": ..., "Z": ...} dicts
+TELEMETRY_FORMAT = "binary"
+TELEMETRY_VERSION = 1
+# version, sample count, sequence number, dropped samples, epoch ms of 1st sample
+HEADER_FORMAT = "<BHHHQ"
+PUBLISH_INTERVAL = 1  # seconds between messages, each carries every new sample
+# Sensor burst data rate in steps of 20 ms, 0 converts back to back as fast as
+# the oversampling and digital filter settings allow
+BURST_DATA_RATE = 0
+MAX_BATCH = 1000  # samples per message, later ones are dropped (and counted)
+
+
+class SampleBatch:
+    """
+    Samples collected since the last publish. The arrays are allocated once
+    for MAX_BATCH samples and reused, so sampling doesn't trigger the GC.
+    """
+
+    def __init__(self):
+        self.values = array("f", (0.0 for _ in range(3 * MAX_BATCH)))  # x, y, z
+        self.deltas = array("H", (0 for _ in range(MAX_BATCH)))  # ms since previous
+        self.overflow = array("f", (0.0, 0.0, 0.0))
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.first_tick = None
+        self.last_tick = None
+        self.dropped = 0
+
+    def read(self, sensor):
+        """Read the next sample of ``sensor`` into the batch."""
+        if self.count >= MAX_BATCH:
+            sensor.read_into(self.overflow)
+            self.dropped += 1
+            return
+        sensor.read_into(self.values, 3 * self.count)
+        tick = time.ticks_ms()
+        if self.first_tick is None:
+            self.first_tick = tick
+            self.deltas[0] = 0
+        else:
+            self.deltas[self.count] = min(time.ticks_diff(tick, self.last_tick), 0xFFFF)
+        self.last_tick = tick
+        self.count += 1
+
+
+# Sampling fills one batch while the other one is being published
+sensor_data_batch, publishing_batch = SampleBatch(), SampleBatch()
 
 # MQTT Topics
 # data_topic = f"magnetometer/picow/{pico_id}/sensor_data"
@@ -62,29 +111,68 @@ config.update(
 
 
 async def sensor_data_acquisition():
+    # In burst mode each read only fetches the newest conversion
+    mlx.start_burst(BURST_DATA_RATE)
     while True:
-        magx, magy, magz = mlx.magnetic
-        sensor_data_buffer.append((magx, magy, magz))
-        await asyncio.sleep(0.1)  # Adjust based on the desired sampling rate
+        if mlx.data_ready:
+            sensor_data_batch.read(mlx)
+        await asyncio.sleep_ms(1)
+
+
+def pack_batch(batch, sequence):
+    """
+    HEADER_FORMAT header followed by the uint16 deltas and the float32 x, y, z
+    values of every sample, all little-endian (the native RP2040 byte order of
+    the arrays). Decoded by decode_sensor_data in _scripts/orchestrator.py.
+    """
+    # ticks_ms has no epoch, so date the first sample from the NTP-set clock
+    now_ms = time.time_ns() // 1000000
+    base_ms = now_ms - time.ticks_diff(time.ticks_ms(), batch.first_tick)
+    header = struct.pack(
+        HEADER_FORMAT,
+        TELEMETRY_VERSION,
+        batch.count,
+        sequence & 0xFFFF,
+        min(batch.dropped, 0xFFFF),
+        base_ms,
+    )
+    count = batch.count
+    return (
+        header
+        + bytes(memoryview(batch.deltas)[:count])
+        + bytes(memoryview(batch.values)[: 3 * count])
+    )
 
 
 async def publish_sensor_data(client):
+    global sensor_data_batch, publishing_batch
+    sequence = 0
     while True:
-        if sensor_data_buffer:
-            # Create a batch of data points with rate limiting
-            data_batch = []
-            if sensor_data_buffer:
-                magx, magy, magz = sensor_data_buffer.popleft()
-                data_batch.append({"X": magx, "Y": magy, "Z": magz})
-
-            # Convert the batch to JSON and publish
-            data = json.dumps(data_batch)
-            await client.publish(data_topic, data, qos=1)
-
-            # Print the data batch
-            print("Published data:", data)
-
-        await asyncio.sleep(1)  # Ensure only one data point is sent per second
+        await asyncio.sleep(PUBLISH_INTERVAL)
+        if not sensor_data_batch.count:
+            continue
+
+        # Swap batches before publishing so sampling carries on meanwhile
+        publishing_batch.reset()
+        batch = sensor_data_batch
+        sensor_data_batch, publishing_batch = publishing_batch, sensor_data_batch
+        if TELEMETRY_FORMAT == "binary":
+            data = pack_batch(batch, sequence)
+        else:
+            values = batch.values
+            data = json.dumps(
+                [
+                    {"X": values[i], "Y": values[i + 1], "Z": values[i + 2]}
+                    for i in range(0, 3 * batch.count, 3)
+                ]
+            )
+        await client.publish(data_topic, data, qos=1)
+        sequence += 1
+
+        print(
+            f"Published {batch.count} samples ({len(data)} bytes, "
+            f"{batch.dropped} dropped)"
+        )
 
 
 async def up(client):  # Respond to connectivity being (re)established
@@ -10,6 +10,7 @@ from machine import unique_id
 from mqtt_as import MQTTClient, config
 from my_secrets import HIVEMQ_HOST, HIVEMQ_PASSWORD, HIVEMQ_USERNAME, PASSWORD, SSID
 from netman import connectWiFi
+from scale_reader import ScaleReader
 from ubinascii import hexlify
 
 # Set timezone offset; adjust as needed for daylight savings time changes
@@ -78,43 +79,71 @@ config.update(
 # Initialize UART for scale data
 uart = machine.UART(1, baudrate=9600, tx=machine.Pin(4), rx=machine.Pin(5))
 
+# Polled with Q, set to the scale's stream command to use its continuous mode
+CONTINUOUS_COMMAND = None
+QUERY_COMMAND = b"Q\r\n"
+POLL_INTERVAL = 0.2  # seconds between queries when not continuous
+PUBLISH_INTERVAL = 1  # seconds, each message summarizes the readings since the last
+STABLE_TOLERANCE = 0.0  # max spread of a stable window if the scale sends no ST/US
+RESEND_AFTER = 5  # seconds without a line before the stream command is sent again
+
+scale = ScaleReader(
+    asyncio.StreamReader(uart),
+    asyncio.StreamWriter(uart, {}),
+    query=QUERY_COMMAND,
+    continuous=CONTINUOUS_COMMAND,
+    poll_interval=POLL_INTERVAL,
+    tolerance=STABLE_TOLERANCE,
+    resend_after=RESEND_AFTER,
+)
+
 
-async def read_scale_data(client):
+async def publish_scale_data(client):
     last_publish = utime.time()  # Track the last time data was published
+    last_sync = utime.time()
     sync_interval = 3600  # Sync every hour
 
     while True:
         try:
+            await asyncio.sleep(PUBLISH_INTERVAL)
+
             # Periodic time sync
-            if utime.time() - last_publish >= sync_interval:
+            if utime.time() - last_sync >= sync_interval:
                 sync_time()
-
-            uart.write(b"Q\r\n")  # Command to read data from the scale
-            utime.sleep(0.1)
-
-            if uart.any():  # Check if there is data available from the scale
-                scale_data = uart.read().decode("utf-8").strip()
-                if scale_data:
-                    weight = scale_data.splitlines()[0].strip()
-                else:
-                    weight = "0g"
-                current = get_local_time()
-                current_date = f"{current[0]:04}-{current[1]:02}-{current[2]:02}"
-                current_time = f"{current[3]:02}:{current[4]:02}:{current[5]:02}"
-                data = OrderedDict(
-                    [
-                        ("Current Weight", weight),
-                        ("Date", current_date),
-                        ("Time", current_time),
-                    ]
-                )
-
-                message = json.dumps(data)
-                print(f"Publishing scale data: {message}")
-                await client.publish(mqtt_topic, message, qos=1)  # Publish data
-                last_publish = utime.time()  # Update the last publish time
-
-            await asyncio.sleep(1)
+                last_sync = utime.time()
+
+            # Published even when the scale is silent (Readings 0), so a quiet
+            # scale doesn't look like a lost connection to the reset below
+            window = scale.take() or {
+                "text": None,
+                "last": None,
+                "min": None,
+                "max": None,
+                "unit": None,
+                "stable": None,
+                "readings": 0,
+            }
+            current = get_local_time()
+            current_date = f"{current[0]:04}-{current[1]:02}-{current[2]:02}"
+            current_time = f"{current[3]:02}:{current[4]:02}:{current[5]:02}"
+            data = OrderedDict(
+                [
+                    ("Current Weight", window["text"]),
+                    ("Date", current_date),
+                    ("Time", current_time),
+                    ("Last", window["last"]),
+                    ("Min", window["min"]),
+                    ("Max", window["max"]),
+                    ("Unit", window["unit"]),
+                    ("Stable", window["stable"]),
+                    ("Readings", window["readings"]),
+                ]
+            )
+
+            message = json.dumps(data)
+            print(f"Publishing scale data: {message}")
+            await client.publish(mqtt_topic, message, qos=1)  # Publish data
+            last_publish = utime.time()  # Update the last publish time
 
             # Reset if no successful publish for 5 minutes
             if utime.time() - last_publish > 300:
@@ -123,10 +152,19 @@ async def read_scale_data(client):
                 machine.reset()
 
         except Exception as e:
-            print(f"Error in read_scale_data: {e}")
+            print(f"Error in publish_scale_data: {e}")
             await asyncio.sleep(5)
 
 
+async def read_scale_data():
+    while True:
+        try:
+            await scale.run()
+        except Exception as e:
+            print(f"Error in read_scale_data: {e}")
+        await asyncio.sleep(1)
+
+
 async def messages(client):
     async for topic, msg, retained in client.queue:
         print(f"Received message on topic {topic}: {msg.decode()}")
@@ -135,7 +173,9 @@ async def messages(client):
 async def main(client):
     try:
         await client.connect()
-        await asyncio.gather(messages(client), read_scale_data(client))
+        await asyncio.gather(
+            messages(client), read_scale_data(), publish_scale_data(client)
+        )
     except Exception as e:
         print(f"Main loop error: {e}")
         machine.reset()
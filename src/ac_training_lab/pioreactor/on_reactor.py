@@ -1,10 +1,19 @@
+import heapq
+import itertools
 import json
+import threading
 import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 
 import lookhere
+import numpy as np
 import paho.mqtt.client as mqtt
 import requests
+from requests.adapters import HTTPAdapter
+from timeseries_store import SeriesStore
 
 """
 This script is used to interact with the PioReactor API to perform various
@@ -29,9 +38,42 @@ Author: Enrui (Edison) Lin
 # HTTP = "http://piobio.local/api"
 HTTP = "http://pioreactor01.local/api"
 
-automation_name = None
-stirring_target_rpm = None
-led_data = None
+# Number of commands that may run at the same time (across different reactors)
+MAX_WORKERS = 8
+REPLY_TOPIC = "pioreactor/control/reply"
+SCHEDULE_TOPIC = "pioreactor/scheduled_actions"
+
+# One keep-alive session shared by all workers, so calls reuse TCP connections
+session = requests.Session()
+session.mount(
+    "http://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+)
+# Separate pool for the per-series fetches inside a single command
+fetch_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Seconds get_worker waits for a reactor's retained settings on first use
+WORKER_STATE_TIMEOUT = 2.0
+# Seconds after subscribing within which retained settings that may not exist
+# at all (e.g. leds, on reactors that never set them) are expected to arrive
+RETAINED_GRACE = 0.5
+
+READING_WINDOWS = {"1 hour": timedelta(hours=1), "24 hours": timedelta(hours=24)}
+# Extra lookback when polling from a cursor, so no point is missed at the edge
+CURSOR_MARGIN_HOURS = 1 / 60
+
+# (reactor, series) -> SeriesStore of the points fetched so far. Each reactor's
+# commands run in order (ReactorDispatcher), so a store is never updated twice
+# at the same time.
+readings_stores = {}
+
+
+def check_response(response, action):
+    """Raise for a non-2xx response, so the command's reply reports the failure."""
+    if not 200 <= response.status_code < 300:
+        raise requests.HTTPError(
+            f"Failed to {action}. Status code: {response.status_code}",
+            response=response,
+        )
 
 
 # --- PioReactor API Functions ---
@@ -48,14 +90,11 @@ def create_experiment(experiment, description="", mediaUsed="", organismUsed="")
     }
 
     headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = session.post(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 200:
-        print("Experiment created successfully!")
-        return response.json()
-    else:
-        print(f"Failed to create experiment. Status code: {response.status_code}")
-        return None
+    check_response(response, "create experiment")
+    print("Experiment created successfully!")
+    return response.json()
 
 
 def assign_worker_to_experiment(worker, experiment):
@@ -63,35 +102,38 @@ def assign_worker_to_experiment(worker, experiment):
     payload = {"pioreactor_unit": worker}
     headers = {"Content-Type": "application/json"}
 
-    response = requests.put(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 200:
-        print(f"Worker {worker} assigned to experiment {experiment}.")
-    else:
-        print(f"Failed to assign worker {worker}. Status code: {response.status_code}")
+    response = session.put(url, headers=headers, data=json.dumps(payload))
+    check_response(response, f"assign worker {worker}")
+    print(f"Worker {worker} assigned to experiment {experiment}.")
 
 
 def remove_worker_from_experiment(worker, experiment):
     url = f"{HTTP}/experiments/{experiment}/workers/{worker}"
     headers = {"Content-Type": "application/json"}
 
-    response = requests.delete(url, headers=headers)
-    if response.status_code == 202:
-        print(f"Worker {worker} removed from experiment {experiment}.")
-    else:
-        print(f"Failed to remove worker {worker}. Status code: {response.status_code}")
+    response = session.delete(url, headers=headers)
+    check_response(response, f"remove worker {worker}")
+    print(f"Worker {worker} removed from experiment {experiment}.")
 
 
-def start_stirring(worker, experiment):
+def start_stirring(worker, experiment, rpm=None):
     url = f"{HTTP}/workers/{worker}/jobs/run/job_name/stirring/experiments/{experiment}"
     print(url)
     headers = {"Content-Type": "application/json"}
     payload = {"env": {"EXPERIMENT": experiment, "JOB_SOURCE": "user"}}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"Stirring started for worker {worker}")
-    else:
-        print(f"Failed to start stirring. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "start stirring")
+    print(f"Stirring started for worker {worker}")
+
+    if rpm:
+        return scheduler.schedule(
+            1,
+            worker,
+            "update_stirring_rpm",
+            update_stirring_rpm,
+            (worker, experiment, rpm),
+        )
 
 
 def stop_stirring(worker, experiment):
@@ -104,11 +146,9 @@ def stop_stirring(worker, experiment):
 
     print(url)
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"Stirring stopped for worker {worker}.")
-    else:
-        print(f"Failed to stop stirring. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "stop stirring")
+    print(f"Stirring stopped for worker {worker}.")
 
 
 def update_stirring_rpm(worker, experiment, rpm):
@@ -119,11 +159,9 @@ def update_stirring_rpm(worker, experiment, rpm):
     headers = {"Content-Type": "application/json"}
     payload = {"settings": {"target_rpm": rpm}}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"Stirring RPM updated to {rpm} for worker {worker}.")
-    else:
-        print(f"Failed to update stirring RPM. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "update stirring RPM")
+    print(f"Stirring RPM updated to {rpm} for worker {worker}.")
 
 
 def set_led_intensity(worker, experiment, brightness_value, led):
@@ -137,63 +175,51 @@ def set_led_intensity(worker, experiment, brightness_value, led):
         "options": {led: brightness_value, "source_of_event": "UI"},
     }
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"LED intensity set to {brightness_value} for worker {worker}.")
-    else:
-        print(f"Failed to set LED intensity. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "set LED intensity")
+    print(f"LED intensity set to {brightness_value} for worker {worker}.")
 
 
 def get_temperature_readings(client, reactor, experiment, filter_mod, lookback):
-    url = f"{HTTP}/experiments/{experiment}/time_series/temperature_readings"
-    params = {"filter_mod_N": filter_mod, "lookback": lookback}
-
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        print(f"Temperature readings retrieved for experiment {experiment}.")
-        print(response.json())
-        temperature_data = response.json()
-        client.publish(
-            f"pioreactor/{reactor}/temperature", json.dumps(temperature_data)
-        )
-    else:
-        print(f"Failed to retrieve temp readings. Status code: {response.status_code}")
+    store, _ = fetch_series(
+        reactor, experiment, "temperature_readings", filter_mod, lookback
+    )
+    print(f"Temperature readings retrieved for experiment {experiment}.")
+    temperature_data = {
+        "series": [reactor],
+        "data": [store.query(reading_window(None, lookback))],
+    }
+    client.publish(f"pioreactor/{reactor}/temperature", json.dumps(temperature_data))
 
 
 def get_experiments(client):
     url = f"{HTTP}/experiments"
     headers = {"Content-Type": "application/json"}
 
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        experiments = response.json()
-        client.publish("pioreactor/experiments", json.dumps(experiments))
-    else:
-        print(f"Failed to retrieve experiments. Status code: {response.status_code}")
+    response = session.get(url, headers=headers)
+    check_response(response, "retrieve experiments")
+    experiments = response.json()
+    client.publish("pioreactor/experiments", json.dumps(experiments))
 
 
 def get_reactors(client, experiment):
     url = f"{HTTP}/experiments/{experiment}/workers"
     headers = {"Content-Type": "application/json"}
 
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        reactors = response.json()
-        client.publish("pioreactor/reactors", json.dumps(reactors))
-    else:
-        print(f"Failed to retrieve reactors. Status code: {response.status_code}")
+    response = session.get(url, headers=headers)
+    check_response(response, "retrieve reactors")
+    reactors = response.json()
+    client.publish("pioreactor/reactors", json.dumps(reactors))
 
 
 def get_reactor_stats(client, reactor):
     url = f"{HTTP}/units/{reactor}/jobs/running"
     headers = {"Content-Type": "application/json"}
 
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        stats = response.json()
-        client.publish("pioreactor/stats", json.dumps(stats))
-    else:
-        print(f"Failed to retrieve reactor stats. Status code: {response.status_code}")
+    response = session.get(url, headers=headers)
+    check_response(response, "retrieve reactor stats")
+    stats = response.json()
+    client.publish("pioreactor/stats", json.dumps(stats))
 
 
 def get_task_status(task_id):
@@ -204,198 +230,151 @@ def get_task_status(task_id):
     headers = {"Content-Type": "application/json"}
 
     # Send the GET request to retrieve the task status
-    response = requests.get(url, headers=headers)
+    response = session.get(url, headers=headers)
 
     # Check the response status code
-    if response.status_code == 200:
-        print("Task status retrieved successfully.")
-        return response.json()  # Return the response data (task status)
-    else:
-        print(f"Failed to retrieve task status. Status code: {response.status_code}")
-        print(f"Response: {response.text}")
-        return None
-
-
-def get_worker(client, reactor):
-    # Construct the URL for getting the worker
-    url = f"{HTTP}/workers/assignments"
-
-    # Set the headers
-    headers = {"Content-Type": "application/json"}
-
-    # Send the GET request to retrieve the worker
-    response = requests.get(url, headers=headers)
-
-    # print(response.text)
-
-    if response.status_code == 200:
-        print("Worker retrieved successfully.")
-    else:
-        print(f"Failed to retrieve worker. Status code: {response.status_code}")
-        print(f"Response: {response.text}")
-        return None
-
-    data = response.json()
-
-    experiment = None
-
-    for e in data:
-        if e["pioreactor_unit"] == reactor:
-            experiment = e["experiment"]
-            break
-
-    if experiment is None:
-        print(f"Failed to retrieve experiment for worker {reactor}")
-        return None
-
-    url2 = f"{HTTP}/units/{reactor}/jobs/running"
-
-    response2 = requests.get(url2, headers=headers)
-
-    stats = response2.json()
-
-    # print(stats)
-
-    # task = stats.get("task_id", None)
-
-    # if task is None:
-    #     return None
+    check_response(response, "retrieve task status")
+    print("Task status retrieved successfully.")
+    return response.json()  # Return the response data (task status)
 
-    # response3 = get_task_status(task)
 
-    # print(response3)
+class ReactorStateCache:
+    """Job settings per reactor, kept current from the Pioreactor MQTT topics.
 
-    running = []
+    One long-lived client per reactor subscribes to the retained settings
+    topics, so reads come from memory instead of a new connection each time.
+    """
 
-    print(stats)
-
-    for item in stats:
-        running.append(item["job_name"])
-
-    url3 = f"{HTTP}/experiments"
-
-    response3 = requests.get(url3, headers=headers)
-
-    experiments = response3.json()
-
-    exp_name = []
-
-    for e in experiments:
-        exp_name.append(e["experiment"])
-
-    exp_name.remove(experiment)
-
-    def on_connect(client, userdata, flags, rc):
-        print(f"PIO connected with result code {rc}")
-        client.subscribe(f"pioreactor/{reactor}/{experiment}/leds/intensity")
-
-    def on_message(client, userdata, msg):
-        global led_data
-        led_data = json.loads(msg.payload.decode("utf-8"))
-        # print(led_data)
-
-    client_temp = mqtt.Client()
-
-    client_temp.on_connect = on_connect
-    client_temp.on_message = on_message
-
-    client_temp.username_pw_set(lookhere.username_pio, lookhere.password_pio)
-
-    client_temp.connect(reactor + ".local", lookhere.port_pio)
-
-    client_temp.loop_start()
-
-    # timeout = 5
-    # start = time.time()
-
-    # while len(led_data) < 5 and time.time() - start < timeout:
-    #     time.sleep(1)
-
-    time.sleep(1)
+    TOPICS = {
+        "leds/intensity": "leds",
+        "temperature_automation/automation_name": "temperature_automation",
+        "stirring/target_rpm": "stirring",
+    }
 
-    client_temp.loop_stop()
-    client_temp.disconnect()
+    def __init__(self):
+        self.clients = {}
+        self.watched_at = {}  # reactor -> time.monotonic() of the subscription
+        self.state = defaultdict(dict)  # (reactor, experiment) -> {key: value}
+        self.updated = threading.Condition()
 
-    if "temperature_automation" in running:
+    def watch(self, reactor):
+        if reactor in self.clients:
+            return
 
         def on_connect(client, userdata, flags, rc):
             print(f"PIO connected with result code {rc}")
-            client.subscribe(
-                f"pioreactor/{reactor}/{experiment}/temperature_automation"
-                "/automation_name"
+            for topic in self.TOPICS:
+                client.subscribe(f"pioreactor/{reactor}/+/{topic}")
+
+        client_pio = mqtt.Client()
+        client_pio.on_connect = on_connect
+        client_pio.on_message = self.on_message
+        client_pio.username_pw_set(lookhere.username_pio, lookhere.password_pio)
+        client_pio.connect_async(reactor + ".local", lookhere.port_pio)
+        client_pio.loop_start()
+        self.clients[reactor] = client_pio
+        self.watched_at[reactor] = time.monotonic()
+
+    def on_message(self, client, userdata, msg):
+        _, reactor, experiment, topic = msg.topic.split("/", 3)
+        value = msg.payload.decode("utf-8") or None
+        if value is not None and self.TOPICS[topic] == "leds":
+            value = json.loads(value)
+
+        with self.updated:
+            self.state[(reactor, experiment)][self.TOPICS[topic]] = value
+            self.updated.notify_all()
+
+    def get(self, reactor, experiment, keys, timeout=0, optional=()):
+        """Return the cached settings, waiting up to ``timeout`` for ``keys``.
+
+        ``optional`` keys are only waited for until RETAINED_GRACE after the
+        reactor was first watched, and are missing (unknown) if they never
+        arrived by then.
+        """
+        self.watch(reactor)
+        start = time.monotonic()
+        grace = self.watched_at[reactor] + RETAINED_GRACE - start
+        with self.updated:
+            state = self.state[(reactor, experiment)]
+            self.updated.wait_for(
+                lambda: all(key in state for key in (*keys, *optional)),
+                max(0, min(timeout, grace)),
             )
+            self.updated.wait_for(
+                lambda: all(key in state for key in keys),
+                max(0, timeout - (time.monotonic() - start)),
+            )
+            return dict(state)
 
-        def on_message(client, userdata, msg):
-            global automation_name
-            automation_name = msg.payload.decode("utf-8")
-            print(automation_name)
-
-        client_temp.on_connect = on_connect
-        client_temp.on_message = on_message
 
-        broker = reactor + ".local"
+reactor_states = ReactorStateCache()
 
-        client_temp.connect(broker, lookhere.port_pio)
 
-        # global automation_name
-        client_temp.loop_start()
-        time.sleep(1)
-        # print(automation_name, "automation_name")
-        client_temp.loop_stop()
-        client_temp.disconnect()
+def get_worker(client, reactor, timeout=WORKER_STATE_TIMEOUT):
+    headers = {"Content-Type": "application/json"}
 
-    if "stirring" in running:
+    # The three lookups are independent, so run them at the same time
+    assignments, jobs, experiments = [
+        fetch_executor.submit(session.get, url, headers=headers)
+        for url in (
+            f"{HTTP}/workers/assignments",
+            f"{HTTP}/units/{reactor}/jobs/running",
+            f"{HTTP}/experiments",
+        )
+    ]
 
-        def on_connect(client, userdata, flags, rc):
-            print(f"PIO connected with result code {rc}")
-            client.subscribe(f"pioreactor/{reactor}/{experiment}/stirring/target_rpm")
+    response = assignments.result()
+    check_response(response, "retrieve worker")
+    print("Worker retrieved successfully.")
 
-        def on_message(client, userdata, msg):
-            global stirring_target_rpm
-            stirring_target_rpm = msg.payload.decode("utf-8")
-            print(stirring_target_rpm)
+    experiment = None
 
-        client_temp.on_connect = on_connect
-        client_temp.on_message = on_message
+    for e in response.json():
+        if e["pioreactor_unit"] == reactor:
+            experiment = e["experiment"]
+            break
 
-        broker = reactor + ".local"
+    if experiment is None:
+        raise ValueError(f"Worker {reactor} is not assigned to an experiment")
 
-        client_temp.connect(broker, lookhere.port_pio)
+    response = jobs.result()
+    check_response(response, f"retrieve jobs of worker {reactor}")
+    running = [item["job_name"] for item in response.json()]
 
-        # global stirring_target_rpm
-        client_temp.loop_start()
-        time.sleep(1)
-        # print(stirring_target_rpm, "stirring_target_rpm")
-        # print(type(stirring_target_rpm))
-        client_temp.loop_stop()
-        client_temp.disconnect()
+    response = experiments.result()
+    check_response(response, "retrieve experiments")
+    exp_name = [e["experiment"] for e in response.json()]
+    exp_name.remove(experiment)
 
-    print(running)
+    # Only wait for the settings of jobs that are running. Reactors that never
+    # set their LEDs have no retained leds message, so it is unknown (None)
+    # unless it arrives right after subscribing.
+    keys = [job for job in ("temperature_automation", "stirring") if job in running]
+    state = reactor_states.get(reactor, experiment, keys, timeout, optional=["leds"])
 
-    # running.remove("watchdog")
-    # running.remove("mqtt_to_db_streaming")
-    # running.remove("monitor")
-    if "mqtt_to_db_streaming" in running:
-        running.remove("mqtt_to_db_streaming")
-    if "watchdog" in running:
-        running.remove("watchdog")
-    if "monitor" in running:
-        running.remove("monitor")
+    automation_name = state.get("temperature_automation")
+    stirring_target_rpm = state.get("stirring")
 
-    # print(experiment)
+    for job in ("mqtt_to_db_streaming", "watchdog", "monitor"):
+        if job in running:
+            running.remove(job)
 
     payload = {
         "experiment": experiment,
         "running": running,
-        "temperature_automation": automation_name,
+        "temperature_automation": (
+            automation_name if "temperature_automation" in running else None
+        ),
         "stirring": (
-            int(float(stirring_target_rpm)) if stirring_target_rpm is not None else None
+            int(float(stirring_target_rpm))
+            if "stirring" in running and stirring_target_rpm is not None
+            else None
         ),
-        "leds": led_data if led_data is not None else None,
+        "leds": state.get("leds"),
         "experiments": exp_name,
     }
 
-    # print("Publishing worker")
     client.publish(f"pioreactor/{reactor}/worker", json.dumps(payload))
 
 
@@ -426,24 +405,20 @@ def set_temperature_automation(worker, experiment, automation_name, temp=None):
             },
         }
     else:
-        print(f"Invalid automation name: {automation_name}")
-        return
+        raise ValueError(f"Invalid automation name: {automation_name}")
 
     # Set the headers
     headers = {"Content-Type": "application/json"}
 
     # Send the PATCH request to set the automation
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
     # Check the response status code
-    if response.status_code == 202:
-        print(
-            f"Automation '{automation_name}' set successfully on worker {worker}"
-            f" for experiment {experiment}!"
-        )
-    else:
-        print(f"Failed to set automation. Status code: {response.status_code}")
-        print(f"Response: {response.text}")
+    check_response(response, "set automation")
+    print(
+        f"Automation '{automation_name}' set successfully on worker {worker}"
+        f" for experiment {experiment}!"
+    )
 
 
 def temp_update(worker, experiment, settings):
@@ -460,27 +435,27 @@ def temp_update(worker, experiment, settings):
     headers = {"Content-Type": "application/json"}
 
     # Send the PATCH request to set the automation
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
     # Check the response status code
-    if response.status_code == 202:
-        print(
-            f"Automation settings updated successfully on worker {worker} for "
-            f"experiment {experiment}!"
-        )
-    else:
-        print(
-            f"Failed to update automation settings. Status code: {response.status_code}"
-        )
-        print(f"Response: {response.text}")
+    check_response(response, "update automation settings")
+    print(
+        f"Automation settings updated successfully on worker {worker} for "
+        f"experiment {experiment}!"
+    )
 
 
 def temp_restart(worker, experiment, automation, temp=None):
     # Update automation to stop then start new automation
     print("Restarting temperature automation")
     temp_update(worker, experiment, {"$state": "disconnected"})
-    time.sleep(3)
-    set_temperature_automation(worker, experiment, automation, temp)
+    return scheduler.schedule(
+        3,
+        worker,
+        "set_temperature_automation",
+        set_temperature_automation,
+        (worker, experiment, automation, temp),
+    )
 
 
 def stop_od_reading(reactor, experiment):
@@ -491,11 +466,9 @@ def stop_od_reading(reactor, experiment):
     headers = {"Content-Type": "application/json"}
     payload = {"settings": {"$state": "disconnected"}}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"OD reading stopped for worker {reactor}.")
-    else:
-        print(f"Failed to stop OD reading. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "stop OD reading")
+    print(f"OD reading stopped for worker {reactor}.")
 
 
 def start_od_reading(reactor, experiment):
@@ -506,11 +479,9 @@ def start_od_reading(reactor, experiment):
     headers = {"Content-Type": "application/json"}
     payload = {"env": {"EXPERIMENT": experiment, "JOB_SOURCE": "user"}}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"OD reading started for worker {reactor}")
-    else:
-        print(f"Failed to start OD reading. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "start OD reading")
+    print(f"OD reading started for worker {reactor}")
 
 
 def stop_growth_rate(reactor, experiment):
@@ -521,11 +492,9 @@ def stop_growth_rate(reactor, experiment):
     headers = {"Content-Type": "application/json"}
     payload = {"settings": {"$state": "disconnected"}}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"Growth rate stopped for worker {reactor}.")
-    else:
-        print(f"Failed to stop growth rate. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "stop growth rate")
+    print(f"Growth rate stopped for worker {reactor}.")
 
 
 def start_growth_rate(reactor, experiment):
@@ -536,11 +505,55 @@ def start_growth_rate(reactor, experiment):
     headers = {"Content-Type": "application/json"}
     payload = {"env": {"EXPERIMENT": experiment, "JOB_SOURCE": "user"}}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 202:
-        print(f"Growth rate started for worker {reactor}")
-    else:
-        print(f"Failed to start growth rate. Status code: {response.status_code}")
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+    check_response(response, "start growth rate")
+    print(f"Growth rate started for worker {reactor}")
+
+
+def fetch_series(reactor, experiment, series, filter_mod, lookback):
+    """Pull the points newer than the store's cursor into the local store.
+
+    Only the points after the last stored timestamp are requested, so a poll
+    every few seconds downloads a few points instead of the whole ``lookback``
+    window. The store is filled again from scratch when ``filter_mod`` changes
+    or ``lookback`` reaches further back than its first fill. Returns the
+    store and the points added since the previous poll (empty on a fill).
+    """
+    start = np.datetime64("now", "ms") - np.timedelta64(int(lookback * 3600e3), "ms")
+    store = readings_stores.get((reactor, series))
+    if (
+        store is None
+        or (store.experiment, store.filter_mod) != (experiment, filter_mod)
+        or start < store.start
+    ):
+        store = SeriesStore(experiment, filter_mod)
+        store.start = start
+        readings_stores[(reactor, series)] = store
+
+    request_lookback = lookback
+    if store.last_time is not None:
+        since = (np.datetime64("now", "ms") - store.last_time) / np.timedelta64(1, "h")
+        request_lookback = min(lookback, since + CURSOR_MARGIN_HOURS)
+
+    url = f"{HTTP}/experiments/{experiment}/time_series/{series}"
+    params = {"filter_mod_N": filter_mod, "lookback": request_lookback}
+
+    response = session.get(url, params=params)
+    check_response(response, f"retrieve {series}")
+
+    body = response.json()
+    data = body.get("data", [])
+    units = body.get("series", [])
+    points = data[units.index(reactor) if reactor in units else 0] if data else []
+
+    first_fill = store.last_time is None
+    new_points = store.extend(points)
+    return store, [] if first_fill else new_points
+
+
+def reading_window(amount, lookback):
+    """Window in seconds for ``amount`` ("1 hour", "24 hours" or the lookback)."""
+    return READING_WINDOWS.get(amount, timedelta(hours=lookback)).total_seconds()
 
 
 def get_readings(
@@ -564,180 +577,40 @@ def get_readings(
     url = f"{HTTP}/experiments/{experiment}"
     headers = {"Content-Type": "application/json"}
 
-    response = requests.get(url, headers=headers)
-
-    # print(response.json())
+    response = session.get(url, headers=headers)
+    check_response(response, f"retrieve experiment {experiment}")
 
     hour = response.json().get("delta_hours", None)
 
-    filter_mod2 = filter_mod2 + hour
-    filter_mod3 = filter_mod3 + hour
-    filter_mod4 = filter_mod4 + hour
-
-    # print(amount2)
-
-    # Get the temperature readings
-    url = f"{HTTP}/experiments/{experiment}/time_series/temperature_readings"
-    params = {"filter_mod_N": filter_mod, "lookback": lookback}
-
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        print(f"Temperature readings retrieved for experiment {experiment}.")
-    else:
-        print(
-            "Failed to retrieve temperature readings. "
-            f"Status code: {response.status_code}"
-        )
-
-    # Get the OD readings
-    url = f"{HTTP}/experiments/{experiment}/time_series/od_readings"
-    params = {"filter_mod_N": filter_mod2, "lookback": lookback2}
-
-    response2 = requests.get(url, params=params)
-    if response2.status_code == 200:
-        print(f"OD readings retrieved for experiment {experiment}.")
-    else:
-        print(f"Failed to retrieve OD readings. Status code: {response2.status_code}")
-
-    # Get the noremalized OD readings
-    url = f"{HTTP}/experiments/{experiment}/time_series/od_readings_filtered"
-    params = {"filter_mod_N": filter_mod3, "lookback": lookback3}
-
-    response3 = requests.get(url, params=params)
-    if response3.status_code == 200:
-        print(f"Normalized OD readings retrieved for experiment {experiment}.")
-    else:
-        print(
-            "Failed to retrieve normalized OD readings. "
-            f"Status code: {response3.status_code}"
-        )
-
-    # Get the growth rate readings
-    url = f"{HTTP}/experiments/{experiment}/time_series/growth_rates"
-    params = {"filter_mod_N": filter_mod4, "lookback": lookback4}
-
-    response4 = requests.get(url, params=params)
-    if response4.status_code == 200:
-        print(f"Growth rate readings retrieved for experiment {experiment}.")
-    else:
-        print(
-            "Failed to retrieve growth rate readings. "
-            f"Status code: {response4.status_code}"
-        )
-
-    # Publish the readings to the MQTT topic
-    # Readings are 4 minutes apart
-    temp = response.json()
-    temp = temp.get("data", [])
-
-    if len(temp) != 0:
-        temp = temp[0]
-        if amount == "1 hour":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(temp), 0, -1):
-                if datetime.strptime(
-                    temp[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=1):
-                    temp = temp[i:]
-                    break
-        elif amount == "24 hours":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(temp), 0, -1):
-                if datetime.strptime(
-                    temp[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=24):
-                    temp = temp[i:]
-                    break
-
-    # Readings are 12 times a minute
-
-    od = response2.json()
-    od = od.get("data", [])
-
-    if len(od) != 0:
-        od = od[0]
-        if amount2 == "1 hour":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(od), 0, -1):
-                if datetime.strptime(
-                    od[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=1):
-                    od = od[i:]
-                    break
-        elif amount2 == "24 hours":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(od), 0, -1):
-                if datetime.strptime(
-                    od[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=24):
-                    od = od[i:]
-                    break
-
-    # print(lastTime)
-
-    norm_od = response3.json()
-    norm_od = norm_od.get("data", [])
-
-    if len(norm_od) != 0:
-        norm_od = norm_od[0]
-        if amount3 == "1 hour":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(norm_od), 0, -1):
-                if datetime.strptime(
-                    norm_od[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=1):
-                    norm_od = norm_od[i:]
-                    break
-        elif amount3 == "24 hours":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(norm_od), 0, -1):
-                if datetime.strptime(
-                    norm_od[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=24):
-                    norm_od = norm_od[i:]
-                    break
-
-    growth_rate = response4.json()
-    growth_rate = growth_rate.get("data", [])
-    if len(growth_rate) != 0:
-        growth_rate = growth_rate[0]
-        if amount4 == "1 hour":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(growth_rate), 0, -1):
-                if datetime.strptime(
-                    growth_rate[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=1):
-                    growth_rate = growth_rate[i:]
-                    break
-        elif amount4 == "24 hours":
-            lastTime = datetime.now()
-            # lastTime = datetime.strptime(lastTime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            for i in range(len(growth_rate), 0, -1):
-                if datetime.strptime(
-                    growth_rate[i - 1].get("x"), "%Y-%m-%dT%H:%M:%S.%fZ"
-                ) < lastTime - timedelta(hours=24):
-                    growth_rate = growth_rate[i:]
-                    break
-
-    readings = {
-        "temperature": temp,
-        "od": od,
-        "normalized_od": norm_od,
-        "growth_rate": growth_rate,
+    # Readings are 4 minutes apart for temperature and 12 times a minute for OD
+    requests_by_key = {
+        "temperature": ("temperature_readings", filter_mod, lookback, amount),
+        "od": ("od_readings", filter_mod2 + hour, lookback2, amount2),
+        "normalized_od": (
+            "od_readings_filtered",
+            filter_mod3 + hour,
+            lookback3,
+            amount3,
+        ),
+        "growth_rate": ("growth_rates", filter_mod4 + hour, lookback4, amount4),
     }
 
-    # print(temp)
+    # Fetch the four series at the same time
+    futures = {
+        key: fetch_executor.submit(fetch_series, reactor, experiment, series, mod, back)
+        for key, (series, mod, back, _) in requests_by_key.items()
+    }
 
-    # print(len(od))
+    readings = {}
+    delta = {}
+    for key, (_, _, back, window) in requests_by_key.items():
+        store, new_points = futures[key].result()
+        readings[key] = store.query(reading_window(window, back))
+        delta[key] = new_points
 
     client.publish(f"pioreactor/{reactor}/readings", json.dumps(readings))
+    if any(delta.values()):
+        client.publish(f"pioreactor/{reactor}/readings/delta", json.dumps(delta))
 
 
 def new_experiment(experiment, description="", mediaUsed="", organismUsed=""):
@@ -753,12 +626,10 @@ def new_experiment(experiment, description="", mediaUsed="", organismUsed=""):
     }
 
     headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    response = session.post(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 200:
-        print("Experiment created successfully!")
-    else:
-        print(f"Failed to create experiment. Status code: {response.status_code}")
+    check_response(response, "create experiment")
+    print("Experiment created successfully!")
 
 
 def change_experiment(experiment, experiment_new, reactor):
@@ -766,24 +637,19 @@ def change_experiment(experiment, experiment_new, reactor):
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.delete(url, headers=headers)
+    response = session.delete(url, headers=headers)
 
-    if response.status_code == 200:
-        print("Experiment changed successfully!")
-    else:
-        print(f"Failed to change experiment. Status code: {response.status_code}")
-        return None
+    check_response(response, "change experiment")
+    print("Experiment changed successfully!")
 
     url = f"{HTTP}/experiments/{experiment_new}/workers"
 
     payload = {"pioreactor_unit": reactor}
 
-    response = requests.put(url, headers=headers, data=json.dumps(payload))
+    response = session.put(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 200:
-        print(f"Worker {reactor} assigned to experiment {experiment_new}.")
-    else:
-        print(f"Failed to assign worker {reactor}. Status code: {response.status_code}")
+    check_response(response, f"assign worker {reactor}")
+    print(f"Worker {reactor} assigned to experiment {experiment_new}.")
 
     set_led_intensity(reactor, experiment_new, 0, "A")
 
@@ -793,13 +659,10 @@ def delete_experiment(experiment):
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.delete(url, headers=headers)
+    response = session.delete(url, headers=headers)
 
-    if response.status_code == 200:
-        print("Experiment deleted successfully!")
-    else:
-        print(f"Failed to delete experiment. Status code: {response.status_code}")
-        return None
+    check_response(response, "delete experiment")
+    print("Experiment deleted successfully!")
 
 
 def pump_add_media(reactor, experiment, volume=None, duration=None, continuous=False):
@@ -824,17 +687,14 @@ def pump_add_media(reactor, experiment, volume=None, duration=None, continuous=F
             "options": {"continuously": None, "source_of_event": "UI"},
         }
     else:
-        print("Please provide either volume or duration.")
-        return
+        raise ValueError("Please provide either volume or duration.")
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 202:
-        print(f"Media added to reactor {reactor}.")
-    else:
-        print(f"Failed to add media. Status code: {response.status_code}")
+    check_response(response, "add media")
+    print(f"Media added to reactor {reactor}.")
 
 
 def pump_remove_media(
@@ -862,17 +722,14 @@ def pump_remove_media(
             "options": {"continuously": None, "source_of_event": "UI"},
         }
     else:
-        print("Please provide either volume or duration.")
-        return
+        raise ValueError("Please provide either volume or duration.")
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 202:
-        print(f"Media removed from reactor {reactor}.")
-    else:
-        print(f"Failed to remove media. Status code: {response.status_code}")
+    check_response(response, "remove media")
+    print(f"Media removed from reactor {reactor}.")
 
 
 def add_alt_media(reactor, experiment, volume=None, duration=None, continuous=False):
@@ -898,49 +755,46 @@ def add_alt_media(reactor, experiment, volume=None, duration=None, continuous=Fa
             "options": {"continuously": None, "source_of_event": "UI"},
         }
     else:
-        print("Please provide either volume or duration.")
-        return
+        raise ValueError("Please provide either volume or duration.")
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 202:
-        print(f"Media added to reactor {reactor}.")
-    else:
-        print(f"Failed to add media. Status code: {response.status_code}")
+    check_response(response, "add media")
+    print(f"Media added to reactor {reactor}.")
 
 
 def circulate_media(reactor, experiment, duration):
     pump_add_media(reactor, experiment, continuous=True)
     pump_remove_media(reactor, experiment, continuous=True)
 
-    time.sleep(duration)
+    return scheduler.schedule(
+        duration, reactor, "stop_circulation", stop_circulation, (reactor, experiment)
+    )
+
 
+def stop_circulation(reactor, experiment):
     url = (
         f"{HTTP}/workers/{reactor}/jobs/stop/job_name/"
         f"add_media/experiments/{experiment}"
     )
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers)
+    response = session.patch(url, headers=headers)
 
-    if response.status_code == 202:
-        print(f"Media circulated in reactor {reactor}.")
-    else:
-        print(f"Failed to circulate media. Status code: {response.status_code}")
+    check_response(response, "circulate media")
+    print(f"Media circulated in reactor {reactor}.")
 
     url = (
         f"{HTTP}/workers/{reactor}/jobs/stop/job_name/"
         f"remove_waste/experiments/{experiment}"
     )
 
-    response = requests.patch(url, headers=headers)
+    response = session.patch(url, headers=headers)
 
-    if response.status_code == 202:
-        print(f"Media circulated in reactor {reactor}.")
-    else:
-        print(f"Failed to circulate media. Status code: {response.status_code}")
+    check_response(response, "circulate media")
+    print(f"Media circulated in reactor {reactor}.")
 
     # url = f"{HTTP}/workers/{reactor}/jobs/run/job_name/" \
     # "circulate_media/experiments/{experiment}"
@@ -973,12 +827,10 @@ def circulate_alt_media(reactor, experiment, media, duration):
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 202:
-        print(f"Media circulated in reactor {reactor}.")
-    else:
-        print(f"Failed to circulate media. Status code: {response.status_code}")
+    check_response(response, "circulate media")
+    print(f"Media circulated in reactor {reactor}.")
 
 
 def start_relay(reactor, experiment, relay):
@@ -991,12 +843,10 @@ def start_relay(reactor, experiment, relay):
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 202:
-        print(f"Relay {relay} started in reactor {reactor}.")
-    else:
-        print(f"Failed to start relay. Status code: {response.status_code}")
+    check_response(response, "start relay")
+    print(f"Relay {relay} started in reactor {reactor}.")
 
 
 def stop_relay(reactor, experiment, relay):
@@ -1011,12 +861,10 @@ def stop_relay(reactor, experiment, relay):
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 202:
-        print(f"Relay {relay} stopped in reactor {reactor}.")
-    else:
-        print(f"Failed to stop relay. Status code: {response.status_code}")
+    check_response(response, "stop relay")
+    print(f"Relay {relay} stopped in reactor {reactor}.")
 
 
 def relay_on(reactor, experiment, relay):
@@ -1029,12 +877,10 @@ def relay_on(reactor, experiment, relay):
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 202:
-        print(f"Relay {relay} turned on in reactor {reactor}.")
-    else:
-        print(f"Failed to turn on relay. Status code: {response.status_code}")
+    check_response(response, "turn on relay")
+    print(f"Relay {relay} turned on in reactor {reactor}.")
 
 
 def relay_off(reactor, experiment, relay):
@@ -1047,12 +893,384 @@ def relay_off(reactor, experiment, relay):
 
     headers = {"Content-Type": "application/json"}
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = session.patch(url, headers=headers, data=json.dumps(payload))
+
+    check_response(response, "turn off relay")
+    print(f"Relay {relay} turned off in reactor {reactor}.")
+
+
+# --- Scheduled Actions ---
+class ActionScheduler:
+    """Run delayed actions from a heap on a background thread.
+
+    Due actions are handed to the dispatcher, so they keep the per-reactor
+    order and never block the MQTT network thread. The pending list is
+    published on SCHEDULE_TOPIC whenever it changes.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.heap = []  # (due, action id)
+        self.pending = {}  # action id -> (due, reactor, name, function, args)
+        self.ids = itertools.count(1)
+        self.wakeup = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, delay, reactor, name, function, args):
+        """Run ``function(*args)`` for ``reactor`` in ``delay`` seconds."""
+        due = time.time() + delay
+        with self.wakeup:
+            action_id = next(self.ids)
+            heapq.heappush(self.heap, (due, action_id))
+            self.pending[action_id] = (due, reactor, name, function, args)
+            self.wakeup.notify()
+
+        self.publish()
+        return action_id
+
+    def cancel(self, action_id=None, reactor=None):
+        """Cancel one action by id, or every pending action of ``reactor``."""
+        with self.wakeup:
+            cancelled = [
+                key
+                for key, (_, action_reactor, *_) in self.pending.items()
+                if key == action_id or (action_id is None and action_reactor == reactor)
+            ]
+            for key in cancelled:
+                del self.pending[key]
+
+        self.publish()
+        return cancelled
+
+    def publish(self):
+        now = time.time()
+        with self.wakeup:
+            actions = [
+                {
+                    "id": action_id,
+                    "reactor": reactor,
+                    "action": name,
+                    "due_in_s": round(due - now, 3),
+                }
+                for action_id, (due, reactor, name, _, _) in sorted(
+                    self.pending.items(), key=lambda item: item[1][0]
+                )
+            ]
+        self.client.publish(SCHEDULE_TOPIC, json.dumps(actions), retain=True)
+
+    def _run(self):
+        while True:
+            with self.wakeup:
+                while True:
+                    # Cancelled actions stay in the heap until they reach the top
+                    while self.heap and self.heap[0][1] not in self.pending:
+                        heapq.heappop(self.heap)
+                    if self.heap and self.heap[0][0] <= time.time():
+                        break
+                    self.wakeup.wait(
+                        self.heap[0][0] - time.time() if self.heap else None
+                    )
+
+                _, action_id = heapq.heappop(self.heap)
+                _, reactor, name, function, args = self.pending.pop(action_id)
+
+            dispatcher.submit(
+                reactor, name, function, args, partial(self._done, action_id)
+            )
+            self.publish()
+
+    def _done(self, action_id, result):
+        reply = {"scheduled_id": action_id, **result}
+        self.client.publish(REPLY_TOPIC, json.dumps(reply))
+
+
+def cancel_scheduled_actions(action_id=None, reactor=None):
+    return scheduler.cancel(action_id, reactor)
+
+
+def get_scheduled_actions():
+    scheduler.publish()
+
+
+# --- Command Registry ---
+NUMBER = (int, float)
+REQUIRED = object()
+
+REACTOR = ("reactor", str, REQUIRED)
+EXPERIMENT = ("experiment", str, REQUIRED)
+PUMP = (
+    REACTOR,
+    EXPERIMENT,
+    ("volume", NUMBER, None),
+    ("duration", NUMBER, None),
+    ("continuous", bool, False),
+)
+READINGS = tuple(
+    (f"{name}{suffix}", NUMBER, REQUIRED)
+    for suffix in ("", "2", "3", "4")
+    for name in ("filter_mod", "lookback")
+) + tuple((f"amount{suffix}", str, REQUIRED) for suffix in ("", "2", "3", "4"))
+
+# command -> (function, arguments). Arguments are (message key, accepted types,
+# default) and are passed to the function in order; "client" is the MQTT client.
+COMMANDS = {
+    "start_stirring": (start_stirring, (REACTOR, EXPERIMENT, ("rpm", NUMBER, None))),
+    "stop_stirring": (stop_stirring, (REACTOR, EXPERIMENT)),
+    "update_stirring_rpm": (
+        update_stirring_rpm,
+        (REACTOR, EXPERIMENT, ("rpm", NUMBER, REQUIRED)),
+    ),
+    "set_led_intensity": (
+        set_led_intensity,
+        (
+            REACTOR,
+            EXPERIMENT,
+            ("brightness", NUMBER, REQUIRED),
+            ("led", str, REQUIRED),
+        ),
+    ),
+    "get_temperature_readings": (
+        get_temperature_readings,
+        (
+            "client",
+            REACTOR,
+            EXPERIMENT,
+            ("filter_mod", NUMBER, REQUIRED),
+            ("lookback", NUMBER, REQUIRED),
+        ),
+    ),
+    "get_experiments": (get_experiments, ("client",)),
+    "get_reactors": (get_reactors, ("client", EXPERIMENT)),
+    "get_reactor_stats": (get_reactor_stats, ("client", REACTOR)),
+    "get_worker": (
+        get_worker,
+        ("client", REACTOR, ("timeout", NUMBER, WORKER_STATE_TIMEOUT)),
+    ),
+    "set_temperature_automation": (
+        set_temperature_automation,
+        (REACTOR, EXPERIMENT, ("automation", str, REQUIRED), ("temp", NUMBER, None)),
+    ),
+    "temp_update": (temp_update, (REACTOR, EXPERIMENT, ("settings", dict, REQUIRED))),
+    "temp_restart": (
+        temp_restart,
+        (REACTOR, EXPERIMENT, ("automation", str, REQUIRED), ("temp", NUMBER, None)),
+    ),
+    "stop_od_reading": (stop_od_reading, (REACTOR, EXPERIMENT)),
+    "start_od_reading": (start_od_reading, (REACTOR, EXPERIMENT)),
+    "stop_growth_rate": (stop_growth_rate, (REACTOR, EXPERIMENT)),
+    "start_growth_rate": (start_growth_rate, (REACTOR, EXPERIMENT)),
+    "get_readings": (get_readings, ("client", REACTOR, EXPERIMENT) + READINGS),
+    "new_experiment": (
+        new_experiment,
+        (
+            EXPERIMENT,
+            ("description", str, ""),
+            ("mediaUsed", str, ""),
+            ("organismUsed", str, ""),
+        ),
+    ),
+    "change_experiment": (
+        change_experiment,
+        (EXPERIMENT, ("experiment_new", str, REQUIRED), ("reactor", str, None)),
+    ),
+    "delete_experiment": (delete_experiment, (EXPERIMENT,)),
+    "pump_add_media": (pump_add_media, PUMP),
+    "pump_remove_media": (pump_remove_media, PUMP),
+    "add_alt_media": (add_alt_media, PUMP),
+    "circulate_media": (
+        circulate_media,
+        (REACTOR, EXPERIMENT, ("duration", NUMBER, REQUIRED)),
+    ),
+    "circulate_alt_media": (
+        circulate_alt_media,
+        (
+            REACTOR,
+            EXPERIMENT,
+            ("media", object, REQUIRED),
+            ("duration", NUMBER, REQUIRED),
+        ),
+    ),
+    "start_relay": (start_relay, (REACTOR, EXPERIMENT, ("relay", str, "a"))),
+    "stop_relay": (stop_relay, (REACTOR, EXPERIMENT, ("relay", str, "a"))),
+    "cancel_scheduled_actions": (
+        cancel_scheduled_actions,
+        (("action_id", int, None), ("reactor", str, None)),
+    ),
+    "get_scheduled_actions": (get_scheduled_actions, ()),
+    "relay_on": (relay_on, (REACTOR, EXPERIMENT, ("relay", str, "a"))),
+    "relay_off": (relay_off, (REACTOR, EXPERIMENT, ("relay", str, "a"))),
+}
+
+
+def accepts(types, value):
+    """isinstance, except that True and False are not numbers here."""
+    if isinstance(value, bool):
+        types = types if isinstance(types, tuple) else (types,)
+        return bool in types or object in types
+    return isinstance(value, types)
+
+
+def parse_command(client, message):
+    """Validate a command message against its schema in one pass.
+
+    Returns the function, its arguments and a list of errors (empty when the
+    message is valid).
+    """
+    command = message.get("command")
+    if command not in COMMANDS:
+        return None, (), [f"Unknown command: {command}"]
+
+    function, schema = COMMANDS[command]
+    args = []
+    errors = []
+    for argument in schema:
+        if argument == "client":
+            args.append(client)
+            continue
+
+        key, types, default = argument
+        value = message.get(key, default)
+        if value is REQUIRED:
+            errors.append(f"{command}: missing '{key}'")
+        elif value is not default and not accepts(types, value):
+            errors.append(f"{command}: invalid '{key}' {value!r}")
+        args.append(value)
+
+    return function, tuple(args), errors
+
+
+class BatchReply:
+    """Collect the results of one control message and publish them together."""
+
+    def __init__(self, client, message_id, size, batch):
+        self.client = client
+        self.message_id = message_id
+        self.results = [None] * size
+        self.remaining = size
+        self.batch = batch
+        self.lock = threading.Lock()
+
+    def done(self, index, result):
+        with self.lock:
+            self.results[index] = result
+            self.remaining -= 1
+            if self.remaining:
+                return
+
+        if self.batch:
+            reply = {
+                "id": self.message_id,
+                "ok": all(result["ok"] for result in self.results),
+                "results": self.results,
+            }
+        else:
+            reply = {"id": self.message_id, **self.results[0]}
+        self.client.publish(REPLY_TOPIC, json.dumps(reply))
+
 
-    if response.status_code == 202:
-        print(f"Relay {relay} turned off in reactor {reactor}.")
+def select_reactors(selector, experiment=None):
+    """Return (reactor, experiment) pairs for a cluster operation.
+
+    ``selector`` is a list of reactors, "all" for every assigned reactor or
+    "experiment" for the reactors assigned to ``experiment``. Reactors without
+    an explicit ``experiment`` use the one they are assigned to, so "all"
+    without one leaves out workers that aren't assigned to any experiment.
+    """
+    if isinstance(selector, list) and experiment is not None:
+        return [(reactor, experiment) for reactor in selector]
+
+    url = f"{HTTP}/workers/assignments"
+    headers = {"Content-Type": "application/json"}
+    response = session.get(url, headers=headers)
+    check_response(response, "retrieve worker assignments")
+    assignments = {e["pioreactor_unit"]: e["experiment"] for e in response.json()}
+
+    if selector == "all":
+        reactors = [
+            r for r, e in assignments.items() if experiment is not None or e is not None
+        ]
+    elif selector == "experiment":
+        reactors = [r for r, e in assignments.items() if e == experiment]
     else:
-        print(f"Failed to turn off relay. Status code: {response.status_code}")
+        reactors = selector
+
+    return [(reactor, experiment or assignments.get(reactor)) for reactor in reactors]
+
+
+def expand_command(command):
+    """Turn a command with a "reactors" selector into one command per reactor."""
+    if "reactors" not in command:
+        return [command]
+
+    selector = command["reactors"]
+    if selector not in ("all", "experiment") and not isinstance(selector, list):
+        raise ValueError(f"{command.get('command')}: invalid 'reactors' {selector!r}")
+
+    return [
+        {**command, "reactor": reactor, "experiment": experiment}
+        for reactor, experiment in select_reactors(selector, command.get("experiment"))
+    ]
+
+
+# --- Command Dispatch ---
+class ReactorDispatcher:
+    """Run commands on a thread pool while keeping per-reactor order.
+
+    Commands for different reactors run in parallel. Commands for the same
+    reactor are queued and run one after another in arrival order.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.queues = defaultdict(deque)
+
+    def submit(self, reactor, command, function, args, done):
+        """Queue ``function(*args)``; ``done`` gets the result and timings."""
+        with self.lock:
+            queue = self.queues[reactor]
+            queue.append((command, function, args, done, time.perf_counter()))
+            if len(queue) == 1:
+                self.executor.submit(self._run_next, reactor)
+
+    def _run_next(self, reactor):
+        with self.lock:
+            command, function, args, done, queued_at = self.queues[reactor][0]
+            queue_depth = len(self.queues[reactor])
+
+        started_at = time.perf_counter()
+        result = error = None
+        try:
+            result = function(*args)
+        except Exception as e:
+            error = repr(e)
+            print(f"Command {command} failed: {error}")
+        finished_at = time.perf_counter()
+
+        # The reactor's next command must run even if the reply fails
+        try:
+            done(
+                {
+                    "command": command,
+                    "reactor": reactor,
+                    "ok": error is None,
+                    "result": result,
+                    "error": error,
+                    "queue_depth": queue_depth,
+                    "wait_s": round(started_at - queued_at, 4),
+                    "latency_s": round(finished_at - started_at, 4),
+                }
+            )
+        except Exception as e:
+            print(f"Reply for command {command} failed: {e!r}")
+        finally:
+            with self.lock:
+                queue = self.queues[reactor]
+                queue.popleft()
+                if queue:
+                    self.executor.submit(self._run_next, reactor)
+                else:
+                    del self.queues[reactor]
 
 
 # --- MQTT Functions ---
@@ -1064,126 +1282,54 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     try:
         message = json.loads(msg.payload.decode("utf-8"))
-        command = message.get("command")
-        reactor = message.get("reactor")
-        experiment = message.get("experiment")
-
-        # Dispatch commands to respective functions
-        if command == "start_stirring":
-            start_stirring(reactor, experiment)
-            if message.get("rpm"):
-                time.sleep(1)
-                update_stirring_rpm(reactor, experiment, message["rpm"])
-        elif command == "stop_stirring":
-            stop_stirring(reactor, experiment)
-        elif command == "update_stirring_rpm":
-            update_stirring_rpm(reactor, experiment, message["rpm"])
-        elif command == "set_led_intensity":
-            set_led_intensity(
-                reactor, experiment, message["brightness"], message["led"]
-            )
-        elif command == "get_temperature_readings":
-            get_temperature_readings(
-                client, reactor, experiment, message["filter_mod"], message["lookback"]
-            )
-        elif command == "get_experiments":
-            get_experiments(client)
-        elif command == "get_reactors":
-            get_reactors(client, experiment)
-        elif command == "get_reactor_stats":
-            get_reactor_stats(client, reactor)
-        elif command == "get_worker":
-            get_worker(client, reactor)
-        elif command == "set_temperature_automation":
-            set_temperature_automation(
-                reactor, experiment, message["automation"], message.get("temp")
-            )
-        elif command == "temp_update":
-            temp_update(reactor, experiment, message["settings"])
-        elif command == "temp_restart":
-            temp_restart(
-                reactor, experiment, message["automation"], message.get("temp", None)
-            )
-        elif command == "stop_od_reading":
-            stop_od_reading(reactor, experiment)
-        elif command == "start_od_reading":
-            start_od_reading(reactor, experiment)
-        elif command == "stop_growth_rate":
-            stop_growth_rate(reactor, experiment)
-        elif command == "start_growth_rate":
-            start_growth_rate(reactor, experiment)
-        elif command == "get_readings":
-            get_readings(
-                client,
-                reactor,
-                experiment,
-                message["filter_mod"],
-                message["lookback"],
-                message["filter_mod2"],
-                message["lookback2"],
-                message["filter_mod3"],
-                message["lookback3"],
-                message["filter_mod4"],
-                message["lookback4"],
-                message["amount"],
-                message["amount2"],
-                message["amount3"],
-                message["amount4"],
-            )
-        elif command == "new_experiment":
-            new_experiment(
-                message["experiment"],
-                message.get("description", ""),
-                message.get("mediaUsed", ""),
-                message.get("organismUsed", ""),
-            )
-        elif command == "change_experiment":
-            change_experiment(message["experiment"], message["experiment_new"], reactor)
-        elif command == "delete_experiment":
-            delete_experiment(message["experiment"])
-        elif command == "pump_add_media":
-            pump_add_media(
-                reactor,
-                experiment,
-                message.get("volume"),
-                message.get("duration"),
-                message.get("continuous", False),
-            )
-        elif command == "pump_remove_media":
-            pump_remove_media(
-                reactor,
-                experiment,
-                message.get("volume"),
-                message.get("duration"),
-                message.get("continuous", False),
-            )
-        elif command == "add_alt_media":
-            add_alt_media(
-                reactor,
-                experiment,
-                message["media"],
-                message.get("volume"),
-                message.get("duration"),
-                message.get("continuous", False),
-            )
-        elif command == "circulate_media":
-            circulate_media(reactor, experiment, message["duration"])
-        elif command == "circulate_alt_media":
-            circulate_alt_media(
-                reactor, experiment, message["media"], message["duration"]
-            )
-        elif command == "start_relay":
-            start_relay(reactor, experiment, "a")
-        elif command == "stop_relay":
-            stop_relay(reactor, experiment, "a")
-        elif command == "relay_off":
-            relay_on(reactor, experiment, "a")
-        elif command == "relay_on":
-            relay_off(reactor, experiment, "a")
-        else:
-            print(f"Unknown command: {command}")
     except json.JSONDecodeError as e:
         print(f"Failed to decode message: {e}")
+        return
+
+    # Selectors may need an HTTP lookup, so keep it off the network thread.
+    # One intake thread keeps messages in arrival order.
+    intake.submit(handle_message, client, message)
+
+
+def handle_message(client, message):
+    # A batch is {"commands": [...]} and a cluster operation has "reactors";
+    # both run in one round-trip with one aggregated reply
+    batch = "commands" in message or "reactors" in message
+    try:
+        commands = [
+            expanded
+            for command in message.get("commands", [message])
+            for expanded in expand_command(command)
+        ]
+    except ValueError as e:
+        commands = []
+        errors = [str(e)]
+    except Exception as e:
+        # The assignments lookup for the selector failed
+        commands = []
+        errors = [repr(e)]
+    else:
+        # Validate everything before running anything
+        parsed = [parse_command(client, command) for command in commands]
+        errors = [error for _, _, command_errors in parsed for error in command_errors]
+        if not commands:
+            errors.append("No reactors selected")
+
+    if errors:
+        print(f"Rejected control message: {errors}")
+        reply = {"id": message.get("id"), "ok": False, "errors": errors}
+        client.publish(REPLY_TOPIC, json.dumps(reply))
+        return
+
+    reply = BatchReply(client, message.get("id"), len(commands), batch)
+    for index, (command, (function, args, _)) in enumerate(zip(commands, parsed)):
+        dispatcher.submit(
+            command.get("reactor"),
+            command["command"],
+            function,
+            args,
+            partial(reply.done, index),
+        )
 
 
 def on_disconnect(client, userdata, rc):
@@ -1196,6 +1342,10 @@ client.on_connect = on_connect
 client.on_message = on_message
 client.on_disconnect = on_disconnect
 
+intake = ThreadPoolExecutor(max_workers=1)
+dispatcher = ReactorDispatcher()
+scheduler = ActionScheduler(client)
+
 client.tls_set(tls_version=mqtt.ssl.PROTOCOL_TLS_CLIENT)
 client.username_pw_set(lookhere.username, lookhere.password)
 client.connect(lookhere.broker, lookhere.port)
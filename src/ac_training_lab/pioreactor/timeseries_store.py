@@ -0,0 +1,165 @@
+"""
+Local time-series store for Pioreactor readings, used by on_reactor.py.
+
+Each series (OD, normalized OD, growth rate, temperature) keeps the raw points
+in a fixed-size ring buffer plus pre-computed 1-min, 10-min and 1-h tiers with
+the min, max and mean of each bucket. Queries are answered from the finest
+tier that fits the requested window in MAX_POINTS points, so the payload size
+stays flat as the experiment gets older.
+"""
+
+import numpy as np
+
+# Bucket size in seconds -> number of buckets kept
+TIERS = {60: 7 * 24 * 60, 600: 30 * 24 * 6, 3600: 365 * 24}
+RAW_CAPACITY = 24 * 60 * 12  # one day of OD readings (12 per minute)
+MAX_POINTS = 720
+
+
+class RingBuffer:
+    """Fixed-capacity columnar buffer where the oldest rows get overwritten."""
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = {name: np.empty(capacity) for name in columns}
+        self.size = 0
+        self.head = 0  # index of the next write
+
+    def extend(self, **values):
+        n = len(next(iter(values.values())))
+        if n > self.capacity:
+            values = {name: column[-self.capacity :] for name, column in values.items()}
+            n = self.capacity
+
+        index = (self.head + np.arange(n)) % self.capacity
+        for name, column in values.items():
+            self.columns[name][index] = column
+
+        self.head = (self.head + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def __getitem__(self, name):
+        """Return one column, oldest row first."""
+        start = (self.head - self.size) % self.capacity
+        return self.columns[name][(start + np.arange(self.size)) % self.capacity]
+
+
+class SeriesStore:
+    """Raw points and downsampled tiers of one time series of one experiment.
+
+    ``filter_mod`` is the downsampling the points were requested with.
+    """
+
+    def __init__(self, experiment, filter_mod=None):
+        self.experiment = experiment
+        self.filter_mod = filter_mod
+        self.raw = RingBuffer(RAW_CAPACITY, ("t", "y"))
+        self.tiers = {
+            size: RingBuffer(capacity, ("t", "min", "max", "mean"))
+            for size, capacity in TIERS.items()
+        }
+        # Bucket still being filled per tier: [start, min, max, sum, count]
+        self.open_buckets = {size: None for size in TIERS}
+        self.last_time = None  # datetime64[ms] of the newest point
+        self.start = None  # datetime64[ms] from which the points are complete
+
+    def extend(self, points):
+        """Add ``{"x", "y"}`` points and return the ones that were new."""
+        if not points:
+            return []
+
+        t = parse_times([point["x"] for point in points])
+        if self.last_time is not None:
+            start = np.searchsorted(t, self.last_time, side="right")
+            points, t = points[start:], t[start:]
+            if not points:
+                return []
+
+        y = np.array([point["y"] for point in points], dtype=float)
+        seconds = t.astype("int64") / 1000
+
+        self.raw.extend(t=seconds, y=y)
+        for size in self.tiers:
+            self._aggregate(size, seconds, y)
+
+        self.last_time = t[-1]
+        return points
+
+    def _aggregate(self, size, seconds, y):
+        buckets = np.floor(seconds / size) * size
+        starts = np.flatnonzero(np.r_[True, np.diff(buckets) != 0])
+        rows = np.column_stack(
+            (
+                buckets[starts],
+                np.minimum.reduceat(y, starts),
+                np.maximum.reduceat(y, starts),
+                np.add.reduceat(y, starts),
+                np.diff(np.r_[starts, len(y)]),
+            )
+        )
+
+        current = self.open_buckets[size]
+        if current is not None:
+            if current[0] == rows[0, 0]:
+                rows[0, 1] = min(rows[0, 1], current[1])
+                rows[0, 2] = max(rows[0, 2], current[2])
+                rows[0, 3:] += current[3:]
+            else:
+                rows = np.vstack((current, rows))
+
+        closed = rows[:-1]
+        if len(closed):
+            self.tiers[size].extend(
+                t=closed[:, 0],
+                min=closed[:, 1],
+                max=closed[:, 2],
+                mean=closed[:, 3] / closed[:, 4],
+            )
+        self.open_buckets[size] = rows[-1]
+
+    def query(self, window_s, max_points=MAX_POINTS):
+        """Return the points of the last ``window_s`` seconds.
+
+        Raw points come back as ``{"x", "y"}``. When the raw points do not fit
+        in ``max_points``, the finest tier that does is used and each point
+        also carries the bucket ``min`` and ``max`` (``y`` is the mean).
+        """
+        now = np.datetime64("now", "ms").astype("int64") / 1000
+        cutoff = now - window_s
+
+        t = self.raw["t"]
+        start = np.searchsorted(t, cutoff, side="left")
+        if len(t) - start <= max_points:
+            return format_points(t[start:], y=self.raw["y"][start:])
+
+        for size, tier in self.tiers.items():
+            t = tier["t"]
+            y = tier["mean"]
+            low = tier["min"]
+            high = tier["max"]
+            current = self.open_buckets[size]
+            if current is not None:
+                t = np.r_[t, current[0]]
+                y = np.r_[y, current[3] / current[4]]
+                low = np.r_[low, current[1]]
+                high = np.r_[high, current[2]]
+
+            start = np.searchsorted(t, cutoff - size, side="right")
+            if len(t) - start <= max_points or size == max(self.tiers):
+                return format_points(
+                    t[start:], y=y[start:], min=low[start:], max=high[start:]
+                )
+
+
+def parse_times(xs):
+    # "2024-01-01T00:00:00.000Z" -> datetime64[ms], dropping the UTC suffix
+    return np.array(
+        np.char.rstrip(np.array(xs, dtype=str), "Z"), dtype="datetime64[ms]"
+    )
+
+
+def format_points(seconds, **columns):
+    ms = np.round(seconds * 1000).astype("int64").astype("datetime64[ms]")
+    xs = np.datetime_as_string(ms, unit="ms")
+    rows = zip(xs, *(column.tolist() for column in columns.values()))
+    return [{"x": f"{x}Z", **dict(zip(columns, values))} for x, *values in rows]
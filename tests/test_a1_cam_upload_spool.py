@@ -0,0 +1,166 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+# upload_spool.py doesn't import picamera2, so it loads without the camera stack
+spec = importlib.util.spec_from_file_location(
+    "upload_spool",
+    Path(__file__).parents[1]
+    / "src"
+    / "ac_training_lab"
+    / "a1_cam"
+    / "upload_spool.py",
+)
+upload_spool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(upload_spool)
+
+DirectoryBackend = upload_spool.DirectoryBackend
+SpoolFull = upload_spool.SpoolFull
+UploadSpool = upload_spool.UploadSpool
+
+
+class FlakyBackend(DirectoryBackend):
+    """Fails the first ``failures`` uploads, then copies like DirectoryBackend."""
+
+    def __init__(self, root, failures=0):
+        super().__init__(root)
+        self.failures = failures
+        self.attempts = []  # time.monotonic() of every upload call
+
+    def upload(self, path, object_name, callback=None):
+        self.attempts.append(time.monotonic())
+        if len(self.attempts) <= self.failures:
+            raise ConnectionError("network is down")
+        super().upload(path, object_name, callback)
+
+
+class GatedBackend(DirectoryBackend):
+    """Holds every upload until ``gate`` is set."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.gate = threading.Event()
+        self.uploads = []
+
+    def upload(self, path, object_name, callback=None):
+        self.gate.wait()
+        self.uploads.append(object_name)
+        super().upload(path, object_name, callback)
+
+
+def read_index(spool_dir):
+    with open(os.path.join(spool_dir, "index.jsonl")) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_retry_with_backoff(tmp_path):
+    backend = FlakyBackend(tmp_path / "bucket", failures=3)
+    spool = UploadSpool(
+        tmp_path / "spool",
+        backend,
+        workers=1,
+        retry_delay=0.05,
+        max_retry_delay=0.1,
+    )
+
+    spool.put(b"image", "a.jpeg")
+
+    assert spool.join(timeout=5)
+    assert (tmp_path / "bucket" / "a.jpeg").read_bytes() == b"image"
+    gaps = [b - a for a, b in zip(backend.attempts, backend.attempts[1:])]
+    assert len(gaps) == 3
+    # The delay doubles after each failure, up to max_retry_delay
+    assert gaps[0] >= 0.05
+    assert gaps[1] >= 0.1
+    assert gaps[2] >= 0.1
+
+
+def test_resume_after_restart(tmp_path):
+    down = FlakyBackend(tmp_path / "bucket", failures=1000)
+    spool = UploadSpool(tmp_path / "spool", down, workers=1, retry_delay=60)
+    spool.put(b"first", "first.jpeg", {"n": 1})
+    spool.put(b"second", "second.jpeg", {"n": 2})
+    assert not spool.join(timeout=0.1)
+
+    # A new process starts from the files and index.jsonl left on disk
+    uploaded = []
+    restarted = UploadSpool(
+        tmp_path / "spool",
+        DirectoryBackend(tmp_path / "bucket"),
+        on_uploaded=lambda name, meta: uploaded.append((name, meta)),
+    )
+
+    assert restarted.join(timeout=5)
+    assert sorted(uploaded) == [("first.jpeg", {"n": 1}), ("second.jpeg", {"n": 2})]
+    assert (tmp_path / "bucket" / "second.jpeg").read_bytes() == b"second"
+    assert sorted(os.listdir(tmp_path / "spool")) == ["index.jsonl"]
+
+
+def test_duplicates_are_uploaded_once_and_notified(tmp_path):
+    backend = GatedBackend(tmp_path / "bucket")
+    uploaded = []
+    spool = UploadSpool(
+        tmp_path / "spool",
+        backend,
+        on_uploaded=lambda name, meta: uploaded.append((name, meta)),
+    )
+
+    first = spool.put(b"same", "a.jpeg", {"n": 1})
+    second = spool.put(b"same", "b.jpeg", {"n": 2})
+    backend.gate.set()
+    assert spool.join(timeout=5)
+    # Already uploaded, reported right away without another upload
+    third = spool.put(b"same", "c.jpeg", {"n": 3})
+
+    assert first == second == third
+    assert backend.uploads == ["a.jpeg"]
+    assert uploaded == [
+        ("a.jpeg", {"n": 1}),
+        ("a.jpeg", {"n": 2}),
+        ("a.jpeg", {"n": 3}),
+    ]
+
+
+def test_spool_full(tmp_path):
+    backend = GatedBackend(tmp_path / "bucket")
+    spool = UploadSpool(tmp_path / "spool", backend, max_files=2, max_bytes=10)
+
+    spool.put(b"1234", "a.jpeg")
+    with pytest.raises(SpoolFull):
+        spool.put(b"1234567", "b.jpeg")  # over max_bytes
+    spool.put(b"5678", "c.jpeg")
+    with pytest.raises(SpoolFull):
+        spool.put(b"9", "d.jpeg")  # over max_files
+
+    backend.gate.set()
+    assert spool.join(timeout=5)
+    spool.put(b"9", "d.jpeg")
+    assert spool.join(timeout=5)
+    assert sorted(backend.uploads) == ["a.jpeg", "c.jpeg", "d.jpeg"]
+
+
+def test_index_is_compacted_and_capped(tmp_path):
+    backend = DirectoryBackend(tmp_path / "bucket")
+    spool = UploadSpool(tmp_path / "spool", backend, max_files=2, max_uploaded=3)
+    for n in range(6):
+        spool.put(str(n).encode(), f"{n}.jpeg")
+        assert spool.join(timeout=5)
+
+    # Rewritten once it exceeded 2 * (max_uploaded + max_files) lines
+    assert len(read_index(tmp_path / "spool")) < 12
+    assert list(spool.uploaded.values()) == ["3.jpeg", "4.jpeg", "5.jpeg"]
+
+    restarted = UploadSpool(tmp_path / "spool", backend, max_uploaded=3)
+    assert read_index(tmp_path / "spool") == [
+        {"op": "done", "hash": content_hash, "object_name": f"{n}.jpeg"}
+        for n, content_hash in zip((3, 4, 5), restarted.uploaded)
+    ]
+    # Forgotten content is uploaded again instead of deduplicated
+    restarted.put(b"0", "0-again.jpeg")
+    assert restarted.join(timeout=5)
+    assert (tmp_path / "bucket" / "0-again.jpeg").exists()
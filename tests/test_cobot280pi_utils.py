@@ -0,0 +1,50 @@
+import importlib.util
+import json
+from pathlib import Path
+
+import paho.mqtt.client as paho
+from paho.mqtt.packettypes import PacketTypes
+
+COBOT_DIR = Path(__file__).parents[1] / "src" / "ac_training_lab" / "cobot280pi"
+spec = importlib.util.spec_from_file_location("cobot_utils", COBOT_DIR / "utils.py")
+cobot_utils = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cobot_utils)
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, qos=0, payload=None, properties=None):
+        self.published.append((topic, payload, properties))
+        return paho.MQTTMessageInfo(len(self.published))
+
+
+def test_publish_jpeg_chunks_carry_one_chunk_property():
+    client = FakeClient()
+    properties = paho.Properties(PacketTypes.PUBLISH)
+    properties.CorrelationData = b"abc"
+    properties.ResponseTopic = "cobot/response"
+    jpeg = bytes(range(256)) * 10
+
+    handle = cobot_utils.publish_jpeg(
+        client, "topic", jpeg, {"success": True}, properties, chunk_size=1000
+    )
+
+    assert handle.mid == 3
+    assert [payload for _, payload, _ in client.published] == [
+        jpeg[:1000],
+        jpeg[1000:2000],
+        jpeg[2000:],
+    ]
+    for chunk, (_, _, chunk_properties) in enumerate(client.published):
+        user_properties = chunk_properties.UserProperty
+        assert [name for name, _ in user_properties] == ["metadata", "chunk"]
+        assert dict(user_properties)["chunk"] == str(chunk)
+        metadata = json.loads(dict(user_properties)["metadata"])
+        assert metadata == {"success": True, "size": len(jpeg), "chunks": 3}
+        assert chunk_properties.CorrelationData == b"abc"
+        assert chunk_properties.ResponseTopic == "cobot/response"
+        assert chunk_properties.ContentType == "image/jpeg"
+    # The request's properties are left alone
+    assert not hasattr(properties, "UserProperty")
@@ -0,0 +1,99 @@
+import importlib.util
+import os
+from pathlib import Path
+
+import paho.mqtt.client as paho
+
+spec = importlib.util.spec_from_file_location(
+    "mqtt_recorder",
+    Path(__file__).parents[1] / "src" / "ac_training_lab" / "mqtt_recorder.py",
+)
+mqtt_recorder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mqtt_recorder)
+Message = mqtt_recorder.Message
+Recorder = mqtt_recorder.Recorder
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload, qos, retain))
+        info = paho.MQTTMessageInfo(len(self.published))
+        info._published = True
+        return info
+
+
+def test_block_round_trip():
+    messages = [
+        Message(1.5, "FX-120i/a", b"12.3g", 0, False),
+        Message(2.25, "magnetometer/picow/b/sensor_data", b"\x00\xff" * 100, 1, True),
+        Message(3.0, "FX-120i/a", b"", 2, False),
+    ]
+    block = mqtt_recorder.encode_block(messages)
+    _, size, count = mqtt_recorder.struct.unpack_from(mqtt_recorder.BLOCK_HEADER, block)
+
+    assert size == len(block) - mqtt_recorder.BLOCK_HEADER_SIZE
+    decoded = mqtt_recorder.decode_block(
+        block[mqtt_recorder.BLOCK_HEADER_SIZE :], count
+    )
+    assert decoded == messages
+
+
+def test_read_filters_by_topic_and_time(tmp_path):
+    recorder = Recorder(tmp_path, block_messages=2)
+    for i in range(5):
+        recorder.record("FX-120i/a", b"%d" % i, received=100.0 + i)
+        recorder.record("USS-DBS51-30/b", b"x", received=100.5 + i)
+    recorder.close()
+
+    messages = list(
+        mqtt_recorder.read_messages(tmp_path, ["FX-120i/#"], start=101, end=103)
+    )
+
+    assert [m.payload for m in messages] == [b"1", b"2", b"3"]
+    assert mqtt_recorder.summary(tmp_path)["USS-DBS51-30/b"][0] == 5
+
+
+def test_recovers_blocks_missing_from_the_index(tmp_path):
+    recorder = Recorder(tmp_path, block_messages=1)
+    for i in range(3):
+        recorder.record("FX-120i/a", b"%d" % i, received=100.0 + i)
+    recorder.close()
+    (segment,) = mqtt_recorder.segments(tmp_path)
+    index = segment[: -len(mqtt_recorder.SEGMENT_SUFFIX)] + mqtt_recorder.INDEX_SUFFIX
+    # A crash after the second block was written but before its index line,
+    # in the middle of writing the third block
+    with open(index) as f:
+        first_line = f.readline()
+    with open(index, "w") as f:
+        f.write(first_line + '{"offset": ')
+    with open(segment, "rb+") as f:
+        f.truncate(os.path.getsize(segment) - 3)
+
+    messages = list(mqtt_recorder.read_messages(tmp_path))
+
+    assert [m.payload for m in messages] == [b"0", b"1"]
+
+
+def test_replay_skips_commands_and_retain():
+    messages = [
+        Message(0, "pioreactor/control", b"{}", 1, False),
+        Message(0, "pioreactor/pio1/exp/stirring/target_rpm/set", b"500", 1, False),
+        Message(0, "fan-control/picow/a/speed", b"100", 1, True),
+        Message(0, "fan-control/picow/a/rpm", b"900", 1, True),
+    ]
+
+    client = FakeClient()
+    assert mqtt_recorder.replay(client, messages, speed=0, prefix="test/") == 1
+    assert client.published == [("test/fan-control/picow/a/rpm", b"900", 1, False)]
+
+    client = FakeClient()
+    mqtt_recorder.replay(client, messages, speed=0, retain=True, commands=True)
+    assert [published[3] for published in client.published] == [
+        False,
+        False,
+        True,
+        True,
+    ]
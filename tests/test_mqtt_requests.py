@@ -0,0 +1,96 @@
+import importlib.util
+import threading
+import time
+from concurrent.futures import TimeoutError
+from pathlib import Path
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "mqtt_requests",
+    Path(__file__).parents[1] / "src" / "ac_training_lab" / "mqtt_requests.py",
+)
+mqtt_requests = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mqtt_requests)
+
+
+class EchoClient(mqtt_requests.PendingRequests):
+    """Requests are answered by ``reply`` instead of a broker."""
+
+    batch_timeout = 0.05
+
+    def __init__(self):
+        self._init_pending()
+        self.published = 0
+
+    def call(self, value, timeout=1, transform=None):
+        self.published += 1
+        request = self._add_pending(self.published)
+        future = request if transform is None else self._then(request, transform)
+        if self._batched(request, future):
+            return future
+        return self._wait(request, future, timeout)
+
+    def reply(self, request_id, value):
+        with self.pending_lock:
+            future = self.pending.pop(request_id)
+        future.set_result(value)
+
+
+def test_timed_out_requests_are_dropped():
+    client = EchoClient()
+
+    with pytest.raises(TimeoutError):
+        client.call("lost", timeout=0.01, transform=str.upper)
+
+    assert client.pending == {}
+
+
+def test_batch_drops_the_requests_left_without_a_reply():
+    client = EchoClient()
+
+    with client.batch() as futures:
+        first = client.call("a", transform=str.upper)
+        client.call("b")
+        client.reply(1, "a")
+
+    assert first.result() == "A"
+    assert len(futures) == 2
+    assert client.pending == {}
+
+
+def test_batch_is_per_thread():
+    client = EchoClient()
+    results = []
+    inside = threading.Event()
+
+    def other_thread():
+        inside.wait()
+        # Not part of the batch below, so this waits for its own reply
+        results.append(client.call("other"))
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    with client.batch() as futures:
+        client.call("batched")
+        inside.set()
+        while 2 not in client.pending:
+            time.sleep(0.001)
+        client.reply(2, "other")
+        client.reply(1, "batched")
+    thread.join()
+
+    assert [future.result() for future in futures] == ["batched"]
+    assert results == ["other"]
+
+
+def test_nested_batch_restores_the_outer_one():
+    client = EchoClient()
+
+    with client.batch() as outer:
+        with client.batch():
+            client.call("inner")
+        client.call("outer")
+
+    assert len(outer) == 1
+    assert client.pending == {}
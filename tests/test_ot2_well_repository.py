@@ -0,0 +1,162 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+mongomock = pytest.importorskip("mongomock")
+ReturnDocument = pymongo.ReturnDocument
+
+SCRIPTS_DIR = (
+    Path(__file__).parents[1] / "src" / "ac_training_lab" / "ot-2" / "_scripts"
+)
+spec = importlib.util.spec_from_file_location(
+    "well_repository", SCRIPTS_DIR / "well_repository.py"
+)
+well_repository = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(well_repository)
+WellRepository = well_repository.WellRepository
+
+
+class SortedCollection:
+    """
+    mongomock collection whose find_one_and_update honors ``sort`` (mongomock
+    4.3 returns the first document in sort order but updates another one).
+    Also counts bulk_write calls.
+    """
+
+    def __init__(self):
+        self.collection = mongomock.MongoClient().db.wells
+        self.bulk_writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        self.bulk_writes += 1
+        return self.collection.bulk_write(requests, ordered=ordered)
+
+    def find_one_and_update(
+        self,
+        filter,
+        update,
+        sort=None,
+        projection=None,
+        return_document=ReturnDocument.BEFORE,
+    ):
+        cursor = self.collection.find(filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        document = next(cursor.limit(1), None)
+        if document is None:
+            return None
+        self.collection.update_one({"_id": document["_id"]}, update)
+        if return_document == ReturnDocument.BEFORE:
+            document = {"_id": document["_id"]}
+        return self.collection.find_one({"_id": document["_id"]}, projection)
+
+
+@pytest.fixture
+def collection():
+    return SortedCollection()
+
+
+@pytest.fixture
+def repository(collection):
+    repository = WellRepository(collection, project="test")
+    repository.reset()
+    return repository
+
+
+def wells(reserved):
+    return [(well["plate"], well["well"]) for well in reserved]
+
+
+def test_reset_and_mark_used_are_single_bulk_writes(collection, repository):
+    assert collection.bulk_writes == 1
+    assert len(repository.unused()) == 96
+
+    repository.mark_used(["A1", "B12", "C3"])
+
+    assert collection.bulk_writes == 2
+    unused = repository.unused()
+    assert len(unused) == 93
+    assert unused[:3] == ["A2", "A3", "A4"]
+    assert "B12" not in unused
+
+
+def test_reserve_claims_wells_in_plate_order(repository):
+    first = repository.reserve(5, "session-1")
+    second = repository.reserve(3, "session-2")
+
+    assert wells(first) == [(1, f"A{col}") for col in range(1, 6)]
+    assert wells(second) == [(1, "A6"), (1, "A7"), (1, "A8")]
+    assert repository.unused()[:2] == ["A9", "A10"]
+
+
+def test_reserve_skips_used_wells_and_spans_plates(collection):
+    repository = WellRepository(collection, project="test", plates=2)
+    repository.reset()
+    repository.mark_used(well_repository.plate_wells()[:-2], plate=1)
+
+    assert wells(repository.reserve(3, "session")) == [
+        (1, "H11"),
+        (1, "H12"),
+        (2, "A1"),
+    ]
+
+
+def test_expired_reservations_are_free_again(repository, monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(well_repository.time, "time", lambda: now)
+    first = repository.reserve(2, "abandoned", ttl=60)
+
+    now += 61
+    second = repository.reserve(2, "session")
+
+    assert wells(second) == wells(first)
+
+
+def test_release_gives_back_only_that_session(repository):
+    repository.reserve(2, "session-1")
+    repository.reserve(2, "session-2")
+
+    repository.release("session-1")
+
+    assert wells(repository.reserve(3, "session-3")) == [
+        (1, "A1"),
+        (1, "A2"),
+        (1, "A5"),
+    ]
+
+
+def test_failed_reserve_keeps_nothing_reserved(repository):
+    repository.mark_used(well_repository.plate_wells()[3:])
+
+    with pytest.raises(ValueError, match="Only 3 empty wells available"):
+        repository.reserve(5, "session")
+
+    assert repository.unused() == ["A1", "A2", "A3"]
+
+
+def test_confirm_marks_reserved_wells_used(collection, repository):
+    repository.reserve(2, "session")
+    repository.confirm("session")
+
+    documents = collection.find({"status": "used"}, {"well": 1, "_id": 0})
+    assert sorted(document["well"] for document in documents) == ["A1", "A2"]
+    assert collection.count_documents({"reserved_by": {"$exists": True}}) == 0
+    assert repository.unused()[0] == "A3"
+
+
+def test_migrates_documents_without_plates(collection):
+    collection.insert_one({"project": "test", "well": "A2", "status": "used"})
+
+    repository = WellRepository(collection, project="test", plates=2)
+    repository.reset(plate=2)
+
+    document = collection.find_one({"well": "A2", "plate": 1})
+    assert document["order"] == well_repository.well_order(1, "A2")
+    assert collection.count_documents({"well": "A2"}) == 2
+    assert repository.unused() == []
+    assert len(repository.unused(plate=2)) == 96
@@ -0,0 +1,132 @@
+import importlib.util
+import io
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+PICAM_DIR = Path(__file__).parents[1] / "src" / "ac_training_lab" / "picam"
+
+
+def load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# device.py imports my_secrets, for which the example values are good enough
+sys.modules["my_secrets"] = load("my_secrets", PICAM_DIR / "my_secrets_example.py")
+try:
+    device = load("picam_device", PICAM_DIR / "device.py")
+finally:
+    del sys.modules["my_secrets"]
+
+PROFILE = {"width": 640, "height": 360, "framerate": 15, "bitrate": 600000}
+
+
+def progress(frame, fps=15.0, drop_frames=0):
+    return (
+        f"frame={frame}\nfps={fps}\nbitrate=600.0kbits/s\n"
+        f"drop_frames={drop_frames}\nspeed=1.0x\nprogress=continue\n"
+    )
+
+
+class FakeProcess:
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.waited = False
+
+    def wait(self, timeout=None):
+        self.waited = True
+
+
+def test_watch_records_progress_until_exit():
+    supervisor = device.StreamSupervisor(lambda: "out.flv")
+    stdout = io.StringIO(progress(15) + progress(30) + progress(45))
+    process = FakeProcess(stdout)
+
+    assert supervisor.watch(process, PROFILE) is False
+    assert process.waited
+    stats = supervisor.snapshot()
+    assert stats["frame"] == 45
+    assert stats["bitrate_kbps"] == 600.0
+
+
+def test_watch_steps_down_on_sustained_drops(monkeypatch):
+    monkeypatch.setattr(device, "DROP_WINDOW", 0)
+    supervisor = device.StreamSupervisor(lambda: "out.flv")
+    stdout = io.StringIO(
+        progress(15) + progress(20, drop_frames=10) + progress(25, drop_frames=20)
+    )
+
+    assert supervisor.watch(FakeProcess(stdout), PROFILE) is True
+    # Already at the lowest profile, keep streaming
+    stdout.seek(0)
+    assert supervisor.watch(FakeProcess(stdout), PROFILE, False) is False
+
+
+def test_watch_gives_up_on_a_stalled_ffmpeg():
+    supervisor = device.StreamSupervisor(lambda: "out.flv", stall_timeout=0.2)
+    read_fd, write_fd = os.pipe()
+    stdout = os.fdopen(read_fd)
+    writer = os.fdopen(write_fd, "w")
+    writer.write(progress(15))
+    writer.flush()  # then nothing more, without exiting
+
+    started = time.monotonic()
+    try:
+        assert supervisor.watch(FakeProcess(stdout), PROFILE) is False
+    finally:
+        writer.close()
+    assert time.monotonic() - started < 2
+    assert supervisor.snapshot()["state"] == "stalled"
+
+
+def test_run_restarts_after_a_stall(monkeypatch):
+    started = []
+    all_started = threading.Event()
+
+    class Pipeline(FakeProcess):
+        def __init__(self):
+            read_fd, self.write_fd = os.pipe()
+            super().__init__(os.fdopen(read_fd))
+
+        def terminate(self):
+            os.close(self.write_fd)
+
+    def start_stream(ffmpeg_url, profile, test_source):
+        started.append(ffmpeg_url)
+        if len(started) == 2:
+            all_started.set()
+            raise KeyboardInterrupt
+        return None, Pipeline()
+
+    monkeypatch.setattr(device, "start_stream", start_stream)
+    monkeypatch.setattr(device, "MIN_BACKOFF", 0)
+    supervisor = device.StreamSupervisor(lambda: "out.flv", stall_timeout=0.1)
+    supervisor.backoff = 0
+
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    assert all_started.is_set()
+    assert supervisor.snapshot()["restarts"] == 1
+
+
+def test_ffmpeg_overwrites_local_output(monkeypatch):
+    commands = []
+
+    class Popen:
+        def __init__(self, cmd, **kwargs):
+            commands.append((cmd, kwargs))
+
+    monkeypatch.setattr(device.subprocess, "Popen", Popen)
+    device.start_stream("out.flv", PROFILE, test_source=True)
+
+    cmd, kwargs = commands[0]
+    assert cmd[:2] == ["ffmpeg", "-y"]
+    assert cmd[-1] == "out.flv"
+    assert kwargs["stdin"] == device.subprocess.DEVNULL
@@ -0,0 +1,89 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    "timeseries_store",
+    Path(__file__).parents[1]
+    / "src"
+    / "ac_training_lab"
+    / "pioreactor"
+    / "timeseries_store.py",
+)
+timeseries_store = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(timeseries_store)
+RingBuffer = timeseries_store.RingBuffer
+SeriesStore = timeseries_store.SeriesStore
+
+
+def points(seconds, ys):
+    """``{"x", "y"}`` points in the Pioreactor API format."""
+    return timeseries_store.format_points(
+        np.asarray(seconds, dtype=float), y=np.asarray(ys, dtype=float)
+    )
+
+
+def test_ring_buffer_keeps_the_newest_rows_in_order():
+    buffer = RingBuffer(4, ("t",))
+    buffer.extend(t=[1, 2, 3])
+    buffer.extend(t=[4, 5])
+
+    assert buffer.size == 4
+    assert buffer["t"].tolist() == [2, 3, 4, 5]
+
+    buffer.extend(t=[6, 7, 8, 9, 10, 11])
+    assert buffer["t"].tolist() == [8, 9, 10, 11]
+
+
+def test_extend_skips_points_already_stored():
+    store = SeriesStore("exp")
+    assert len(store.extend(points([0, 5, 10], [1, 2, 3]))) == 3
+
+    new = store.extend(points([5, 10, 15], [2, 3, 4]))
+
+    assert [point["y"] for point in new] == [4]
+    assert store.raw["t"].tolist() == [0, 5, 10, 15]
+
+
+def test_tiers_hold_min_max_and_mean_of_closed_buckets():
+    store = SeriesStore("exp")
+    # Two minutes of readings every 20 s, then one more to close the second
+    store.extend(points([0, 20, 40], [1, 5, 3]))
+    store.extend(points([60, 80, 100], [2, 2, 8]))
+    store.extend(points([120], [0]))
+
+    tier = store.tiers[60]
+    assert tier["t"].tolist() == [0, 60]
+    assert tier["min"].tolist() == [1, 2]
+    assert tier["max"].tolist() == [5, 8]
+    assert tier["mean"].tolist() == [3, 4]
+    assert store.open_buckets[60].tolist() == [120, 0, 0, 0, 1]
+    assert len(store.tiers[600]["t"]) == 0
+
+
+def test_query_uses_raw_points_while_they_fit():
+    now = np.datetime64("now", "s").astype("int64")
+    store = SeriesStore("exp")
+    store.extend(points(now - np.arange(100, 0, -10), np.arange(10)))
+
+    result = store.query(window_s=55)
+
+    assert [point["y"] for point in result] == [5, 6, 7, 8, 9]
+    assert set(result[0]) == {"x", "y"}
+
+
+def test_query_falls_back_to_the_finest_tier_that_fits():
+    now = np.datetime64("now", "s").astype("int64") // 60 * 60
+    store = SeriesStore("exp")
+    # Two hours of one reading per second
+    seconds = np.arange(now - 7200, now)
+    store.extend(points(seconds, np.ones(len(seconds))))
+
+    result = store.query(window_s=3600, max_points=100)
+
+    # 60 one-minute buckets (plus the partial one at the edge of the window)
+    assert 60 <= len(result) <= 62
+    assert set(result[0]) == {"x", "y", "min", "max"}
+    assert all(point["y"] == pytest.approx(1) for point in result)
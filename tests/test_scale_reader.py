@@ -0,0 +1,172 @@
+import asyncio
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+LIB_DIR = (
+    Path(__file__).parents[1]
+    / "src"
+    / "ac_training_lab"
+    / "picow"
+    / "autotrickler-scale"
+    / "lib"
+)
+spec = importlib.util.spec_from_file_location(
+    "scale_reader", LIB_DIR / "scale_reader.py"
+)
+scale_reader = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(scale_reader)
+parse_line = scale_reader.parse_line
+ScaleReader = scale_reader.ScaleReader
+
+
+class FakeUart:
+    """
+    Async reader and writer in one, like the UART streams. Lines are handed
+    out as they are fed; ``reply`` is fed back for every command written.
+    """
+
+    def __init__(self, reply=None):
+        self.lines = asyncio.Queue()
+        self.reply = reply
+        self.written = []
+
+    def feed(self, *lines):
+        for line in lines:
+            self.lines.put_nowait(line)
+
+    def close(self):
+        self.lines.put_nowait(b"")
+
+    async def readline(self):
+        return await self.lines.get()
+
+    def write(self, data):
+        self.written.append(data)
+        if self.reply is not None:
+            self.feed(self.reply)
+
+    async def drain(self):
+        pass
+
+
+@pytest.mark.parametrize(
+    "line, weight, unit, stable",
+    [
+        (b"ST,+00012.34  g\r\n", 12.34, "g", True),
+        (b"US,-00000.05  g\r\n", -0.05, "g", False),
+        (b"QT,+00010 PC\r\n", 10.0, "PC", None),
+        (b"  12.345 g\r\n", 12.345, "g", None),
+        ("ST,+00001.50 ct", 1.5, "ct", True),
+    ],
+)
+def test_parse_line(line, weight, unit, stable):
+    reading = parse_line(line)
+    assert reading.weight == weight
+    assert reading.unit == unit
+    assert reading.stable is stable
+
+
+@pytest.mark.parametrize(
+    "line",
+    [b"OL,+9999999 g\r\n", b"OK\r\n", b"\r\n", b"\xff\xfe", b"ST,\r\n"],
+)
+def test_parse_line_without_a_weight(line):
+    assert parse_line(line) is None
+
+
+def test_continuous_mode_coalesces_readings():
+    async def main():
+        uart = FakeUart()
+        scale = ScaleReader(uart, uart, continuous=b"SIR\r\n")
+        task = asyncio.create_task(scale.run())
+        uart.feed(
+            b"US,+00010.00  g\r\n",
+            b"OL,+9999999 g\r\n",
+            b"ST,+00010.20  g\r\n",
+            b"ST,+00010.10  g\r\n",
+        )
+        await asyncio.sleep(0)
+        while not uart.lines.empty():
+            await asyncio.sleep(0)
+        first = scale.take()
+        uart.feed(b"ST,+00010.10  g\r\n")
+        uart.close()
+        await task
+        return uart, scale, first
+
+    uart, scale, first = asyncio.run(main())
+
+    assert uart.written == [b"SIR\r\n"]
+    assert first == {
+        "last": 10.1,
+        "min": 10.0,
+        "max": 10.2,
+        "unit": "g",
+        "text": "+00010.10  g",
+        "readings": 3,
+        "stable": False,
+    }
+    second = scale.take()
+    assert second["readings"] == 1
+    assert second["stable"] is True
+    assert scale.take() is None
+    assert scale.lines == 5
+
+
+def test_polled_mode_uses_the_tolerance():
+    async def main():
+        uart = FakeUart(reply=b"  5.001 g\r\n")
+        scale = ScaleReader(uart, uart, poll_interval=0.01, tolerance=0.01)
+        task = asyncio.create_task(scale.run())
+        await asyncio.sleep(0.05)
+        steady = scale.take()
+        uart.feed(b"  5.001 g\r\n")
+        uart.reply = b"  5.100 g\r\n"
+        await asyncio.sleep(0.03)
+        moving = scale.take()
+        uart.close()
+        await task
+        return uart, steady, moving
+
+    uart, steady, moving = asyncio.run(main())
+
+    assert set(uart.written) == {b"Q\r\n"}
+    assert steady["readings"] >= 2
+    assert steady["stable"] is True
+    assert moving["min"] == 5.001
+    assert moving["max"] == 5.1
+    assert moving["stable"] is False
+
+
+def test_a_new_unit_starts_a_new_window():
+    window = scale_reader.ReadingWindow()
+    for line in (b"ST,+00012.00  g", b"QT,+00010 PC", b"QT,+00011 PC"):
+        window.add(parse_line(line))
+
+    summary = window.summary(tolerance=0)
+    assert summary["unit"] == "PC"
+    assert (summary["min"], summary["max"], summary["readings"]) == (10, 11, 2)
+
+
+def test_continuous_command_is_sent_again_after_silence():
+    async def main():
+        uart = FakeUart()
+        scale = ScaleReader(uart, uart, continuous=b"SIR\r\n", resend_after=0.05)
+        task = asyncio.create_task(scale.run())
+        for _ in range(5):
+            uart.feed(b"ST,+00010.00  g\r\n")
+            await asyncio.sleep(0.005)
+        streaming = list(uart.written)
+        # Power cycled: the scale stays quiet until it is told to stream again
+        await asyncio.sleep(0.15)
+        uart.close()
+        await task
+        return streaming, uart.written
+
+    streaming, written = asyncio.run(main())
+
+    assert streaming == [b"SIR\r\n"]
+    assert len(written) >= 2
+    assert set(written) == {b"SIR\r\n"}